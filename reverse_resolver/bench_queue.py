@@ -0,0 +1,89 @@
+"""
+This module contains a benchmark of the AsyncLimitedProcessor queue.
+
+Usage:
+python bench_queue.py -n 10000 50000 100000 -c 100 -- enqueues N items of
+100 clients and both priorities to a processor running one item at a time,
+then completes them all, prints the scheduling cost per item.
+"""
+
+import argparse
+import gc
+import time
+
+from twisted.internet.defer import Deferred
+
+from main import PRIORITIES
+from main import AsyncLimitedProcessor
+
+
+class BenchProcessor(AsyncLimitedProcessor):
+
+    def __init__(self, limit):
+        AsyncLimitedProcessor.__init__(self, limit)
+        self.handled = []
+
+    def _item_key(self, item):
+        return item
+
+    def _handle_item(self, item):
+        result = Deferred()
+        self.handled.append(result)
+        return result
+
+
+def bench_queue(count, clients, cancelled_ratio):
+    processor = BenchProcessor(1)
+    gc.disable()
+    try:
+        start = time.time()
+        results = [processor.enqueue(index,
+                                     PRIORITIES[index % len(PRIORITIES)],
+                                     index % clients)
+                   for index in xrange(count)]
+        enqueue_time = time.time() - start
+
+        start = time.time()
+        if cancelled_ratio:
+            step = int(1 / cancelled_ratio)
+            for result in results[1::step]:
+                result.addErrback(lambda _: None)
+                result.cancel()
+        cancel_time = time.time() - start
+
+        # every completed item starts the next one
+        start = time.time()
+        index = 0
+        while index < len(processor.handled):
+            processor.handled[index].callback(None)
+            index += 1
+        drain_time = time.time() - start
+    finally:
+        gc.enable()
+    assert processor.queue_length == 0 and processor.active_count == 0
+    return {
+        'count': count,
+        'processed': len(processor.handled),
+        'enqueue_us': enqueue_time / count * 1e6,
+        'cancel_us': cancel_time / count * 1e6,
+        'drain_us': drain_time / len(processor.handled) * 1e6,
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", "--counts", type=int, nargs='+',
+                        default=[10000, 50000, 100000],
+                        help="numbers of enqueued items")
+    parser.add_argument("-c", "--clients", type=int, default=100,
+                        help="number of clients sharing the queue")
+    parser.add_argument("--cancelled", type=float, default=0.1,
+                        help="ratio of cancelled queued items")
+    args = parser.parse_args()
+
+    print("%8s %10s %12s %12s %12s" % (
+        'items', 'processed', 'enqueue, us', 'cancel, us', 'drain, us'))
+    for count in args.counts:
+        result = bench_queue(count, args.clients, args.cancelled)
+        print("%(count)8d %(processed)10d %(enqueue_us)12.2f "
+              "%(cancel_us)12.2f %(drain_us)12.2f" % result)
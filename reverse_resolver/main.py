@@ -1,15 +1,48 @@
-from copy import deepcopy
+import cgi
+import hashlib
+import json
+import math
+import os
+import re
+import sys
+from collections import OrderedDict
+from collections import deque
+from collections import namedtuple
 from datetime import datetime
+from functools import partial
+from itertools import islice
+from urllib import urlencode
+
+from zope.interface import implementer
 
 from twisted.internet import reactor
+from twisted.internet.abstract import isIPAddress
 from twisted.internet.defer import Deferred
+from twisted.internet.defer import TimeoutError
+from twisted.internet.defer import fail
 from twisted.internet.defer import inlineCallbacks
 from twisted.internet.defer import maybeDeferred
+from twisted.internet.defer import returnValue
+from twisted.internet.defer import succeed
+from twisted.internet.endpoints import TCP4ClientEndpoint
 from twisted.internet.endpoints import TCP4ServerEndpoint
+from twisted.internet.endpoints import connectProtocol
+from twisted.internet.error import ConnectionDone
+from twisted.internet.interfaces import IPushProducer
 from twisted.internet.protocol import ProcessProtocol
+from twisted.internet.protocol import Protocol
+from twisted.internet.task import Cooperator
+from twisted.internet.task import LoopingCall
+from twisted.internet.task import TaskFinished
+from twisted.internet.task import TaskStopped
 from twisted.names import client
+from twisted.names import dns
+from twisted.names.error import DNSNameError
+from twisted.python import log
 from twisted.python.failure import Failure
+from twisted.web import http
 from twisted.web.resource import Resource
+from twisted.web.server import NOT_DONE_YET
 from twisted.web.server import Site
 from twisted.web.util import redirectTo
 
@@ -17,35 +50,200 @@ from twisted.web.util import redirectTo
 # ------------------------------------------------------------------------------
 
 
+# items of higher priority are processed first, the lower value the higher
+# priority
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BULK = 1
+PRIORITIES = (PRIORITY_INTERACTIVE, PRIORITY_BULK)
+
+
+class QueueFullError(Exception):
+    pass
+
+
+# upper bounds of latency histogram buckets, every next one is twice as
+# large: 0.5 ms .. 32 s
+LATENCY_MIN_BOUND = 0.0005
+LATENCY_BUCKETS = 17
+
+
+class LatencyHistogram(object):
+
+    # counts of values in buckets of exponentially growing width, so the
+    # relative error is the same for fast and slow values
+
+    __slots__ = ('counts', 'count', 'sum')
+
+    def __init__(self):
+        # the last bucket is for values above all the bounds
+        self.counts = [0] * (LATENCY_BUCKETS + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    @staticmethod
+    def get_bounds():
+        return [LATENCY_MIN_BOUND * 2 ** index
+                for index in xrange(LATENCY_BUCKETS)]
+
+    def add(self, value):
+        # the bucket index is the binary exponent of the value in units of
+        # the first bound, values equal to a bound are counted in its bucket
+        mantissa, exponent = math.frexp(value / LATENCY_MIN_BOUND)
+        if mantissa == 0.5:
+            exponent -= 1
+        if exponent < 0:
+            exponent = 0
+        elif exponent > LATENCY_BUCKETS:
+            exponent = LATENCY_BUCKETS
+        self.counts[exponent] += 1
+        self.count += 1
+        self.sum += value
+
+
+class QueueEntry(object):
+
+    # an item being queued or processed and results waiting for it: the item
+    # result and the same key items results
+
+    __slots__ = ('item', 'key', 'waiters', 'running', 'priority', 'time')
+
+    def __init__(self, item, key, time):
+        self.item = item
+        self.key = key
+        self.waiters = []
+        self.running = False
+        # the highest priority of the waiters, the entry is queued with it
+        self.priority = None
+        # of enqueueing, then of the processing start
+        self.time = time
+
+
 class AsyncLimitedProcessor(object):
 
-    def __init__(self, limit):
-        self._queue = []
+    def __init__(self, limit, max_queue_length=None, clock=reactor):
+        self._clock = clock
         self._active_count = 0
         self._limit = limit
+        self._max_queue_length = max_queue_length
+        self._queue_length = 0
+        # queues of clients in round robin order for every priority
+        self._client_queues = [OrderedDict() for _ in PRIORITIES]
+        # queued and processed entries by item keys
+        self._entries = {}
+        self._wait_time = LatencyHistogram()
+        self._handle_time = LatencyHistogram()
+        self._successes = 0
+        # error counts by exception type names
+        self._errors = {}
 
-    def _next(self):
-        if self._queue:
-            handler_args = self._queue.pop(0)
-            self._process(*handler_args)
+    @property
+    def active_count(self):
+        return self._active_count
 
-    def _callback(self, handler_result, process_result):
-        process_result.callback(handler_result)
+    @property
+    def queue_length(self):
+        return self._queue_length
+
+    def get_stats(self):
+        return {
+            'active': self._active_count,
+            'limit': self._limit,
+            'queued': self._queue_length,
+            'max_queued': self._max_queue_length,
+            'wait_time': self._wait_time,
+            'handle_time': self._handle_time,
+            'successes': self._successes,
+            'errors': dict(self._errors),
+        }
+
+    def _pop_entry(self):
+        for client_queues in self._client_queues:
+            while client_queues:
+                client, queue = client_queues.popitem(last=False)
+                entry = queue.popleft()
+                if queue:
+                    client_queues[client] = queue
+                # entries without waiters are cancelled, running ones were
+                # moved to a higher priority queue and are left here
+                if entry.waiters and not entry.running:
+                    self._queue_length -= 1
+                    return entry
+        return None
+
+    def _push_entry(self, entry, priority, client):
+        # an entry moved to a higher priority queue stays in the previous
+        # one and is skipped there
+        if entry.priority is None:
+            self._queue_length += 1
+        entry.priority = priority
+        client_queues = self._client_queues[priority]
+        queue = client_queues.get(client)
+        if queue is None:
+            queue = client_queues[client] = deque()
+        queue.append(entry)
+
+    def _next(self):
+        # waiters of a finished entry may have started new items already
+        while self._active_count < self._limit:
+            entry = self._pop_entry()
+            if entry is None:
+                break
+            self._process(entry)
+
+    def _finish(self, entry):
+        # the entry still counts as active while its waiters are fired, so
+        # items enqueued by them wait in the queue
+        self._handle_time.add(self._clock.seconds() - entry.time)
+        if entry.key is not None and self._entries.get(entry.key) is entry:
+            del self._entries[entry.key]
+        waiters, entry.waiters = entry.waiters, []
+        return waiters
+
+    def _callback(self, handler_result, entry):
+        self._successes += 1
+        for process_result, item in self._finish(entry):
+            if item is not entry.item:
+                self._copy_result(entry.item, item)
+            process_result.callback(handler_result)
         self._active_count -= 1
         self._next()
 
-    def _errback(self, handler_fail, process_result):
-        process_result.errback(handler_fail)
+    def _errback(self, handler_fail, entry):
+        error_type = handler_fail.type.__name__
+        self._errors[error_type] = self._errors.get(error_type, 0) + 1
+        for process_result, _ in self._finish(entry):
+            process_result.errback(handler_fail)
         self._active_count -= 1
         self._next()
 
+    def _cancel(self, entry, process_result):
+        entry.waiters = [waiter for waiter in entry.waiters
+                         if waiter[0] is not process_result]
+        if not entry.waiters and not entry.running:
+            # the entry stays in its queue and is skipped there
+            self._queue_length -= 1
+            if entry.key is not None and self._entries.get(entry.key) is entry:
+                del self._entries[entry.key]
+
     def _handle_item(self, item):
         raise NotImplementedError("Override in subclasses!!!")
 
-    def _process(self, process_result, item):
+    def _item_key(self, item):
+        # items with the same key are processed once, None disables it
+        return None
+
+    def _copy_result(self, source_item, item):
+        # copies results of a processed item to the same key ones
+        pass
+
+    def _process(self, entry):
+        now = self._clock.seconds()
+        self._wait_time.add(now - entry.time)
+        entry.time = now
+        entry.running = True
         self._active_count += 1
-        handler_result = maybeDeferred(self._handle_item, item)
-        handler_callbacks_args = (process_result,)
+        handler_result = maybeDeferred(self._handle_item, entry.item)
+        handler_callbacks_args = (entry,)
         handler_result.addCallbacks(
             self._callback,
             errback=self._errback,
@@ -53,28 +251,169 @@ class AsyncLimitedProcessor(object):
             errbackArgs=handler_callbacks_args
         )
 
-    def enqueue(self, item):
-        process_result = Deferred()
-        handler_args = (process_result, item)
-        if self._active_count < self._limit:
-            self._process(*handler_args)
-        else:
-            self._queue.append(handler_args)
+    def enqueue(self, item, priority=PRIORITY_INTERACTIVE, client=None):
+        key = self._item_key(item)
+        entry = self._entries.get(key) if key is not None else None
+        is_new = entry is None
+        if is_new:
+            if (self._active_count >= self._limit and
+                    self._max_queue_length is not None and
+                    self._queue_length >= self._max_queue_length):
+                return fail(QueueFullError(
+                    'Queue is full ({} items)'.format(self._queue_length)))
+            entry = QueueEntry(item, key, self._clock.seconds())
+            if key is not None:
+                self._entries[key] = entry
+        process_result = Deferred(canceller=partial(self._cancel, entry))
+        entry.waiters.append((process_result, item))
+        if is_new:
+            if self._active_count < self._limit:
+                self._process(entry)
+            else:
+                self._push_entry(entry, priority, client)
+        elif not entry.running and priority < entry.priority:
+            self._push_entry(entry, priority, client)
         return process_result
 
 
 # ------------------------------------------------------------------------------
 
+class ExpiringCache(object):
+
+    # LRU cache of values with their own time to live, expired values are
+    # dropped when they are met, least recently used ones when there are too
+    # many values or their total size (len) is too large
+
+    def __init__(self, max_items=None, max_size=None, clock=reactor):
+        self._items = OrderedDict()
+        self._max_items = max_items
+        self._max_size = max_size
+        self._clock = clock
+        self._size = 0
+        self._hits = 0
+        self._misses = 0
+        self._expirations = 0
+        self._evictions = 0
+
+    def __len__(self):
+        return len(self._items)
+
+    def _get_size(self, value):
+        return len(value) if self._max_size is not None else 0
+
+    def _pop(self, key):
+        entry = self._items.pop(key, None)
+        if entry is not None:
+            self._size -= self._get_size(entry[1])
+        return entry
+
+    def get(self, key):
+        entry = self._pop(key)
+        if entry is not None:
+            expires, value = entry
+            if expires > self._clock.seconds():
+                self._items[key] = entry
+                self._size += self._get_size(value)
+                self._hits += 1
+                return value
+            self._expirations += 1
+        self._misses += 1
+        return None
+
+    def put(self, key, value, ttl):
+        self._pop(key)
+        size = self._get_size(value)
+        if ttl <= 0 or (self._max_size is not None and size > self._max_size):
+            return False
+        self._items[key] = (self._clock.seconds() + ttl, value)
+        self._size += size
+        while ((self._max_items is not None and
+                len(self._items) > self._max_items) or
+               (self._max_size is not None and self._size > self._max_size)):
+            _, (_, evicted_value) = self._items.popitem(last=False)
+            self._size -= self._get_size(evicted_value)
+            self._evictions += 1
+        return True
+
+    def get_stats(self):
+        return {
+            'items': len(self._items),
+            'max_items': self._max_items,
+            'size': self._size,
+            'max_size': self._max_size,
+            'hits': self._hits,
+            'misses': self._misses,
+            'expirations': self._expirations,
+            'evictions': self._evictions,
+        }
+
+
+# ------------------------------------------------------------------------------
+
+PTR_CACHE_SIZE = 4096
+PTR_MAX_TTL = 24 * 60 * 60
+# failed lookups are retried sooner than the resolved ones
+PTR_NEGATIVE_TTL = 5 * 60
+PTR_TIMEOUT_TTL = 30
+
+
 class ReverseResolver(AsyncLimitedProcessor):
 
+    def __init__(self, limit, cache=None):
+        AsyncLimitedProcessor.__init__(self, limit)
+        if cache is None:
+            cache = ExpiringCache(PTR_CACHE_SIZE)
+        self._cache = cache
+
+    @property
+    def cache(self):
+        return self._cache
+
+    def _item_key(self, item):
+        return item['ip_addr']
+
+    def _copy_result(self, source_item, item):
+        item['name'] = source_item['name']
+
     def _reverse_name_by_ip_addr(self, ip_addr):
         return '.'.join(reversed(ip_addr.split('.'))) + '.in-addr.arpa'
 
+    def _get_negative_ttl(self, error):
+        if not isinstance(error, DNSNameError):
+            return PTR_TIMEOUT_TTL
+        # the name error message has SOA of the zone in the authority
+        # section, it limits the negative answer TTL (RFC 2308)
+        message = error.args[0] if error.args else None
+        for record in getattr(message, 'authority', ()):
+            if record.type == dns.SOA:
+                return min(record.ttl, record.payload.minimum,
+                           PTR_NEGATIVE_TTL)
+        return PTR_NEGATIVE_TTL
+
+    def enqueue(self, item, priority=PRIORITY_INTERACTIVE, client=None):
+        # cached names and errors don't wait in the queue
+        entry = self._cache.get(item['ip_addr'])
+        if entry is None:
+            return AsyncLimitedProcessor.enqueue(self, item, priority, client)
+        name, error = entry
+        if error is not None:
+            return fail(error)
+        item['name'] = name
+        return succeed(None)
+
     @inlineCallbacks
     def _handle_item(self, item):
-        reversed_name = self._reverse_name_by_ip_addr(item['ip_addr'])
-        resolve_results = yield client.lookupPointer(reversed_name)
-        item['name'] = resolve_results[0][0].payload.name.name
+        ip_addr = item['ip_addr']
+        reversed_name = self._reverse_name_by_ip_addr(ip_addr)
+        try:
+            answers, _, _ = yield client.lookupPointer(reversed_name)
+        except (DNSNameError, TimeoutError) as e:
+            self._cache.put(ip_addr, (None, e), self._get_negative_ttl(e))
+            raise
+        name = answers[0].payload.name.name
+        ttl = min([answer.ttl for answer in answers] + [PTR_MAX_TTL])
+        self._cache.put(ip_addr, (name, None), ttl)
+        item['name'] = name
 
 
 # ------------------------------------------------------------------------------
@@ -103,7 +442,13 @@ class WhoisProcessProtocol(ProcessProtocol):
             self._handler_result.callback(None)
 
 
-class WhoisCaller(AsyncLimitedProcessor):
+class WhoisProcessCaller(AsyncLimitedProcessor):
+
+    def _item_key(self, item):
+        return item['name']
+
+    def _copy_result(self, source_item, item):
+        item['whois'] = source_item['whois']
 
     def _handle_item(self, item):
         handler_result = Deferred()
@@ -119,40 +464,969 @@ class WhoisCaller(AsyncLimitedProcessor):
 
 # ------------------------------------------------------------------------------
 
+WHOIS_PORT = 43
+WHOIS_TIMEOUT = 10
+WHOIS_SERVER_LIMIT = 4
+WHOIS_MAX_REFERRALS = 2
+WHOIS_MAX_RESPONSE_SIZE = 1024 * 1024
+# unknown top level domains are asked there, it refers to their servers
+WHOIS_DEFAULT_SERVER = 'whois.iana.org'
+WHOIS_SERVERS = {
+    'com': 'whois.verisign-grs.com',
+    'net': 'whois.verisign-grs.com',
+    'org': 'whois.pir.org',
+    'info': 'whois.afilias.net',
+    'biz': 'whois.nic.biz',
+    'io': 'whois.nic.io',
+    'me': 'whois.nic.me',
+    'us': 'whois.nic.us',
+    'eu': 'whois.eu',
+    'uk': 'whois.nic.uk',
+    'de': 'whois.denic.de',
+    'fr': 'whois.nic.fr',
+    'nl': 'whois.domain-registry.nl',
+    'ru': 'whois.tcinet.ru',
+    'su': 'whois.tcinet.ru',
+    'ua': 'whois.ua',
+    'by': 'whois.cctld.by',
+    'kz': 'whois.nic.kz',
+    'edu': 'whois.educause.edu',
+    'gov': 'whois.dotgov.gov',
+}
+# servers that need more than a domain name in the query
+WHOIS_QUERY_FORMATS = {
+    'whois.verisign-grs.com': 'domain %s',
+    'whois.denic.de': '-T dn,ace %s',
+}
+WHOIS_REFERRAL_RE = re.compile(
+    r'^[ \t]*(?:refer|whois|registrar whois server|referralserver):'
+    r'[ \t]*(\S+)', re.IGNORECASE | re.MULTILINE)
+
+
+def parse_whois_server(server):
+    if '://' in server:
+        scheme, server = server.split('://', 1)
+        if scheme.lower() != 'whois':
+            # rwhois and web pages are not supported
+            return None
+    host, _, port = server.rstrip('/').partition(':')
+    if not host:
+        return None
+    return host.lower(), int(port) if port.isdigit() else WHOIS_PORT
+
+
+def get_whois_referral(response):
+    for server in WHOIS_REFERRAL_RE.findall(response):
+        address = parse_whois_server(server)
+        if address is not None:
+            return address
+    return None
+
+
+class WhoisProtocol(Protocol):
+
+    # RFC 3912: a query line is sent, the server answers and closes the
+    # connection
+
+    def __init__(self, query, timeout, clock=reactor):
+        self._query = query
+        self._timeout = timeout
+        self._clock = clock
+        self._chunks = []
+        self._size = 0
+        self._timeout_call = None
+        self._error = None
+        self.finished = Deferred()
+
+    def connectionMade(self):
+        self._timeout_call = self._clock.callLater(self._timeout, self._abort,
+                                                   TimeoutError(self._query))
+        self.transport.write(self._query + '\r\n')
+
+    def dataReceived(self, data):
+        self._chunks.append(data)
+        self._size += len(data)
+        if self._size > WHOIS_MAX_RESPONSE_SIZE:
+            self._abort(RuntimeError('Too long WHOIS response'))
+
+    def _abort(self, error):
+        if self._error is None:
+            self._error = error
+            self.transport.abortConnection()
+
+    def connectionLost(self, reason):
+        if self._timeout_call is not None and self._timeout_call.active():
+            self._timeout_call.cancel()
+        if self._error is not None:
+            self.finished.errback(self._error)
+        elif self._chunks or reason.check(ConnectionDone):
+            # some servers reset the connection after the answer
+            self.finished.callback(''.join(self._chunks))
+        else:
+            self.finished.errback(reason)
+
+
+class WhoisServer(AsyncLimitedProcessor):
+
+    # queries to a server, at most limit connections to it at once
+
+    def __init__(self, address, limit, timeout, clock=reactor):
+        AsyncLimitedProcessor.__init__(self, limit, clock=clock)
+        self._host, self._port = address
+        self._timeout = timeout
+
+    def _item_key(self, query):
+        return query
+
+    @inlineCallbacks
+    def _handle_item(self, query):
+        host = self._host
+        if not isIPAddress(host):
+            host = yield client.getHostByName(host)
+        endpoint = TCP4ClientEndpoint(self._clock, host, self._port,
+                                      timeout=self._timeout)
+        protocol = WhoisProtocol(query, self._timeout, self._clock)
+        yield connectProtocol(endpoint, protocol)
+        response = yield protocol.finished
+        returnValue(response)
+
+
+class WhoisClient(object):
+
+    def __init__(self, servers=None, default_server=WHOIS_DEFAULT_SERVER,
+                 server_limit=WHOIS_SERVER_LIMIT, timeout=WHOIS_TIMEOUT,
+                 max_referrals=WHOIS_MAX_REFERRALS, clock=reactor):
+        self._servers = WHOIS_SERVERS if servers is None else servers
+        self._default_server = default_server
+        self._server_limit = server_limit
+        self._timeout = timeout
+        self._max_referrals = max_referrals
+        self._clock = clock
+        self._server_queues = {}
+
+    def _get_server_queue(self, address):
+        server_queue = self._server_queues.get(address)
+        if server_queue is None:
+            server_queue = WhoisServer(address, self._server_limit,
+                                       self._timeout, self._clock)
+            self._server_queues[address] = server_queue
+        return server_queue
+
+    def _get_server_address(self, name):
+        tld = name.rstrip('.').rpartition('.')[2].lower()
+        server = self._servers.get(tld, self._default_server)
+        return parse_whois_server(server)
+
+    @inlineCallbacks
+    def query(self, name):
+        name = name.rstrip('.')
+        address = self._get_server_address(name)
+        visited = set()
+        response = None
+        # a registry may refer to a registrar server with the full record
+        for _ in xrange(self._max_referrals + 1):
+            visited.add(address)
+            query_format = WHOIS_QUERY_FORMATS.get(address[0], '%s')
+            try:
+                response = yield self._get_server_queue(address).enqueue(
+                    query_format % name)
+            except Exception:
+                if response is None:
+                    raise
+                # an answer of the referring server is better than nothing
+                break
+            address = get_whois_referral(response)
+            if address is None or address in visited:
+                break
+        returnValue(response)
+
+
+# ------------------------------------------------------------------------------
+
+# rules of the public suffix list of registries, see the file header
+PUBLIC_SUFFIX_LIST_PATH = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), 'public_suffix_list.dat')
+
+
+def encode_domain_name(name):
+    # rules of internationalized domains are in utf-8, PTR names are in
+    # punycode
+    try:
+        return name.decode('utf-8').encode('idna').lower()
+    except UnicodeError:
+        return None
+
+
+class PublicSuffixList(object):
+
+    # public suffixes (https://publicsuffix.org/list/): plain rules,
+    # wildcard rules (*.kawasaki.jp) kept by their parent suffixes and
+    # exception rules (!city.kawasaki.jp); a top level domain is a public
+    # suffix too, registrable domains are one level below the suffixes
+
+    def __init__(self, lines):
+        self._rules = set()
+        self._wildcards = set()
+        self._exceptions = set()
+        for line in lines:
+            rule = line.strip()
+            if not rule or rule.startswith('//'):
+                continue
+            if rule.startswith('!'):
+                rules, rule = self._exceptions, rule[1:]
+            elif rule.startswith('*.'):
+                rules, rule = self._wildcards, rule[2:]
+            else:
+                rules = self._rules
+            rule = encode_domain_name(rule)
+            if rule:
+                rules.add(rule)
+
+    @classmethod
+    def load(cls, path=PUBLIC_SUFFIX_LIST_PATH):
+        with open(path) as rules_file:
+            return cls(rules_file)
+
+    def get_registrable_domain(self, name):
+        labels = name.rstrip('.').lower().split('.')
+        # the first matching suffix is the longest one
+        for index in xrange(len(labels)):
+            suffix = '.'.join(labels[index:])
+            if suffix in self._exceptions:
+                # the suffix is registrable itself
+                return suffix
+            if (suffix in self._rules or
+                    '.'.join(labels[index + 1:]) in self._wildcards):
+                break
+        else:
+            index = len(labels) - 1
+        return '.'.join(labels[max(index - 1, 0):])
+
+
+# loaded on the first use
+_public_suffix_list = None
+
+
+def get_registrable_domain(name):
+    global _public_suffix_list
+    if _public_suffix_list is None:
+        _public_suffix_list = PublicSuffixList.load()
+    return _public_suffix_list.get_registrable_domain(name)
+
+
+WHOIS_CALLER_LIMIT = 16
+WHOIS_CACHE_SIZE = 16 * 1024 * 1024
+# registration data rarely changes
+WHOIS_CACHE_TTL = 24 * 60 * 60
+
+
+class WhoisCaller(AsyncLimitedProcessor):
+
+    # asks WHOIS servers with the client, the whois utility is the fallback,
+    # answers are cached by registrable domains of names
+
+    def __init__(self, limit, whois_client=None, process_limit=1,
+                 cache=None):
+        AsyncLimitedProcessor.__init__(self, limit)
+        self._whois_client = whois_client
+        self._process_caller = WhoisProcessCaller(process_limit)
+        if cache is None:
+            cache = ExpiringCache(max_size=WHOIS_CACHE_SIZE)
+        self._cache = cache
+
+    @property
+    def cache(self):
+        return self._cache
+
+    def _item_key(self, item):
+        return get_registrable_domain(item['name'])
+
+    def _copy_result(self, source_item, item):
+        item['whois'] = source_item['whois']
+
+    def enqueue(self, item, priority=PRIORITY_INTERACTIVE, client=None):
+        # cached answers don't wait in the queue
+        whois = self._cache.get(self._item_key(item))
+        if whois is None:
+            return AsyncLimitedProcessor.enqueue(self, item, priority, client)
+        item['whois'] = whois
+        return succeed(None)
+
+    @inlineCallbacks
+    def _handle_item(self, item):
+        domain = self._item_key(item)
+        whois = None
+        if self._whois_client is not None:
+            try:
+                whois = yield self._whois_client.query(domain)
+            except Exception as e:
+                log.msg('Name: {}. WHOIS query failed {}, calling whois'.format(
+                    domain, e))
+        if whois is None:
+            domain_item = {'name': domain, 'whois': None}
+            yield self._process_caller.enqueue(domain_item)
+            whois = domain_item['whois']
+        if whois is not None:
+            self._cache.put(domain, whois, WHOIS_CACHE_TTL)
+        item['whois'] = whois
+
+
+# ------------------------------------------------------------------------------
+
+HISTORY_SIZE = 10000
+HISTORY_MAX_SIZE = 64 * 1024 * 1024
+
+
+class HistoryRecord(object):
+
+    # history item, its fields are accessed as dict items too
+
+    __slots__ = ('datetime', 'ip_addr', 'name', 'whois', 'status', 'id',
+                 'version', 'size', 'indexed')
+
+    FIELDS = ('datetime', 'ip_addr', 'name', 'whois', 'status')
+
+    def __init__(self, ip_addr, created=None, name=None, whois=None,
+                 status='pending', id=None, version=None):
+        self.datetime = datetime.now() if created is None else created
+        self.ip_addr = ip_addr
+        self.name = name
+        self.whois = whois
+        self.status = status
+        # number in the history and the history version of the last change
+        self.id = id
+        self.version = version
+        # size accounted by the history, None if the record is not there
+        self.size = None
+        # status and domain the record is indexed by
+        self.indexed = None
+
+    def __getitem__(self, key):
+        if key not in self.FIELDS:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __setitem__(self, key, value):
+        if key not in self.FIELDS:
+            raise KeyError(key)
+        setattr(self, key, value)
+
+    def keys(self):
+        return list(self.FIELDS)
+
+    def copy(self):
+        return HistoryRecord(self.ip_addr, self.datetime, self.name,
+                             self.whois, self.status, self.id, self.version)
+
+    def get_size(self):
+        # approximate memory of the record and its own values
+        size = sys.getsizeof(self) + sys.getsizeof(self.datetime)
+        for value in (self.ip_addr, self.name, self.whois, self.status):
+            if value is not None:
+                size += sys.getsizeof(value)
+        return size
+
+
+HistorySnapshot = namedtuple('HistorySnapshot', ['version', 'items'])
+HistoryPage = namedtuple('HistoryPage', ['version', 'total', 'items'])
+
+
+def get_ip_prefixes(ip_addr):
+    # prefixes of 1 to 4 octets: 10, 10.0, 10.0.0, 10.0.0.1
+    parts = str(ip_addr).split('.')
+    return ['.'.join(parts[:count]) for count in xrange(1, len(parts) + 1)]
+
+
 class ResolveHistory(object):
 
-    def __init__(self):
-        self._history = []
+    # the latest records bounded by their number and size, the oldest ones
+    # are evicted; every change makes a new version of the history
+
+    def __init__(self, max_items=HISTORY_SIZE, max_size=HISTORY_MAX_SIZE):
+        self._history = deque()
+        self._max_items = max_items
+        self._max_size = max_size
+        self._size = 0
+        self._evictions = 0
+        self._successes = 0
+        # error counts by exception type names
+        self._errors = {}
+        self._version = 0
+        self._snapshot = HistorySnapshot(0, ())
+        self._next_id = 0
+        # records by status, IP address prefix and registrable domain of
+        # the name in the history order
+        self._status_index = {}
+        self._ip_index = {}
+        self._domain_index = {}
+        # callables getting changes of the history
+        self._listeners = []
         self._resolver = ReverseResolver(3)
-        self._whois_caller = WhoisCaller(1)
+        self._whois_caller = WhoisCaller(WHOIS_CALLER_LIMIT, WhoisClient())
+
+    @property
+    def version(self):
+        return self._version
+
+    @property
+    def resolver(self):
+        return self._resolver
+
+    @property
+    def whois_caller(self):
+        return self._whois_caller
+
+    def _index(self, index, key, record):
+        records = index.get(key)
+        if records is None:
+            records = index[key] = OrderedDict()
+        records[record.id] = record
+
+    def _unindex(self, index, key, record):
+        records = index.get(key)
+        if records is not None:
+            records.pop(record.id, None)
+            if not records:
+                del index[key]
+
+    def _reindex(self, record):
+        domain = record.name and get_registrable_domain(record.name)
+        old_status, old_domain = record.indexed or (None, None)
+        if record.status != old_status:
+            self._unindex(self._status_index, old_status, record)
+            self._index(self._status_index, record.status, record)
+        if domain != old_domain:
+            if old_domain:
+                self._unindex(self._domain_index, old_domain, record)
+            if domain:
+                self._index(self._domain_index, domain, record)
+        record.indexed = (record.status, domain)
+
+    def _remove(self, record):
+        self._size -= record.size
+        record.size = None
+        for prefix in get_ip_prefixes(record.ip_addr):
+            self._unindex(self._ip_index, prefix, record)
+        status, domain = record.indexed
+        self._unindex(self._status_index, status, record)
+        if domain:
+            self._unindex(self._domain_index, domain, record)
+
+    def add_listener(self, listener):
+        self._listeners.append(listener)
+
+    def remove_listener(self, listener):
+        self._listeners.remove(listener)
+
+    def _notify(self, event, record):
+        # events are 'add' and 'update' of a record or 'clear' without it
+        for listener in self._listeners:
+            listener(event, record)
+
+    def _update(self, record):
+        self._version += 1
+        if record.size is not None:
+            record.version = self._version
+            size = record.get_size()
+            self._size += size - record.size
+            record.size = size
+            self._reindex(record)
+            self._evict()
+            self._notify('update', record)
+
+    def _evict(self):
+        # the latest record stays even if it is too large alone
+        while len(self._history) > 1 and (
+                len(self._history) > self._max_items or
+                self._size > self._max_size):
+            self._remove(self._history.popleft())
+            self._evictions += 1
 
     @inlineCallbacks
-    def _process_item(self, item):
+    def _process_item(self, item, priority, client):
         try:
-            yield self._resolver.enqueue(item)
-            yield self._whois_caller.enqueue(item)
+            yield self._resolver.enqueue(item, priority, client)
+            self._update(item)
+            yield self._whois_caller.enqueue(item, priority, client)
             item['status'] = 'success'
+            self._successes += 1
         except Exception as e:
             item['status'] = 'error'
-            # TODO: use logger
-            print('IP: {}. Got exception {}'.format(item['ip_addr'], e))
-
-    def add(self, ip_addr):
-        item = {
-            'datetime': datetime.now(),
-            'ip_addr': ip_addr,
-            'name': None,
-            'whois': None,
-            'status': 'pending'
-        }
+            error_type = type(e).__name__
+            self._errors[error_type] = self._errors.get(error_type, 0) + 1
+            log.msg('IP: {}. Got exception {}'.format(item['ip_addr'], e))
+        self._update(item)
+        returnValue(item)
+
+    def add(self, ip_addr, priority=PRIORITY_INTERACTIVE, client=None):
+        self._version += 1
+        self._next_id += 1
+        item = HistoryRecord(ip_addr, id=self._next_id, version=self._version)
+        item.size = item.get_size()
         self._history.append(item)
-        self._process_item(item)
+        self._size += item.size
+        for prefix in get_ip_prefixes(ip_addr):
+            self._index(self._ip_index, prefix, item)
+        self._reindex(item)
+        self._evict()
+        self._notify('add', item)
+        return self._process_item(item, priority, client)
+
+    def get_snapshot(self):
+        # processed records don't change, so only pending ones are copied;
+        # the snapshot is built once per version
+        if self._snapshot.version != self._version:
+            items = tuple(item if item.status != 'pending' else item.copy()
+                          for item in self._history)
+            self._snapshot = HistorySnapshot(self._version, items)
+        return self._snapshot
 
     def get_items(self):
-        return deepcopy(self._history)
+        return self.get_snapshot().items
+
+    def find(self, status=None, ip_prefix=None, domain=None, offset=0,
+             limit=None):
+        # a page of records matching all the given filters, the smallest
+        # index is scanned and checked by the others
+        indexes = []
+        if status:
+            indexes.append(self._status_index.get(status, {}))
+        if ip_prefix:
+            indexes.append(self._ip_index.get(ip_prefix.rstrip('.'), {}))
+        if domain:
+            indexes.append(self._domain_index.get(domain.lower(), {}))
+        if not indexes:
+            records, total = self._history, len(self._history)
+        elif len(indexes) == 1:
+            records, total = indexes[0].itervalues(), len(indexes[0])
+        else:
+            indexes.sort(key=len)
+            records = [record for record in indexes[0].itervalues()
+                       if all(record.id in index for index in indexes[1:])]
+            total = len(records)
+        stop = None if limit is None else offset + limit
+        items = tuple(item if item.status != 'pending' else item.copy()
+                      for item in islice(records, offset, stop))
+        return HistoryPage(self._version, total, items)
+
+    def get_stats(self):
+        return {
+            'items': len(self._history),
+            'max_items': self._max_items,
+            'size': self._size,
+            'max_size': self._max_size,
+            'evictions': self._evictions,
+            'version': self._version,
+            'successes': self._successes,
+            'errors': dict(self._errors),
+        }
 
     def clear(self):
-        self._history = []
+        for item in self._history:
+            item.size = None
+        self._history = deque()
+        self._size = 0
+        self._status_index = {}
+        self._ip_index = {}
+        self._domain_index = {}
+        self._version += 1
+        self._notify('clear', None)
+
+
+# ------------------------------------------------------------------------------
+
+# items of a bulk submission being processed at once
+BULK_WINDOW = 64
+MAX_BULK_ITEMS = 65536
+
+
+def parse_ip_range(entry):
+    # an IPv4 address or a network in CIDR notation, host bits of a network
+    # address are ignored
+    ip_addr, slash, prefix = entry.partition('/')
+    parts = ip_addr.split('.')
+    if len(parts) != 4 or not all(part.isdigit() and int(part) < 256
+                                  for part in parts):
+        raise ValueError('Wrong IP address: {}'.format(entry))
+    first = reduce(lambda value, part: value << 8 | int(part), parts, 0)
+    if not slash:
+        return first, 1
+    if not prefix.isdigit() or int(prefix) > 32:
+        raise ValueError('Wrong network prefix: {}'.format(entry))
+    count = 1 << (32 - int(prefix))
+    return first & ~(count - 1), count
+
+
+def iter_ip_addrs(ip_ranges):
+    for first, count in ip_ranges:
+        for value in xrange(first, first + count):
+            yield '.'.join(str(value >> shift & 0xff)
+                           for shift in (24, 16, 8, 0))
+
+
+def get_bulk_entries(request):
+    # a JSON list, an uploaded file or a request body with an entry per line
+    content_type = cgi.parse_header(request.getHeader('content-type') or '')[0]
+    if content_type == 'application/json':
+        entries = json.loads(request.content.read())
+        if not isinstance(entries, list) or not all(
+                isinstance(entry, basestring) for entry in entries):
+            raise ValueError('JSON list of strings is expected')
+        return [entry.strip().encode('ascii', 'replace') for entry in entries]
+    if 'file' in request.args:
+        data = request.args['file'][0]
+    else:
+        data = request.content.read()
+    return data.split()
+
+
+def decode_text(value):
+    # WHOIS servers answer in various encodings, latin-1 keeps any bytes
+    if not isinstance(value, str):
+        return value
+    try:
+        return value.decode('utf-8')
+    except UnicodeDecodeError:
+        return value.decode('latin-1')
+
+
+def get_item_json(item):
+    item = dict((name, decode_text(item[name])) for name in item.keys())
+    item['datetime'] = item['datetime'].isoformat()
+    return json.dumps(item, sort_keys=True)
+
+
+@implementer(IPushProducer)
+class BulkSubmission(object):
+
+    # adds IP addresses to the history keeping at most window of them in
+    # processing, writes processed items to the request as JSON lines;
+    # new items are not added while the request transport is paused
+
+    def __init__(self, request, history, ip_addrs, client=None,
+                 window=BULK_WINDOW):
+        self._request = request
+        self._history = history
+        self._ip_addrs = ip_addrs
+        self._client = client
+        self._window = window
+        self._active_count = 0
+        self._exhausted = False
+        self._paused = False
+        self._stopped = False
+        self._submitting = False
+
+    def start(self):
+        self._request.registerProducer(self, True)
+        self._request.notifyFinish().addErrback(self._disconnected)
+        self._submit()
+
+    def _submit(self):
+        # items processed at once are written in the loop, not in recursion
+        if self._submitting:
+            return
+        self._submitting = True
+        try:
+            while (not self._paused and not self._stopped and
+                   not self._exhausted and
+                   self._active_count < self._window):
+                ip_addr = next(self._ip_addrs, None)
+                if ip_addr is None:
+                    self._exhausted = True
+                    break
+                self._active_count += 1
+                self._history.add(ip_addr, PRIORITY_BULK, self._client
+                                  ).addCallbacks(self._item_done,
+                                                 self._item_failed,
+                                                 errbackArgs=(ip_addr,))
+        finally:
+            self._submitting = False
+        if self._exhausted and not self._active_count and not self._stopped:
+            self._stopped = True
+            self._request.unregisterProducer()
+            self._request.finish()
+
+    def _item_done(self, item):
+        self._active_count -= 1
+        if not self._stopped:
+            self._request.write(get_item_json(item) + '\n')
+            self._submit()
+
+    def _item_failed(self, reason, ip_addr):
+        self._active_count -= 1
+        log.err(reason, 'Bulk item {} failed'.format(ip_addr))
+        if not self._stopped:
+            self._request.write(json.dumps({
+                'ip_addr': ip_addr,
+                'status': 'error',
+                'error': decode_text(reason.getErrorMessage()),
+            }, sort_keys=True) + '\n')
+            self._submit()
+
+    def _disconnected(self, reason):
+        self.stopProducing()
+
+    def pauseProducing(self):
+        self._paused = True
+
+    def resumeProducing(self):
+        self._paused = False
+        self._submit()
+
+    def stopProducing(self):
+        self._stopped = True
+
+
+# ------------------------------------------------------------------------------
+
+EVENTS_HEARTBEAT_INTERVAL = 15
+# recent events for reconnecting clients
+EVENTS_BACKLOG = 1000
+EVENTS_RETRY = 3000
+RESYNC_EVENT = 'event: resync\ndata: {}\n\n'
+
+
+def get_event_data(event, record, version):
+    # a small delta without WHOIS text, it is on the history page
+    if record is None:
+        delta = {}
+    else:
+        delta = {
+            'id': record.id,
+            'version': record.version,
+            'ip_addr': record.ip_addr,
+            'name': decode_text(record.name),
+            'status': record.status,
+        }
+    return 'id: {}\nevent: {}\ndata: {}\n\n'.format(
+        version, event, json.dumps(delta, sort_keys=True))
+
+
+@implementer(IPushProducer)
+class EventSubscriber(object):
+
+    # a client of the event stream; while its transport is paused events are
+    # dropped, then the client is asked to reload the history
+
+    def __init__(self, request):
+        self._request = request
+        self._paused = False
+        self._missed = False
+
+    def send(self, data):
+        if self._paused:
+            self._missed = True
+        else:
+            self._request.write(data)
+
+    def pauseProducing(self):
+        self._paused = True
+
+    def resumeProducing(self):
+        self._paused = False
+        if self._missed:
+            self._missed = False
+            self._request.write(RESYNC_EVENT)
+
+    def stopProducing(self):
+        self._paused = True
+
+
+class EventBroadcaster(object):
+
+    # sends history changes to all subscribers as server-sent events, an
+    # event is formatted once for all of them
+
+    def __init__(self, history, clock=reactor,
+                 heartbeat_interval=EVENTS_HEARTBEAT_INTERVAL):
+        self._history = history
+        self._subscribers = set()
+        self._backlog = deque(maxlen=EVENTS_BACKLOG)
+        self._heartbeat = LoopingCall(self._send, ':\n\n')
+        self._heartbeat.clock = clock
+        self._heartbeat_interval = heartbeat_interval
+        history.add_listener(self._history_changed)
+
+    def __len__(self):
+        return len(self._subscribers)
+
+    def _send(self, data):
+        for subscriber in self._subscribers:
+            subscriber.send(data)
+
+    def _history_changed(self, event, record):
+        version = self._history.version
+        data = get_event_data(event, record, version)
+        self._backlog.append((version, data))
+        self._send(data)
+
+    def _get_missed_events(self, last_version):
+        # None if some of the missed events are not in the backlog
+        if last_version >= self._history.version:
+            return []
+        if not self._backlog or self._backlog[0][0] > last_version + 1:
+            return None
+        return [data for version, data in self._backlog
+                if version > last_version]
+
+    def subscribe(self, subscriber, last_version=None):
+        if last_version is not None:
+            missed_events = self._get_missed_events(last_version)
+            if missed_events is None:
+                subscriber.send(RESYNC_EVENT)
+            else:
+                map(subscriber.send, missed_events)
+        self._subscribers.add(subscriber)
+        if not self._heartbeat.running:
+            self._heartbeat.start(self._heartbeat_interval, now=False)
+
+    def unsubscribe(self, subscriber):
+        self._subscribers.discard(subscriber)
+        if not self._subscribers and self._heartbeat.running:
+            self._heartbeat.stop()
+
+
+# ------------------------------------------------------------------------------
+
+METRICS_PREFIX = 'reverse_resolver_'
+METRICS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def escape_label_value(value):
+    return (str(value).replace('\\', '\\\\').replace('\n', '\\n')
+            .replace('"', '\\"'))
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(name, escape_label_value(value))
+                          for name, value in labels) + '}'
+
+
+def format_value(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+class MetricsWriter(object):
+
+    # Prometheus text exposition format: samples of a metric are grouped
+    # after its HELP and TYPE lines
+
+    def __init__(self):
+        # lines of metrics by their names in the order of adding
+        self._metrics = OrderedDict()
+
+    def _get_lines(self, name, metric_type, help_text):
+        lines = self._metrics.get(name)
+        if lines is None:
+            lines = self._metrics[name] = [
+                '# HELP {}{} {}'.format(METRICS_PREFIX, name, help_text),
+                '# TYPE {}{} {}'.format(METRICS_PREFIX, name, metric_type),
+            ]
+        return lines
+
+    def _format_sample(self, name, labels, value):
+        return '{}{}{} {}'.format(
+            METRICS_PREFIX, name, format_labels(labels), format_value(value))
+
+    def add(self, name, metric_type, help_text, value, labels=()):
+        # metrics without a value, like unlimited sizes, are skipped
+        if value is not None:
+            self._get_lines(name, metric_type, help_text).append(
+                self._format_sample(name, labels, value))
+
+    def add_histogram(self, name, help_text, histogram, labels=()):
+        lines = self._get_lines(name, 'histogram', help_text)
+        labels = tuple(labels)
+        count = 0
+        for bound, bucket_count in zip(histogram.get_bounds(),
+                                       histogram.counts):
+            count += bucket_count
+            lines.append(self._format_sample(
+                name + '_bucket', labels + (('le', repr(bound)),), count))
+        lines.append(self._format_sample(
+            name + '_bucket', labels + (('le', '+Inf'),), histogram.count))
+        lines.append(self._format_sample(name + '_sum', labels,
+                                         histogram.sum))
+        lines.append(self._format_sample(name + '_count', labels,
+                                         histogram.count))
+
+    def get_text(self):
+        return ''.join(line + '\n' for lines in self._metrics.itervalues()
+                       for line in lines)
+
+
+def add_processor_metrics(writer, processor_name, stats):
+    labels = (('processor', processor_name),)
+    writer.add('active', 'gauge', 'Items being processed.',
+               stats['active'], labels)
+    writer.add('active_limit', 'gauge', 'Items processed at once at most.',
+               stats['limit'], labels)
+    writer.add('queue_length', 'gauge', 'Items waiting in the queue.',
+               stats['queued'], labels)
+    writer.add('queue_max_length', 'gauge', 'Queue length limit.',
+               stats['max_queued'], labels)
+    writer.add_histogram('queue_wait_seconds', 'Time items wait in the queue.',
+                         stats['wait_time'], labels)
+    writer.add_histogram('handle_seconds',
+                         'Time of DNS lookups and WHOIS queries.',
+                         stats['handle_time'], labels)
+    writer.add('processed_total', 'counter', 'Processed items by result.',
+               stats['successes'], labels + (('result', 'success'),))
+    for error_type, count in sorted(stats['errors'].items()):
+        writer.add('processed_total', 'counter',
+                   'Processed items by result.', count,
+                   labels + (('result', 'error'), ('error', error_type)))
+
+
+def add_cache_metrics(writer, cache_name, stats):
+    labels = (('cache', cache_name),)
+    writer.add('cache_items', 'gauge', 'Cached values.', stats['items'],
+               labels)
+    writer.add('cache_max_items', 'gauge', 'Cached values limit.',
+               stats['max_items'], labels)
+    # sizes are counted only by size limited caches
+    if stats['max_size'] is not None:
+        writer.add('cache_size_bytes', 'gauge', 'Size of cached values.',
+                   stats['size'], labels)
+    writer.add('cache_max_size_bytes', 'gauge', 'Cache size limit.',
+               stats['max_size'], labels)
+    for name in ('hits', 'misses', 'expirations', 'evictions'):
+        writer.add('cache_{}_total'.format(name), 'counter',
+                   'Cache {}.'.format(name), stats[name], labels)
+
+
+def get_metrics(history):
+    writer = MetricsWriter()
+    for processor_name, processor in (('dns', history.resolver),
+                                      ('whois', history.whois_caller)):
+        add_processor_metrics(writer, processor_name, processor.get_stats())
+    for cache_name, processor in (('ptr', history.resolver),
+                                  ('whois', history.whois_caller)):
+        add_cache_metrics(writer, cache_name, processor.cache.get_stats())
+    stats = history.get_stats()
+    writer.add('history_items', 'gauge', 'Records in the history.',
+               stats['items'])
+    writer.add('history_max_items', 'gauge', 'History records limit.',
+               stats['max_items'])
+    writer.add('history_size_bytes', 'gauge', 'Size of the history records.',
+               stats['size'])
+    writer.add('history_max_size_bytes', 'gauge', 'History size limit.',
+               stats['max_size'])
+    writer.add('history_evictions_total', 'counter',
+               'Records evicted from the history.', stats['evictions'])
+    writer.add('history_version', 'gauge', 'Version of the history.',
+               stats['version'])
+    writer.add('items_total', 'counter', 'Resolved IP addresses by result.',
+               stats['successes'], (('result', 'success'),))
+    for error_type, count in sorted(stats['errors'].items()):
+        writer.add('items_total', 'counter',
+                   'Resolved IP addresses by result.', count,
+                   (('result', 'error'), ('error', error_type)))
+    return writer.get_text()
 
 
 # ------------------------------------------------------------------------------
@@ -181,6 +1455,25 @@ CHECK_IP_FORM = """
 """
 
 
+BULK_FORM = """
+<form method="post" action="/bulk" enctype="multipart/form-data">
+    <label for="file">File with IP addresses or networks to check:</label>
+    <input type="file" name="file"/>
+    <br/>
+    <input type="submit" value="Check All">
+</form>
+"""
+
+
+HISTORY_STATS_TEMPLATE = """
+<p>
+    Records: %(items)s of %(max_items)s,
+    memory: %(size_kb)s of %(max_size_kb)s KB,
+    evicted: %(evictions)s
+</p>
+"""
+
+
 CLEAR_HISTORY_FORM = """
 <form method="post" action="/clear">
     <input type="submit" value="Clear History"/>
@@ -188,6 +1481,27 @@ CLEAR_HISTORY_FORM = """
 """
 
 
+HISTORY_FILTER_FORM = """
+<form method="get" action="/history">
+    <label for="status">Status:</label>
+    <input type="text" name="status" size="8" value="%(status)s"/>
+    <label for="ip">IP prefix:</label>
+    <input type="text" name="ip" size="15" value="%(ip)s"/>
+    <label for="domain">Domain:</label>
+    <input type="text" name="domain" size="20" value="%(domain)s"/>
+    <input type="submit" value="Filter"/>
+</form>
+"""
+
+
+HISTORY_PAGES_TEMPLATE = """
+<p>
+    Page %(page)s of %(pages)s, %(total)s records
+    %(links)s
+</p>
+"""
+
+
 HISTORY_TABLE_TEMPLATE = """
 <table>
     <thead>
@@ -207,16 +1521,32 @@ HISTORY_TABLE_TEMPLATE = """
 
 
 HISTORY_ROW_TEMPLATE = """
-<tr>
+<tr id="item-%(id)s">
     <td>%(datetime)s</td>
     <td>%(ip_addr)s</td>
-    <td>%(status)s</td>
-    <td>%(name)s</td>
+    <td class="status">%(status)s</td>
+    <td class="name">%(name)s</td>
     <td><pre>%(whois)s</pre></td>
 </tr>
 """
 
 
+# updates statuses and names of the shown records
+HISTORY_EVENTS_SCRIPT = """
+<script>
+var events = new EventSource("/events");
+events.addEventListener("update", function (event) {
+    var item = JSON.parse(event.data);
+    var row = document.getElementById("item-" + item.id);
+    if (row) {
+        row.querySelector(".status").textContent = item.status;
+        row.querySelector(".name").textContent = item.name;
+    }
+});
+</script>
+"""
+
+
 # ------------------------------------------------------------------------------
 
 class Root(Resource):
@@ -228,7 +1558,7 @@ class Root(Resource):
 
     def render_GET(self, request):
         context = {
-            'content': CHECK_IP_FORM,
+            'content': CHECK_IP_FORM + BULK_FORM,
             'title': 'Check IP'
         }
         return PAGE_TEMPLATE % context
@@ -239,30 +1569,208 @@ class New(Resource):
     isLeaf = True
 
     def render_POST(self, request):
-        request.site.history.add(request.args['ip_addr'][0])
+        request.site.history.add(request.args['ip_addr'][0],
+                                 client=request.getClientIP())
         return redirectTo('/', request)
 
 
+class Bulk(Resource):
+
+    isLeaf = True
+
+    def __init__(self, window=BULK_WINDOW):
+        Resource.__init__(self)
+        self._window = window
+
+    def render_POST(self, request):
+        try:
+            ip_ranges = map(parse_ip_range, get_bulk_entries(request))
+        except ValueError as e:
+            request.setResponseCode(400)
+            return '{}\n'.format(e)
+        count = sum(count for _, count in ip_ranges)
+        if count > MAX_BULK_ITEMS:
+            request.setResponseCode(400)
+            return 'Too many IP addresses: {}, at most {}\n'.format(
+                count, MAX_BULK_ITEMS)
+        request.setHeader('content-type', 'application/x-ndjson')
+        submission = BulkSubmission(request, request.site.history,
+                                    iter_ip_addrs(ip_ranges),
+                                    request.getClientIP(), self._window)
+        submission.start()
+        return NOT_DONE_YET
+
+
+HISTORY_PAGE_SIZE = 100
+HISTORY_MAX_PAGE_SIZE = 1000
+# rows written at once, then control goes back to the reactor
+HISTORY_CHUNK_ROWS = 50
+HISTORY_ROW_CACHE_SIZE = 16 * 1024 * 1024
+HISTORY_ROW_CACHE_TTL = 60 * 60
+HISTORY_FILTERS = (('status', 'status'), ('ip', 'ip_prefix'),
+                   ('domain', 'domain'))
+# the page is streamed, its content goes between the parts of the template
+CONTENT_MARKER = '\0content\0'
+
+
+def get_history_query(request):
+    args = dict((name, values[0].strip())
+                for name, values in request.args.items())
+    page = int(args.get('page') or 1)
+    per_page = int(args.get('per_page') or HISTORY_PAGE_SIZE)
+    if page < 1 or not 0 < per_page <= HISTORY_MAX_PAGE_SIZE:
+        raise ValueError('Wrong page: {}, {} per page'.format(page, per_page))
+    filters = dict((arg_name, args.get(name, ''))
+                   for name, arg_name in HISTORY_FILTERS)
+    return filters, page, per_page
+
+
+def get_history_url(filters, page, per_page):
+    args = [(name, filters[arg_name]) for name, arg_name in HISTORY_FILTERS
+            if filters[arg_name]]
+    args.append(('page', page))
+    if per_page != HISTORY_PAGE_SIZE:
+        args.append(('per_page', per_page))
+    return '/history?' + urlencode(args)
+
+
 class History(Resource):
 
     isLeaf = True
 
+    def __init__(self, cooperator=None):
+        Resource.__init__(self)
+        self._cooperator = cooperator or Cooperator()
+        # rows are rendered once for each version of a record
+        self._row_cache = ExpiringCache(max_size=HISTORY_ROW_CACHE_SIZE)
+
+    @property
+    def row_cache(self):
+        return self._row_cache
+
+    def _render_row(self, item):
+        key = (item.id, item.version)
+        row = self._row_cache.get(key)
+        if row is None:
+            values = dict((name, cgi.escape(str(item[name])))
+                          for name in item.keys())
+            values['id'] = item.id
+            row = HISTORY_ROW_TEMPLATE % values
+            self._row_cache.put(key, row, HISTORY_ROW_CACHE_TTL)
+        return row
+
+    def _render_pages(self, filters, page, per_page, total):
+        pages = max((total + per_page - 1) // per_page, 1)
+        links = []
+        if page > 1:
+            links.append('<a href="%s">Previous</a>' % cgi.escape(
+                get_history_url(filters, page - 1, per_page), True))
+        if page < pages:
+            links.append('<a href="%s">Next</a>' % cgi.escape(
+                get_history_url(filters, page + 1, per_page), True))
+        return HISTORY_PAGES_TEMPLATE % {
+            'page': page,
+            'pages': pages,
+            'total': total,
+            'links': '\n'.join(links),
+        }
+
+    def _iter_write(self, request, items, tail):
+        for start in xrange(0, len(items), HISTORY_CHUNK_ROWS):
+            rows = map(self._render_row,
+                       items[start:start + HISTORY_CHUNK_ROWS])
+            request.write(''.join(rows))
+            yield
+        request.write(tail)
+        request.finish()
+
+    def _stop(self, reason, task):
+        try:
+            task.stop()
+        except TaskFinished:
+            pass
+
+    def _stopped(self, reason):
+        reason.trap(TaskStopped)
+
     def render_GET(self, request):
-        header = "<h1>History Page</hq>"
-        rows = []
-        for item in request.site.history.get_items():
-            rows.append(HISTORY_ROW_TEMPLATE % item)
-        table = HISTORY_TABLE_TEMPLATE % {'rows': '\n'.join(rows)}
+        try:
+            filters, page, per_page = get_history_query(request)
+        except ValueError as e:
+            request.setResponseCode(400)
+            return '{}\n'.format(e)
+        history = request.site.history
+        # the page depends on the history version and the query only
+        query_hash = hashlib.sha1(repr(sorted(request.args.items())))
+        etag = '"{}-{}"'.format(history.version, query_hash.hexdigest()[:16])
+        if request.setETag(etag) == http.CACHED:
+            return ''
+        result = history.find(offset=(page - 1) * per_page, limit=per_page,
+                              **filters)
+
+        stats = history.get_stats()
+        stats['size_kb'] = stats['size'] // 1024
+        stats['max_size_kb'] = stats['max_size'] // 1024
+        escaped_filters = dict((name, cgi.escape(filters[arg_name], True))
+                               for name, arg_name in HISTORY_FILTERS)
+        pages = self._render_pages(filters, page, per_page, result.total)
         content = '\n'.join([
-            header,
-            table,
-            CLEAR_HISTORY_FORM
+            "<h1>History Page</h1>",
+            HISTORY_STATS_TEMPLATE % stats,
+            HISTORY_FILTER_FORM % escaped_filters,
+            pages,
+            HISTORY_TABLE_TEMPLATE % {'rows': CONTENT_MARKER},
+            pages,
+            CLEAR_HISTORY_FORM,
+            HISTORY_EVENTS_SCRIPT
         ])
         context = {
             'content': content,
             'title': 'History Page'
         }
-        return PAGE_TEMPLATE % context
+        head, tail = (PAGE_TEMPLATE % context).split(CONTENT_MARKER)
+        request.write(head)
+        task = self._cooperator.cooperate(
+            self._iter_write(request, result.items, tail))
+        request.notifyFinish().addErrback(self._stop, task)
+        task.whenDone().addErrback(self._stopped)
+        return NOT_DONE_YET
+
+
+class Events(Resource):
+
+    isLeaf = True
+
+    def __init__(self, broadcaster):
+        Resource.__init__(self)
+        self._broadcaster = broadcaster
+
+    def render_GET(self, request):
+        last_event_id = (request.getHeader('last-event-id') or
+                         request.args.get('last_event_id', [''])[0])
+        try:
+            last_version = int(last_event_id) if last_event_id else None
+        except ValueError:
+            request.setResponseCode(400)
+            return 'Wrong event id: {}\n'.format(last_event_id)
+        request.setHeader('content-type', 'text/event-stream')
+        request.setHeader('cache-control', 'no-cache')
+        request.write('retry: {}\n\n'.format(EVENTS_RETRY))
+        subscriber = EventSubscriber(request)
+        request.registerProducer(subscriber, True)
+        self._broadcaster.subscribe(subscriber, last_version)
+        request.notifyFinish().addBoth(
+            lambda _: self._broadcaster.unsubscribe(subscriber))
+        return NOT_DONE_YET
+
+
+class Metrics(Resource):
+
+    isLeaf = True
+
+    def render_GET(self, request):
+        request.setHeader('content-type', METRICS_CONTENT_TYPE)
+        return get_metrics(request.site.history)
 
 
 class Clear(Resource):
@@ -293,9 +1801,13 @@ class MySite(Site):
 if __name__ == "__main__":
     root = Root()
     root.putChild('new', New())
+    root.putChild('bulk', Bulk())
     root.putChild('history', History())
     root.putChild('clear', Clear())
-    site = MySite(root, ResolveHistory())
+    root.putChild('metrics', Metrics())
+    history = ResolveHistory()
+    root.putChild('events', Events(EventBroadcaster(history)))
+    site = MySite(root, history)
     endpoint = TCP4ServerEndpoint(reactor, 8080)
     endpoint.listen(site)
     reactor.run()
@@ -5,7 +5,9 @@ from twisted.internet.defer import inlineCallbacks
 from twisted.internet import reactor
 
 from main import ReverseResolver
+from main import WHOIS_CALLER_LIMIT
 from main import WhoisCaller
+from main import WhoisClient
 
 
 @inlineCallbacks
@@ -53,7 +55,7 @@ def doit():
 if __name__ == "__main__":
     command = ['whois', 'mail.ru']
     resolver = ReverseResolver(3)
-    whois_caller = WhoisCaller(1)
+    whois_caller = WhoisCaller(WHOIS_CALLER_LIMIT, WhoisClient())
     reactor.callLater(1, doit)
     reactor.callLater(10, reactor.stop)
     reactor.run()
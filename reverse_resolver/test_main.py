@@ -0,0 +1,1244 @@
+import json
+import re
+from datetime import datetime
+from io import BytesIO
+
+from twisted.internet import reactor
+from twisted.internet.defer import CancelledError
+from twisted.internet.defer import Deferred
+from twisted.internet.defer import TimeoutError
+from twisted.internet.defer import fail
+from twisted.internet.defer import gatherResults
+from twisted.internet.defer import inlineCallbacks
+from twisted.internet.defer import succeed
+from twisted.internet.error import ConnectionRefusedError
+from twisted.internet.error import ProcessDone
+from twisted.internet.protocol import Factory
+from twisted.internet.task import Clock
+from twisted.internet.task import Cooperator
+from twisted.names import dns
+from twisted.names.error import DNSNameError
+from twisted.protocols.basic import LineReceiver
+from twisted.python.failure import Failure
+from twisted.trial import unittest
+from twisted.web import http
+from twisted.web.test.requesthelper import DummyRequest
+
+import main
+from main import PRIORITY_BULK
+from main import AsyncLimitedProcessor
+from main import Bulk
+from main import EventBroadcaster
+from main import Events
+from main import ExpiringCache
+from main import History
+from main import LatencyHistogram
+from main import Metrics
+from main import HistoryRecord
+from main import PublicSuffixList
+from main import QueueFullError
+from main import ResolveHistory
+from main import ReverseResolver
+from main import WhoisCaller
+from main import WhoisClient
+from main import get_bulk_entries
+from main import get_registrable_domain
+from main import get_whois_referral
+from main import iter_ip_addrs
+from main import parse_ip_range
+from main import parse_whois_server
+
+
+# ------------------------------------------------------------------------------
+
+class KeyProcessor(AsyncLimitedProcessor):
+
+    def __init__(self, limit, max_queue_length=None, clock=reactor):
+        AsyncLimitedProcessor.__init__(self, limit, max_queue_length, clock)
+        self.handled = []
+
+    def _item_key(self, item):
+        return item.get('key')
+
+    def _copy_result(self, source_item, item):
+        item['result'] = source_item['result']
+
+    def _handle_item(self, item):
+        result = Deferred()
+        self.handled.append((item, result))
+        return result
+
+    def finish(self, index, value):
+        item, result = self.handled[index]
+        item['result'] = value
+        result.callback(None)
+
+
+class AsyncLimitedProcessorTests(unittest.TestCase):
+
+    def setUp(self):
+        self.processor = KeyProcessor(1)
+
+    def test_limit(self):
+        items = [{'key': key} for key in 'abc']
+        results = map(self.processor.enqueue, items)
+        self.assertEqual(len(self.processor.handled), 1)
+        for index, item in enumerate(items):
+            self.processor.finish(index, index)
+            self.successResultOf(results[index])
+            self.assertEqual(item['result'], index)
+        self.assertEqual(len(self.processor.handled), 3)
+
+    def test_same_keys_are_processed_once(self):
+        items = [{'key': key} for key in 'abab']
+        results = map(self.processor.enqueue, items)
+        self.processor.finish(0, 'A')
+        self.assertEqual(len(self.processor.handled), 2)
+        self.processor.finish(1, 'B')
+        self.assertEqual(len(self.processor.handled), 2)
+        map(self.successResultOf, results)
+        self.assertEqual([item['result'] for item in items],
+                         ['A', 'B', 'A', 'B'])
+        # finished keys are processed again
+        self.processor.enqueue({'key': 'a'})
+        self.assertEqual(len(self.processor.handled), 3)
+
+    def test_same_key_error(self):
+        results = [self.processor.enqueue({'key': 'a'}) for _ in xrange(3)]
+        self.processor.handled[0][1].errback(RuntimeError('failed'))
+        for result in results:
+            self.failureResultOf(result, RuntimeError)
+        self.assertEqual(len(self.processor.handled), 1)
+
+    def test_no_key(self):
+        results = [self.processor.enqueue({}) for _ in xrange(2)]
+        self.processor.finish(0, 1)
+        self.assertEqual(len(self.processor.handled), 2)
+        self.successResultOf(results[0])
+        self.assertNoResult(results[1])
+
+    def run_all(self):
+        index = 0
+        while index < len(self.processor.handled):
+            self.processor.finish(index, None)
+            index += 1
+        return [item['key'] for item, _ in self.processor.handled]
+
+    def test_priorities(self):
+        self.processor.enqueue({'key': 'a'})
+        for key in 'bc':
+            self.processor.enqueue({'key': key}, priority=PRIORITY_BULK)
+        for key in 'de':
+            self.processor.enqueue({'key': key})
+        self.assertEqual(self.processor.queue_length, 4)
+        self.assertEqual(self.run_all(), list('adebc'))
+        self.assertEqual(self.processor.queue_length, 0)
+        self.assertEqual(self.processor.active_count, 0)
+
+    def test_priority_of_queued_key_is_raised(self):
+        self.processor.enqueue({'key': 'a'})
+        for key in 'bcd':
+            self.processor.enqueue({'key': key}, priority=PRIORITY_BULK)
+        result = self.processor.enqueue({'key': 'd'})
+        self.processor.enqueue({'key': 'e'})
+        self.assertEqual(self.processor.queue_length, 4)
+        self.assertEqual(self.run_all(), list('adebc'))
+        self.successResultOf(result)
+        self.assertEqual(self.processor.queue_length, 0)
+
+    def test_limit_with_reentrant_enqueue(self):
+        # a waiter enqueueing a new item doesn't exceed the limit
+        result = self.processor.enqueue({'key': 'a'})
+        self.processor.enqueue({'key': 'b'})
+        result.addCallback(
+            lambda _: self.processor.enqueue({'key': 'c'}))
+        self.processor.finish(0, None)
+        self.assertEqual(self.processor.active_count, 1)
+        self.assertEqual(self.processor.queue_length, 1)
+        self.processor.finish(1, None)
+        self.processor.finish(2, None)
+        self.assertEqual([item['key'] for item, _ in self.processor.handled],
+                         list('abc'))
+        self.assertEqual(self.processor.active_count, 0)
+
+    def test_clients_round_robin(self):
+        self.processor.enqueue({'key': 'a0'}, client='a')
+        for index in xrange(1, 4):
+            self.processor.enqueue({'key': 'a%d' % index}, client='a')
+        for index in xrange(2):
+            self.processor.enqueue({'key': 'b%d' % index}, client='b')
+        self.processor.enqueue({'key': 'c0'}, client='c')
+        self.assertEqual(self.run_all(),
+                         ['a0', 'a1', 'b0', 'c0', 'a2', 'b1', 'a3'])
+
+    def test_max_queue_length(self):
+        processor = KeyProcessor(1, max_queue_length=2)
+        results = [processor.enqueue({'key': key}) for key in 'abc']
+        self.failureResultOf(processor.enqueue({'key': 'd'}), QueueFullError)
+        # the same key items don't take place in the queue
+        results.append(processor.enqueue({'key': 'c'}))
+        processor.finish(0, None)
+        results.append(processor.enqueue({'key': 'd'}))
+        self.assertEqual(processor.queue_length, 2)
+        self.assertEqual([result.called for result in results],
+                         [True, False, False, False, False])
+
+    def test_cancel_queued(self):
+        results = [self.processor.enqueue({'key': key}) for key in 'abcb']
+        results[1].cancel()
+        self.failureResultOf(results[1], CancelledError)
+        self.assertEqual(self.processor.queue_length, 2)
+        results[2].cancel()
+        self.failureResultOf(results[2], CancelledError)
+        self.assertEqual(self.processor.queue_length, 1)
+        self.assertEqual(self.run_all(), ['a', 'b'])
+        self.successResultOf(results[3])
+        self.assertEqual(self.processor.queue_length, 0)
+
+    def test_cancel_running(self):
+        results = [self.processor.enqueue({'key': 'a'}) for _ in xrange(2)]
+        results[0].cancel()
+        self.failureResultOf(results[0], CancelledError)
+        self.processor.finish(0, 'A')
+        self.successResultOf(results[1])
+
+    def test_cancelled_key_is_queued_again(self):
+        self.processor.enqueue({'key': 'a'})
+        cancelled = self.processor.enqueue({'key': 'b'})
+        cancelled.cancel()
+        self.failureResultOf(cancelled, CancelledError)
+        result = self.processor.enqueue({'key': 'b'})
+        self.assertEqual(self.run_all(), ['a', 'b'])
+        self.successResultOf(result)
+
+    def test_stats(self):
+        clock = Clock()
+        processor = KeyProcessor(1, clock=clock)
+        processor.enqueue({'key': 'a'})
+        failed = processor.enqueue({'key': 'b'})
+        clock.advance(0.01)
+        processor.finish(0, 'A')
+        clock.advance(1)
+        processor.handled[1][1].errback(TimeoutError())
+        self.failureResultOf(failed, TimeoutError)
+        stats = processor.get_stats()
+        self.assertEqual((stats['active'], stats['queued'], stats['limit']),
+                         (0, 0, 1))
+        self.assertEqual(stats['successes'], 1)
+        self.assertEqual(stats['errors'], {'TimeoutError': 1})
+        self.assertEqual(stats['wait_time'].count, 2)
+        self.assertAlmostEqual(stats['wait_time'].sum, 0.01)
+        self.assertAlmostEqual(stats['handle_time'].sum, 1.01)
+
+    def test_latency_histogram(self):
+        histogram = LatencyHistogram()
+        for value in (0, 0.0005, 0.0006, 0.001, 0.003, 1000):
+            histogram.add(value)
+        bounds = histogram.get_bounds()
+        self.assertEqual(bounds[:3], [0.0005, 0.001, 0.002])
+        self.assertEqual(len(histogram.counts), len(bounds) + 1)
+        self.assertEqual(histogram.counts[:4], [2, 2, 0, 1])
+        self.assertEqual(histogram.counts[-1], 1)
+        self.assertEqual(histogram.count, 6)
+
+
+# ------------------------------------------------------------------------------
+
+class ExpiringCacheTests(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.cache = ExpiringCache(2, clock=self.clock)
+
+    def test_get_and_put(self):
+        self.assertEqual(self.cache.get('a'), None)
+        self.assertTrue(self.cache.put('a', 1, 10))
+        self.assertEqual(self.cache.get('a'), 1)
+        stats = self.cache.get_stats()
+        self.assertEqual((stats['hits'], stats['misses']), (1, 1))
+
+    def test_expiration(self):
+        self.cache.put('a', 1, 10)
+        self.clock.advance(9)
+        self.assertEqual(self.cache.get('a'), 1)
+        self.clock.advance(1)
+        self.assertEqual(self.cache.get('a'), None)
+        self.assertEqual(len(self.cache), 0)
+        self.assertEqual(self.cache.get_stats()['expirations'], 1)
+        self.assertFalse(self.cache.put('a', 1, 0))
+        self.assertEqual(self.cache.get('a'), None)
+
+    def test_least_recently_used_are_evicted(self):
+        self.cache.put('a', 1, 10)
+        self.cache.put('b', 2, 10)
+        self.cache.get('a')
+        self.cache.put('c', 3, 10)
+        self.assertEqual(self.cache.get('b'), None)
+        self.assertEqual(self.cache.get('a'), 1)
+        self.assertEqual(self.cache.get('c'), 3)
+        self.assertEqual(self.cache.get_stats()['evictions'], 1)
+
+    def test_size_bound(self):
+        cache = ExpiringCache(max_size=10, clock=self.clock)
+        cache.put('a', 'x' * 4, 10)
+        cache.put('b', 'x' * 4, 10)
+        cache.get('a')
+        self.assertTrue(cache.put('c', 'x' * 4, 10))
+        self.assertEqual(cache.get('b'), None)
+        self.assertFalse(cache.put('d', 'x' * 11, 10))
+        cache.put('a', 'x' * 2, 10)
+        stats = cache.get_stats()
+        self.assertEqual((stats['items'], stats['size']), (2, 6))
+        self.clock.advance(10)
+        cache.get('a')
+        self.assertEqual(cache.get_stats()['size'], 4)
+
+
+# ------------------------------------------------------------------------------
+
+def make_answers(name, ttl):
+    record = dns.Record_PTR(name, ttl=ttl)
+    return [dns.RRHeader('1.0.0.127.in-addr.arpa', dns.PTR, ttl=ttl,
+                         payload=record)]
+
+
+def make_name_error(soa_ttl=None, soa_minimum=None):
+    message = dns.Message(rCode=dns.ENAME)
+    if soa_ttl is not None:
+        record = dns.Record_SOA(minimum=soa_minimum, ttl=soa_ttl)
+        message.authority.append(
+            dns.RRHeader('in-addr.arpa', dns.SOA, ttl=soa_ttl,
+                         payload=record))
+    return DNSNameError(message)
+
+
+class ReverseResolverTests(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.resolver = ReverseResolver(
+            1, ExpiringCache(10, clock=self.clock))
+        self.lookups = []
+        self.patch(main.client, 'lookupPointer', self.lookup_pointer)
+
+    def lookup_pointer(self, name):
+        result = Deferred()
+        self.lookups.append((name, result))
+        return result
+
+    def resolve(self, ip_addr='127.0.0.1'):
+        item = {'ip_addr': ip_addr, 'name': None}
+        result = self.resolver.enqueue(item)
+        return item, result
+
+    def test_cached_name(self):
+        item, result = self.resolve()
+        self.assertEqual(self.lookups[0][0], '1.0.0.127.in-addr.arpa')
+        self.lookups[0][1].callback((make_answers('localhost', 60), [], []))
+        self.successResultOf(result)
+        self.assertEqual(item['name'], 'localhost')
+
+        item, result = self.resolve()
+        self.successResultOf(result)
+        self.assertEqual(item['name'], 'localhost')
+        self.assertEqual(len(self.lookups), 1)
+        stats = self.resolver.cache.get_stats()
+        self.assertEqual((stats['hits'], stats['misses']), (1, 1))
+
+    def test_record_ttl(self):
+        self.resolve()
+        self.lookups[0][1].callback((make_answers('localhost', 60), [], []))
+        self.clock.advance(60)
+        item, result = self.resolve()
+        self.assertNoResult(result)
+        self.assertEqual(len(self.lookups), 2)
+
+    def test_cached_name_error(self):
+        _, result = self.resolve()
+        self.lookups[0][1].errback(make_name_error(3600, 120))
+        self.failureResultOf(result, DNSNameError)
+        self.clock.advance(119)
+        _, result = self.resolve()
+        self.failureResultOf(result, DNSNameError)
+        self.assertEqual(len(self.lookups), 1)
+        self.clock.advance(1)
+        _, result = self.resolve()
+        self.assertEqual(len(self.lookups), 2)
+
+    def test_name_error_without_soa(self):
+        _, result = self.resolve()
+        self.lookups[0][1].errback(make_name_error())
+        self.failureResultOf(result, DNSNameError)
+        self.clock.advance(main.PTR_NEGATIVE_TTL - 1)
+        self.failureResultOf(self.resolve()[1], DNSNameError)
+        self.clock.advance(1)
+        self.assertNoResult(self.resolve()[1])
+
+    def test_cached_timeout(self):
+        _, result = self.resolve()
+        self.lookups[0][1].errback(TimeoutError())
+        self.failureResultOf(result, TimeoutError)
+        self.failureResultOf(self.resolve()[1], TimeoutError)
+        self.clock.advance(main.PTR_TIMEOUT_TTL)
+        self.assertNoResult(self.resolve()[1])
+
+    def test_same_ip_addrs_are_resolved_once(self):
+        pending = [self.resolve() for _ in xrange(10)]
+        self.assertEqual(len(self.lookups), 1)
+        self.lookups[0][1].callback((make_answers('localhost', 60), [], []))
+        for item, result in pending:
+            self.successResultOf(result)
+            self.assertEqual(item['name'], 'localhost')
+
+    def test_other_errors_are_not_cached(self):
+        _, result = self.resolve(123)
+        self.failureResultOf(result, AttributeError)
+        _, result = self.resolve('127.0.0.1')
+        self.lookups[0][1].errback(RuntimeError())
+        self.failureResultOf(result, RuntimeError)
+        self.assertEqual(len(self.resolver.cache), 0)
+
+
+# ------------------------------------------------------------------------------
+
+class FakeWhoisProtocol(LineReceiver):
+
+    def connectionMade(self):
+        self.factory.connections.append(self)
+        self.factory.max_connections = max(self.factory.max_connections,
+                                           len(self.factory.connections))
+
+    def connectionLost(self, reason):
+        self.factory.connections.remove(self)
+
+    def lineReceived(self, line):
+        self.factory.queries.append(line)
+        if not self.factory.paused:
+            self.answer(line)
+        else:
+            self.factory.pending.append((self, line))
+
+    def answer(self, line):
+        self.transport.write(self.factory.responses.get(line, 'No match\n'))
+        self.transport.loseConnection()
+
+
+class FakeWhoisFactory(Factory):
+
+    protocol = FakeWhoisProtocol
+
+    def __init__(self, responses, paused=False):
+        self.responses = responses
+        self.paused = paused
+        self.queries = []
+        self.pending = []
+        self.connections = []
+        self.max_connections = 0
+
+    def answer_pending(self):
+        pending, self.pending = self.pending, []
+        for protocol, line in pending:
+            protocol.answer(line)
+
+
+class WhoisClientTests(unittest.TestCase):
+
+    def listen(self, responses, paused=False):
+        factory = FakeWhoisFactory(responses, paused)
+        port = reactor.listenTCP(0, factory, interface='127.0.0.1')
+        self.addCleanup(port.stopListening)
+        factory.address = '127.0.0.1:%d' % port.getHost().port
+        return factory
+
+    def test_parse_whois_server(self):
+        self.assertEqual(parse_whois_server('whois.nic.ru'),
+                         ('whois.nic.ru', 43))
+        self.assertEqual(parse_whois_server('whois://Whois.Nic.Ru:4343/'),
+                         ('whois.nic.ru', 4343))
+        self.assertEqual(parse_whois_server('rwhois://rwhois.nic.ru:4321'),
+                         None)
+
+    def test_get_whois_referral(self):
+        response = ('Domain Name: EXAMPLE.COM\r\n'
+                    '   Registrar WHOIS Server: whois.example.net\r\n')
+        self.assertEqual(get_whois_referral(response),
+                         ('whois.example.net', 43))
+        response = '% IANA WHOIS server\nrefer:        whois.nic.xyz\n'
+        self.assertEqual(get_whois_referral(response), ('whois.nic.xyz', 43))
+        self.assertEqual(get_whois_referral('Domain Name: EXAMPLE.COM\n'),
+                         None)
+
+    @inlineCallbacks
+    def test_query(self):
+        server = self.listen({'example.test': 'Domain: example.test\n'})
+        whois_client = WhoisClient({'test': server.address}, timeout=5)
+        response = yield whois_client.query('example.test.')
+        self.assertEqual(response, 'Domain: example.test\n')
+        response = yield whois_client.query('unknown.test')
+        self.assertEqual(response, 'No match\n')
+        self.assertEqual(server.queries, ['example.test', 'unknown.test'])
+
+    @inlineCallbacks
+    def test_unknown_tld(self):
+        server = self.listen({})
+        whois_client = WhoisClient({}, default_server=server.address,
+                                   timeout=5)
+        response = yield whois_client.query('example.test')
+        self.assertEqual(response, 'No match\n')
+
+    @inlineCallbacks
+    def test_referrals(self):
+        registrar = self.listen({'example.test': 'Registrant: Somebody\n'})
+        registry = self.listen({
+            'example.test': 'Registrar WHOIS Server: %s\n' % registrar.address,
+        })
+        whois_client = WhoisClient({'test': registry.address}, timeout=5)
+        response = yield whois_client.query('example.test')
+        self.assertEqual(response, 'Registrant: Somebody\n')
+
+    @inlineCallbacks
+    def test_referral_loop(self):
+        server = self.listen({})
+        server.responses['example.test'] = 'refer: %s\n' % server.address
+        whois_client = WhoisClient({'test': server.address}, timeout=5)
+        response = yield whois_client.query('example.test')
+        self.assertEqual(response, 'refer: %s\n' % server.address)
+        self.assertEqual(len(server.queries), 1)
+
+    @inlineCallbacks
+    def test_broken_referral(self):
+        registry = self.listen({'example.test': 'refer: 127.0.0.1:1\n'})
+        whois_client = WhoisClient({'test': registry.address}, timeout=5)
+        response = yield whois_client.query('example.test')
+        self.assertEqual(response, 'refer: 127.0.0.1:1\n')
+
+    def test_connection_refused(self):
+        whois_client = WhoisClient({'test': '127.0.0.1:1'}, timeout=5)
+        return self.assertFailure(whois_client.query('example.test'),
+                                  ConnectionRefusedError)
+
+    def test_timeout(self):
+        server = self.listen({}, paused=True)
+        whois_client = WhoisClient({'test': server.address}, timeout=0.1)
+        return self.assertFailure(whois_client.query('example.test'),
+                                  TimeoutError)
+
+    @inlineCallbacks
+    def test_server_limit(self):
+        server = self.listen({}, paused=True)
+        whois_client = WhoisClient({'test': server.address}, server_limit=2,
+                                   timeout=5)
+        results = [whois_client.query('example%d.test' % index)
+                   for index in (0, 1, 2, 3, 4, 0)]
+        for count in (2, 2, 1):
+            yield self.wait_pending(server, count)
+            server.answer_pending()
+        responses = yield gatherResults(results)
+        self.assertEqual(responses, ['No match\n'] * 6)
+        self.assertEqual(server.max_connections, 2)
+        self.assertEqual(len(server.queries), 5)
+
+    def wait_pending(self, server, count):
+        # the client connects asynchronously, so the fake server is polled
+        waiting = Deferred()
+
+        def check():
+            if len(server.pending) >= count:
+                waiting.callback(None)
+            else:
+                reactor.callLater(0.01, check)
+
+        check()
+        return waiting
+
+
+# ------------------------------------------------------------------------------
+
+class WhoisCallerTests(unittest.TestCase):
+
+    def setUp(self):
+        self.processes = []
+        self.patch(main.reactor, 'spawnProcess', self.spawn_process)
+
+    def spawn_process(self, protocol, executable, args):
+        self.processes.append((protocol, args))
+
+    def test_same_names_are_called_once(self):
+        caller = WhoisCaller(1)
+        items = [{'name': name, 'whois': None}
+                 for name in ('localhost', 'example.com') * 5]
+        results = map(caller.enqueue, items)
+        self.assertEqual(len(self.processes), 1)
+        for protocol, args in self.processes:
+            protocol.outReceived('whois ' + args[1])
+            protocol.processEnded(Failure(ProcessDone(0)))
+        self.assertEqual(len(self.processes), 2)
+        map(self.successResultOf, results)
+        for item in items:
+            self.assertEqual(item['whois'], 'whois ' + item['name'])
+
+    def test_registrable_domain(self):
+        self.assertEqual(get_registrable_domain('mx1.mail.RU.'), 'mail.ru')
+        self.assertEqual(get_registrable_domain('a.b.example.co.uk'),
+                         'example.co.uk')
+        # hosting companies domains are asked, not their subdomains
+        self.assertEqual(get_registrable_domain('ec2-1-2-3-4.compute-1.'
+                                                'amazonaws.com'),
+                         'amazonaws.com')
+        self.assertEqual(get_registrable_domain('ec2-54-1-2-3.eu-west-1.'
+                                                'compute.amazonaws.com'),
+                         'amazonaws.com')
+        self.assertEqual(get_registrable_domain('a.r.cloudfront.net'),
+                         'cloudfront.net')
+        self.assertEqual(get_registrable_domain('example.com'), 'example.com')
+        self.assertEqual(get_registrable_domain('co.uk'), 'co.uk')
+        self.assertEqual(get_registrable_domain('localhost'), 'localhost')
+
+    def test_registrable_domain_under_registry_suffixes(self):
+        for name, domain in [
+                ('p1234.tokyo.ocn.ad.jp', 'ocn.ad.jp'),
+                ('host.example.com.pl', 'example.com.pl'),
+                ('x.vnpt.com.vn', 'vnpt.com.vn'),
+                ('a.b.telkom.net.id', 'telkom.net.id'),
+                ('mail.example.gr.jp', 'example.gr.jp'),
+                ('www.phys.msu.ac.ru', 'msu.ac.ru'),
+                ('ns1.example.co.th', 'example.co.th'),
+                ('a.b.example.xn--p1ai', 'example.xn--p1ai')]:
+            self.assertEqual(get_registrable_domain(name), domain)
+
+    def test_public_suffix_list_rules(self):
+        suffixes = PublicSuffixList([
+            '// comment', '', 'jp', 'kawasaki.jp', '*.kawasaki.jp',
+            '!city.kawasaki.jp', '\xd1\x80\xd1\x84'])
+        self.assertEqual(
+            suffixes.get_registrable_domain('a.b.foo.kawasaki.jp'),
+            'b.foo.kawasaki.jp')
+        self.assertEqual(suffixes.get_registrable_domain('a.city.kawasaki.jp'),
+                         'city.kawasaki.jp')
+        self.assertEqual(suffixes.get_registrable_domain('a.b.xn--p1ai'),
+                         'b.xn--p1ai')
+        # unknown top level domains are public suffixes too
+        self.assertEqual(suffixes.get_registrable_domain('a.b.example.org'),
+                         'example.org')
+
+    def test_cached_by_registrable_domain(self):
+        whois_client = WhoisClient()
+        queries = []
+
+        def query(name):
+            queries.append(name)
+            return succeed('whois ' + name)
+
+        self.patch(whois_client, 'query', query)
+        caller = WhoisCaller(1, whois_client)
+        items = [{'name': 'host%d.mail.ru' % index, 'whois': None}
+                 for index in xrange(1000)]
+        map(self.successResultOf, map(caller.enqueue, items))
+        self.assertEqual(queries, ['mail.ru'])
+        self.assertEqual(set(item['whois'] for item in items),
+                         set(['whois mail.ru']))
+        stats = caller.cache.get_stats()
+        self.assertEqual((stats['hits'], stats['misses']), (999, 1))
+        self.assertEqual(stats['size'], len('whois mail.ru'))
+
+    def test_whois_client(self):
+        whois_client = WhoisClient()
+        self.patch(whois_client, 'query', lambda name: succeed('whois ' + name))
+        caller = WhoisCaller(1, whois_client)
+        item = {'name': 'localhost', 'whois': None}
+        self.successResultOf(caller.enqueue(item))
+        self.assertEqual(item['whois'], 'whois localhost')
+        self.assertEqual(self.processes, [])
+
+    def test_process_fallback(self):
+        whois_client = WhoisClient()
+        self.patch(whois_client, 'query',
+                   lambda name: fail(ConnectionRefusedError()))
+        caller = WhoisCaller(1, whois_client)
+        item = {'name': 'localhost', 'whois': None}
+        result = caller.enqueue(item)
+        protocol, args = self.processes[0]
+        self.assertEqual(args, ['whois', 'localhost'])
+        protocol.outReceived('whois localhost')
+        protocol.processEnded(Failure(ProcessDone(0)))
+        self.successResultOf(result)
+        self.assertEqual(item['whois'], 'whois localhost')
+        self.successResultOf(caller.enqueue({'name': 'localhost'}))
+        self.assertEqual(len(self.processes), 1)
+
+
+# ------------------------------------------------------------------------------
+
+class FakeProcessor(object):
+
+    def __init__(self, field):
+        self.field = field
+        self.enqueued = []
+
+    def enqueue(self, item, priority, client):
+        result = Deferred()
+        self.enqueued.append((item, result))
+        return result
+
+    def finish(self, index, value):
+        item, result = self.enqueued[index]
+        item[self.field] = value
+        result.callback(None)
+
+
+class ResolveHistoryTests(unittest.TestCase):
+
+    def make_history(self, *args, **kwargs):
+        history = ResolveHistory(*args, **kwargs)
+        self.resolver = history._resolver = FakeProcessor('name')
+        self.whois_caller = history._whois_caller = FakeProcessor('whois')
+        return history
+
+    def process(self, history, ip_addr, whois='whois'):
+        result = history.add(ip_addr)
+        self.resolver.finish(-1, 'host')
+        self.whois_caller.finish(-1, whois)
+        return self.successResultOf(result)
+
+    def test_record(self):
+        record = HistoryRecord('10.0.0.1', datetime(2017, 1, 1))
+        record['name'] = 'host'
+        self.assertEqual(record.name, 'host')
+        self.assertEqual('%(ip_addr)s %(name)s %(status)s' % record,
+                         '10.0.0.1 host pending')
+        self.assertEqual(dict(record)['datetime'], datetime(2017, 1, 1))
+        self.assertRaises(KeyError, record.__getitem__, 'size')
+        self.assertRaises(KeyError, record.__setitem__, 'other', 1)
+        self.assertFalse(hasattr(record, '__dict__'))
+
+    def test_processing(self):
+        history = self.make_history()
+        result = history.add('10.0.0.1')
+        item = history.get_items()[0]
+        self.assertEqual((item['ip_addr'], item['status']),
+                         ('10.0.0.1', 'pending'))
+        self.resolver.finish(0, 'host')
+        self.assertEqual(history.get_items()[0]['name'], 'host')
+        self.whois_caller.finish(0, 'whois')
+        self.assertEqual(self.successResultOf(result)['status'], 'success')
+        self.assertEqual(history.get_items()[0]['status'], 'success')
+
+    def test_error(self):
+        history = self.make_history()
+        result = history.add('10.0.0.1')
+        self.resolver.enqueued[0][1].errback(RuntimeError('failed'))
+        self.assertEqual(self.successResultOf(result)['status'], 'error')
+        self.assertEqual(self.whois_caller.enqueued, [])
+
+    def test_snapshots(self):
+        history = self.make_history()
+        self.process(history, '10.0.0.1')
+        history.add('10.0.0.2')
+        snapshot = history.get_snapshot()
+        self.assertIs(history.get_snapshot(), snapshot)
+        self.resolver.finish(1, 'host2')
+        self.assertEqual(snapshot.items[1]['name'], None)
+        new_snapshot = history.get_snapshot()
+        self.assertTrue(new_snapshot.version > snapshot.version)
+        self.assertEqual(new_snapshot.items[1]['name'], 'host2')
+        # processed records are shared, not copied
+        self.assertIs(new_snapshot.items[0], snapshot.items[0])
+
+    def test_max_items(self):
+        history = self.make_history(max_items=3)
+        for index in xrange(5):
+            self.process(history, '10.0.0.%d' % index)
+        self.assertEqual([item['ip_addr'] for item in history.get_items()],
+                         ['10.0.0.2', '10.0.0.3', '10.0.0.4'])
+        stats = history.get_stats()
+        self.assertEqual((stats['items'], stats['evictions']), (3, 2))
+
+    def test_max_size(self):
+        history = self.make_history(max_size=9000)
+        self.process(history, '10.0.0.1', 'x' * 3000)
+        self.process(history, '10.0.0.2', 'x' * 3000)
+        size = history.get_stats()['size']
+        self.assertTrue(6000 < size < 9000)
+        self.process(history, '10.0.0.3', 'x' * 3000)
+        self.assertEqual([item['ip_addr'] for item in history.get_items()],
+                         ['10.0.0.2', '10.0.0.3'])
+        self.assertEqual(history.get_stats()['size'], size)
+        # the latest record stays
+        self.process(history, '10.0.0.4', 'x' * 20000)
+        self.assertEqual([item['ip_addr'] for item in history.get_items()],
+                         ['10.0.0.4'])
+
+    def test_find(self):
+        history = self.make_history(max_items=5)
+        names = ['a.mail.ru', 'b.mail.ru', 'host.example.com', 'c.mail.ru',
+                 'd.mail.ru', 'e.mail.ru']
+        for index, name in enumerate(names):
+            history.add('10.0.%d.%d' % (index % 2, index))
+            self.resolver.finish(index, name)
+        for index in (1, 2, 3):
+            self.whois_caller.finish(index, 'whois')
+
+        def find(**kwargs):
+            page = history.find(**kwargs)
+            return page.total, [item['name'] for item in page.items]
+
+        self.assertEqual(find(), (5, names[1:]))
+        self.assertEqual(find(domain='MAIL.RU'),
+                         (4, ['b.mail.ru', 'c.mail.ru', 'd.mail.ru',
+                              'e.mail.ru']))
+        self.assertEqual(find(domain='mail.ru', status='pending'),
+                         (2, ['d.mail.ru', 'e.mail.ru']))
+        self.assertEqual(find(ip_prefix='10.0.1.'),
+                         (3, ['b.mail.ru', 'c.mail.ru', 'e.mail.ru']))
+        self.assertEqual(find(ip_prefix='10.0.1', status='success',
+                              domain='mail.ru'),
+                         (2, ['b.mail.ru', 'c.mail.ru']))
+        self.assertEqual(find(ip_prefix='10.0.1.5'), (1, ['e.mail.ru']))
+        self.assertEqual(find(ip_prefix='10.0.1.1'), (1, ['b.mail.ru']))
+        self.assertEqual(find(status='unknown'), (0, []))
+        self.assertEqual(find(offset=1, limit=2),
+                         (5, ['host.example.com', 'c.mail.ru']))
+        self.assertEqual(find(domain='mail.ru', offset=3, limit=2),
+                         (4, ['e.mail.ru']))
+        # evicted records are not found
+        self.assertEqual(find(ip_prefix='10.0.0.0'), (0, []))
+        history.clear()
+        self.assertEqual(find(domain='mail.ru'), (0, []))
+
+    def test_clear(self):
+        history = self.make_history()
+        self.process(history, '10.0.0.1')
+        result = history.add('10.0.0.2')
+        history.clear()
+        self.assertEqual(history.get_items(), ())
+        self.resolver.finish(1, 'host')
+        self.whois_caller.finish(1, 'x' * 1000)
+        self.successResultOf(result)
+        self.assertEqual(history.get_stats()['size'], 0)
+
+
+class HistoryRequest(DummyRequest):
+
+    def setETag(self, etag):
+        self.responseHeaders.setRawHeaders('etag', [etag])
+        if self.getHeader('if-none-match') == etag:
+            self.setResponseCode(http.NOT_MODIFIED)
+            return http.CACHED
+        return None
+
+
+class HistoryPageTests(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        cooperator = Cooperator(
+            terminationPredicateFactory=lambda: lambda: True,
+            scheduler=lambda step: self.clock.callLater(1, step))
+        self.resource = History(cooperator)
+        self.history = ResolveHistory()
+        self.resolver = self.history._resolver = FakeProcessor('name')
+        self.whois_caller = self.history._whois_caller = FakeProcessor('whois')
+        for index in xrange(120):
+            self.history.add('10.0.0.%d' % index)
+            self.resolver.finish(index, 'host%d.example.com' % index)
+            self.whois_caller.finish(index, '<whois %d>' % index)
+
+    def get(self, etag=None, **args):
+        request = HistoryRequest(['history'])
+        request.site = self
+        for name, value in args.items():
+            request.addArg(name, str(value))
+        if etag is not None:
+            request.requestHeaders.setRawHeaders('if-none-match', [etag])
+        request.render(self.resource)
+        while self.clock.getDelayedCalls():
+            self.clock.advance(1)
+        return request
+
+    def get_ip_addrs(self, request):
+        return re.findall(r'<td>(10\.0\.0\.\d+)</td>', ''.join(request.written))
+
+    def test_pages(self):
+        request = self.get()
+        self.assertEqual(request.finished, 1)
+        self.assertEqual(self.get_ip_addrs(request),
+                         ['10.0.0.%d' % index for index in xrange(100)])
+        body = ''.join(request.written)
+        self.assertIn('Page 1 of 2, 120 records', body)
+        self.assertIn('href="/history?page=2"', body)
+        self.assertIn('&lt;whois 1&gt;', body)
+        # rows are written by chunks
+        self.assertTrue(len(request.written) > 3)
+        request = self.get(page=2, per_page=50)
+        self.assertEqual(self.get_ip_addrs(request),
+                         ['10.0.0.%d' % index for index in xrange(50, 100)])
+
+    def test_filters(self):
+        request = self.get(ip='10.0.0.11', domain='example.com')
+        self.assertEqual(self.get_ip_addrs(request), ['10.0.0.11'])
+        self.assertIn('value="10.0.0.11"', ''.join(request.written))
+        request = self.get(status='pending')
+        self.assertEqual(self.get_ip_addrs(request), [])
+
+    def test_bad_query(self):
+        for args in ({'page': 'x'}, {'page': 0}, {'per_page': 100000}):
+            request = self.get(**args)
+            self.assertEqual(request.responseCode, 400)
+
+    def test_not_modified(self):
+        request = self.get()
+        etag = request.responseHeaders.getRawHeaders('etag')[0]
+        request = self.get(etag)
+        self.assertEqual(request.responseCode, http.NOT_MODIFIED)
+        self.assertEqual(''.join(request.written), '')
+        request = self.get(etag, page=2)
+        self.assertEqual(request.responseCode, None)
+        self.history.add('10.0.0.200')
+        request = self.get(etag)
+        self.assertEqual(request.responseCode, None)
+
+    def test_row_cache(self):
+        self.get()
+        stats = self.resource.row_cache.get_stats()
+        self.assertEqual((stats['hits'], stats['misses']), (0, 100))
+        self.history.add('10.0.0.200')
+        self.get(per_page=1000)
+        stats = self.resource.row_cache.get_stats()
+        self.assertEqual((stats['hits'], stats['misses']), (100, 121))
+
+    def test_disconnect(self):
+        request = HistoryRequest(['history'])
+        request.site = self
+        request.render(self.resource)
+        self.clock.advance(1)
+        request.processingFailed(Failure(RuntimeError()))
+        while self.clock.getDelayedCalls():
+            self.clock.advance(1)
+        self.assertEqual(request.finished, 0)
+
+
+# ------------------------------------------------------------------------------
+
+class FakeHistory(object):
+
+    def __init__(self):
+        self.added = []
+
+    def add(self, ip_addr, priority, client):
+        item = {'datetime': datetime(2017, 1, 1), 'ip_addr': ip_addr,
+                'name': None, 'whois': None, 'status': 'success'}
+        result = Deferred()
+        self.added.append((item, result, priority, client))
+        return result
+
+    def finish(self, index):
+        item, result, _, _ = self.added[index]
+        result.callback(item)
+
+
+class BulkRequest(DummyRequest):
+
+    method = 'POST'
+
+    def registerProducer(self, producer, streaming):
+        self.producer = producer
+
+    def unregisterProducer(self):
+        self.producer = None
+
+
+class BulkTests(unittest.TestCase):
+
+    def setUp(self):
+        self.history = FakeHistory()
+
+    def post(self, body, content_type=None, **args):
+        request = BulkRequest(['bulk'])
+        request.site = self
+        request.content = BytesIO(body)
+        if content_type is not None:
+            request.requestHeaders.setRawHeaders('content-type',
+                                                 [content_type])
+        for name, value in args.items():
+            request.addArg(name, value)
+        request.render(Bulk(window=2))
+        return request
+
+    def get_lines(self, request):
+        return [json.loads(line)
+                for line in ''.join(request.written).splitlines()]
+
+    def test_parse_ip_range(self):
+        self.assertEqual(parse_ip_range('10.0.0.1'), (0x0a000001, 1))
+        self.assertEqual(parse_ip_range('10.0.1.7/22'), (0x0a000000, 1024))
+        self.assertEqual(parse_ip_range('0.0.0.0/0'), (0, 1 << 32))
+        for entry in ('wer', '10.0.0', '10.0.0.256', '10.0.0.0x1',
+                      '10.0.0.0/33', '10.0.0.0/', '10.0.0.0/-1'):
+            self.assertRaises(ValueError, parse_ip_range, entry)
+
+    def test_iter_ip_addrs(self):
+        ip_addrs = iter_ip_addrs([parse_ip_range('10.0.0.255'),
+                                  parse_ip_range('192.168.0.1/31')])
+        self.assertEqual(list(ip_addrs),
+                         ['10.0.0.255', '192.168.0.0', '192.168.0.1'])
+        ip_addrs = iter_ip_addrs([parse_ip_range('0.0.0.0/0')])
+        self.assertEqual(next(ip_addrs), '0.0.0.0')
+
+    def test_get_bulk_entries(self):
+        request = DummyRequest([])
+        request.content = BytesIO('["10.0.0.1", " 10.0.1.0/24 "]')
+        request.requestHeaders.setRawHeaders(
+            'content-type', ['application/json; charset=utf-8'])
+        self.assertEqual(get_bulk_entries(request),
+                         ['10.0.0.1', '10.0.1.0/24'])
+        request.content = BytesIO('{"ip_addr": "10.0.0.1"}')
+        self.assertRaises(ValueError, get_bulk_entries, request)
+        request.content = BytesIO('[')
+        self.assertRaises(ValueError, get_bulk_entries, request)
+        request = DummyRequest([])
+        request.content = BytesIO('10.0.0.1\r\n10.0.1.0/24\n\n')
+        self.assertEqual(get_bulk_entries(request),
+                         ['10.0.0.1', '10.0.1.0/24'])
+        request.addArg('file', '10.0.0.2\n')
+        self.assertEqual(get_bulk_entries(request), ['10.0.0.2'])
+
+    def test_window(self):
+        request = self.post('10.0.0.0/30\n10.0.1.1\n')
+        self.assertEqual(len(self.history.added), 2)
+        self.assertEqual(
+            [added[2:] for added in self.history.added],
+            [(main.PRIORITY_BULK, None)] * 2)
+        self.history.finish(1)
+        self.assertEqual(len(self.history.added), 3)
+        self.assertEqual([line['ip_addr'] for line in self.get_lines(request)],
+                         ['10.0.0.1'])
+        for index in (0, 2, 3, 4):
+            self.history.finish(index)
+        self.assertEqual([line['ip_addr'] for line in self.get_lines(request)],
+                         ['10.0.0.1', '10.0.0.0', '10.0.0.2', '10.0.0.3',
+                          '10.0.1.1'])
+        self.assertEqual(self.get_lines(request)[0]['datetime'],
+                         '2017-01-01T00:00:00')
+        self.assertEqual(request.finished, 1)
+        self.assertEqual(request.producer, None)
+
+    def test_non_utf8_whois(self):
+        request = self.post('10.0.0.1\n10.0.0.2\n')
+        for index, encoding in enumerate(('latin-1', 'utf-8')):
+            self.history.added[index][0]['whois'] = u'M\xfcller'.encode(
+                encoding)
+            self.history.finish(index)
+        self.assertEqual([line['whois'] for line in self.get_lines(request)],
+                         [u'M\xfcller', u'M\xfcller'])
+        self.assertEqual(request.finished, 1)
+
+    def test_history_records(self):
+        self.history = ResolveHistory()
+        resolver = self.history._resolver = FakeProcessor('name')
+        whois_caller = self.history._whois_caller = FakeProcessor('whois')
+        request = self.post('10.0.0.1\n')
+        resolver.finish(0, 'host.example.com')
+        whois_caller.finish(0, u'M\xfcller'.encode('latin-1'))
+        self.assertEqual(self.get_lines(request), [{
+            'datetime': self.history.get_items()[0]['datetime'].isoformat(),
+            'ip_addr': '10.0.0.1',
+            'name': 'host.example.com',
+            'whois': u'M\xfcller',
+            'status': 'success',
+        }])
+        self.assertEqual(request.finished, 1)
+
+    def test_failed_item(self):
+        request = self.post('10.0.0.1\n10.0.0.2\n')
+        self.history.finish(0)
+        self.history.added[1][1].errback(RuntimeError('failed'))
+        self.assertEqual(len(self.flushLoggedErrors(RuntimeError)), 1)
+        lines = self.get_lines(request)
+        self.assertEqual(lines[1], {'ip_addr': '10.0.0.2', 'status': 'error',
+                                    'error': 'failed'})
+        self.assertEqual(request.finished, 1)
+
+    def test_paused(self):
+        request = self.post('["10.0.0.0/29"]', 'application/json')
+        request.producer.pauseProducing()
+        self.history.finish(0)
+        self.history.finish(1)
+        self.assertEqual(len(self.history.added), 2)
+        self.assertEqual(len(self.get_lines(request)), 2)
+        request.producer.resumeProducing()
+        self.assertEqual(len(self.history.added), 4)
+
+    def test_disconnect(self):
+        request = self.post('10.0.0.0/29')
+        request.processingFailed(Failure(RuntimeError()))
+        self.history.finish(0)
+        self.assertEqual(len(self.history.added), 2)
+        self.assertEqual(request.written, [])
+
+    def test_bad_requests(self):
+        request = self.post('10.0.0.1\nwer\n')
+        self.assertEqual(request.responseCode, 400)
+        self.assertEqual(request.written, ['Wrong IP address: wer\n'])
+        request = self.post('10.0.0.0/15')
+        self.assertEqual(request.responseCode, 400)
+        self.assertEqual(self.history.added, [])
+
+    def test_empty(self):
+        request = self.post('')
+        self.assertEqual(request.finished, 1)
+        self.assertEqual(request.written, [])
+
+
+class EventsRequest(DummyRequest):
+
+    def registerProducer(self, producer, streaming):
+        self.producer = producer
+
+
+class EventsTests(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.history = ResolveHistory()
+        self.resolver = self.history._resolver = FakeProcessor('name')
+        self.whois_caller = self.history._whois_caller = FakeProcessor('whois')
+        self.broadcaster = EventBroadcaster(self.history, self.clock)
+        self.resource = Events(self.broadcaster)
+
+    def get(self, last_event_id=None):
+        request = EventsRequest(['events'])
+        if last_event_id is not None:
+            request.requestHeaders.setRawHeaders('last-event-id',
+                                                 [last_event_id])
+        request.render(self.resource)
+        return request
+
+    def get_events(self, request):
+        events = []
+        for block in ''.join(request.written).split('\n\n'):
+            fields = dict(line.split(': ', 1) for line in block.splitlines()
+                          if not line.startswith(':'))
+            if 'event' in fields:
+                events.append((fields.get('id'), fields['event'],
+                               json.loads(fields['data'])))
+        return events
+
+    def test_events(self):
+        request = self.get()
+        self.assertEqual(request.responseHeaders.getRawHeaders(
+            'content-type'), ['text/event-stream'])
+        self.assertEqual(request.written, ['retry: 3000\n\n'])
+        self.history.add('10.0.0.1')
+        self.resolver.finish(0, 'host')
+        self.whois_caller.finish(0, 'whois')
+        events = self.get_events(request)
+        self.assertEqual([event for _, event, _ in events],
+                         ['add', 'update', 'update'])
+        self.assertEqual(events[-1][2]['status'], 'success')
+        self.assertEqual(events[-1][2]['name'], 'host')
+        self.assertNotIn('whois', events[-1][2])
+        self.assertEqual(int(events[-1][0]), self.history.version)
+        self.history.clear()
+        self.assertEqual(self.get_events(request)[-1][1:], ('clear', {}))
+
+    def test_non_utf8_name(self):
+        request = self.get()
+        self.history.add('10.0.0.1')
+        self.resolver.finish(0, 'caf\xe9.example.com')
+        self.assertEqual(self.get_events(request)[-1][2]['name'],
+                         u'caf\xe9.example.com')
+
+    def test_reconnect(self):
+        request = self.get()
+        self.history.add('10.0.0.1')
+        self.history.add('10.0.0.2')
+        first_id = self.get_events(request)[0][0]
+        request.processingFailed(Failure(RuntimeError()))
+        self.assertEqual(len(self.broadcaster), 0)
+        self.resolver.finish(0, 'host')
+        request = self.get(first_id)
+        self.assertEqual([data['ip_addr'] for _, _, data
+                          in self.get_events(request)],
+                         ['10.0.0.2', '10.0.0.1'])
+        request = self.get(str(self.history.version))
+        self.assertEqual(self.get_events(request), [])
+        self.assertEqual(self.get('a').responseCode, 400)
+
+    def test_resync(self):
+        self.patch(main, 'EVENTS_BACKLOG', 2)
+        self.broadcaster = EventBroadcaster(self.history, self.clock)
+        self.resource = Events(self.broadcaster)
+        for index in xrange(3):
+            self.history.add('10.0.0.%d' % index)
+        request = self.get('0')
+        self.assertEqual([event for _, event, _
+                          in self.get_events(request)], ['resync'])
+
+    def test_paused(self):
+        request = self.get()
+        request.producer.pauseProducing()
+        self.history.add('10.0.0.1')
+        self.history.add('10.0.0.2')
+        self.assertEqual(self.get_events(request), [])
+        request.producer.resumeProducing()
+        self.assertEqual([event for _, event, _
+                          in self.get_events(request)], ['resync'])
+        self.history.add('10.0.0.3')
+        self.assertEqual(self.get_events(request)[-1][1], 'add')
+
+    def test_heartbeat(self):
+        requests = [self.get() for _ in xrange(3)]
+        self.assertEqual(len(self.clock.getDelayedCalls()), 1)
+        self.clock.advance(main.EVENTS_HEARTBEAT_INTERVAL)
+        for request in requests:
+            self.assertEqual(request.written[-1], ':\n\n')
+        for request in requests:
+            request.processingFailed(Failure(RuntimeError()))
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+
+class MetricsTests(unittest.TestCase):
+
+    def test_metrics(self):
+        history = ResolveHistory()
+        history.resolver.cache.put('10.0.0.2', (None, TimeoutError()), 10)
+        self.patch(history.resolver, '_handle_item',
+                   lambda item: item.__setitem__('name', 'host.example.com'))
+        self.patch(history.whois_caller, '_handle_item',
+                   lambda item: item.__setitem__('whois', 'whois'))
+        self.successResultOf(history.add('10.0.0.1'))
+        self.successResultOf(history.add('10.0.0.2'))
+        request = DummyRequest(['metrics'])
+        request.site = self
+        self.history = history
+        request.render(Metrics())
+        self.assertEqual(request.responseHeaders.getRawHeaders(
+            'content-type')[0].split(';')[0], 'text/plain')
+        text = ''.join(request.written)
+        samples = dict(line.rsplit(' ', 1) for line in text.splitlines()
+                       if not line.startswith('#'))
+        prefix = 'reverse_resolver_'
+        self.assertEqual(samples[prefix + 'queue_length{processor="dns"}'],
+                         '0')
+        self.assertEqual(
+            samples[prefix + 'handle_seconds_bucket{processor="whois",'
+                    'le="+Inf"}'], '1')
+        self.assertEqual(
+            samples[prefix + 'processed_total{processor="dns",'
+                    'result="success"}'], '1')
+        self.assertEqual(
+            samples[prefix + 'items_total{result="error",'
+                    'error="TimeoutError"}'], '1')
+        self.assertEqual(samples[prefix + 'cache_hits_total{cache="ptr"}'],
+                         '1')
+        self.assertNotIn(prefix + 'cache_size_bytes{cache="ptr"}', samples)
+        self.assertEqual(samples[prefix + 'history_items'], '2')
+        # samples of a metric follow its only TYPE line
+        types = re.findall(r'^# TYPE (\S+)', text, re.M)
+        self.assertEqual(len(types), len(set(types)))
+        metric = None
+        for line in text.splitlines():
+            if line.startswith('# TYPE '):
+                metric = line.split()[2]
+            elif not line.startswith('#'):
+                self.assertTrue(line.startswith(metric), line)
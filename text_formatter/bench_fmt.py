@@ -0,0 +1,511 @@
+# -*- encoding: utf-8 -*-
+"""
+This module contains benchmarks of the text formatter from fmt.py.
+
+Usage:
+python bench_fmt.py build -- measures the cost of building one justified
+and one plain line of text from collected words on the sample corpora.
+python bench_fmt.py suite -o results.json -- measures throughput and peak
+memory of the formatter on the sample and generated corpora, saves results.
+python bench_fmt.py compare old.json new.json -- compares saved results.
+"""
+
+import itertools
+import json
+import os
+import platform
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+from fmt import Formatter
+from fmt import detect_encoding
+from fmt import iter_decoded_lines
+
+
+SOURCE_DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                               'source_data')
+SAMPLE_CORPORA = ('text01_utf.txt', 'text01_cp1251.txt')
+FMT_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          'fmt.py')
+
+SUITE_PATHS = ('parse_line', 'format_file', 'format_mapped', 'cli')
+DEFAULT_SIZES = ('1M',)
+DEFAULT_MIXES = (0.0, 0.5, 1.0)
+DEFAULT_WIDTHS = (20, 40, 80, 120)
+SIZE_UNITS = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+
+ASCII_SYLLABLES = ('lo', 're', 'mi', 'psum', 'do', 'lor', 'sit', 'a', 'met',
+                   'con', 'sec', 'te', 'tur', 'e', 'lit', 'sed', 'ut', 'ex')
+CYRILLIC_SYLLABLES = (u'се', u'лдон', u'не', u'пы', u'та',
+                      u'лся', u'за', u'дер', u'жи', u'вать',
+                      u'со', u'про', u'во', u'жда', u'ю',
+                      u'щих', u'о', u'сно')
+SENTENCE_ENDINGS = ('.', '.', '.', '!', '?', ':')
+
+
+def read_lines(path):
+    """Reads and decodes all lines of a text file."""
+    with open(path, 'rb') as src:
+        head = src.read()
+        return list(iter_decoded_lines(src, detect_encoding(head), head))
+
+
+class _DraftCollector(Formatter):
+
+    """
+    Inner class. Formatter, which saves the state of each line it builds.
+
+    Attributes justified_drafts and plain_drafts are lists of tuples:
+    words, size of words and new paragraph flag.
+    """
+
+    def __init__(self, *args, **kwargs):
+        Formatter.__init__(self, *args, **kwargs)
+        self.justified_drafts = []
+        self.plain_drafts = []
+
+    def _save_draft(self, drafts):
+        drafts.append((list(self._draft_line), self._draft_line_size,
+                       self._is_new_paragraph))
+
+    def _build_justified_ready_line(self):
+        self._save_draft(self.justified_drafts)
+        Formatter._build_justified_ready_line(self)
+
+    def _build_ready_line(self):
+        self._save_draft(self.plain_drafts)
+        Formatter._build_ready_line(self)
+
+
+def time_build(formatter, build, drafts, repeat):
+    """
+    Measures the best time of building lines from drafts.
+
+    Arguments are:
+    * formatter -- Formatter instance to build lines with;
+    * build -- unbound build method of Formatter;
+    * drafts -- list of saved drafts (see _DraftCollector);
+    * repeat -- integer value, number of measurements.
+
+    Returns the best time in seconds of building all the lines.
+    """
+    best = None
+    for _ in xrange(repeat):
+        start = time.time()
+        for formatter._draft_line, formatter._draft_line_size, \
+                formatter._is_new_paragraph in drafts:
+            build(formatter)
+        elapsed = time.time() - start
+        del formatter._ready_lines[:]
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def bench_build(paths, linesize=80, tabsize=4, repeat=15):
+    """
+    Measures the cost of building lines on the corpora.
+
+    Arguments are:
+    * paths -- list of corpora file names;
+    * linesize, tabsize -- options of the formatter;
+    * repeat -- integer value, number of measurements.
+
+    Returns a list of dicts with the corpus name, line kind, number of
+    lines and the best cost of building a line in nanoseconds.
+    """
+    results = []
+    for path in paths:
+        collector = _DraftCollector(linesize, tabsize, engine='split')
+        for _ in collector.iter_format(read_lines(path)):
+            pass
+        formatter = Formatter(linesize, tabsize)
+        for kind, build, drafts in (
+                ('justified', Formatter._build_justified_ready_line,
+                 collector.justified_drafts),
+                ('plain', Formatter._build_ready_line,
+                 collector.plain_drafts)):
+            if not drafts:
+                continue
+            elapsed = time_build(formatter, build, drafts, repeat)
+            results.append({
+                'corpus': os.path.basename(path),
+                'kind': kind,
+                'lines': len(drafts),
+                'ns_per_line': elapsed / len(drafts) * 1e9,
+            })
+    return results
+
+
+def parse_size(size):
+    """Converts size like '16M' into a number of bytes."""
+    unit = SIZE_UNITS.get(size[-1:].upper())
+    if unit is None:
+        return int(size)
+    return int(size[:-1]) * unit
+
+
+class CorpusGenerator(object):
+
+    """
+    This class generates synthetic texts for the benchmarks.
+
+    Texts consist of headers and paragraphs of varied length, words are
+    built of ascii and cyrillic syllables in a given proportion, and
+    paragraphs are splitted into source lines of random length.
+    Generation is deterministic for the same seed.
+    """
+
+    def __init__(self, cyrillic_ratio=0.5, seed=1, pool_size=512):
+        """
+        Instance constructor.
+
+        Arguments are:
+        * cyrillic_ratio -- float value from 0 to 1, the part of cyrillic
+        words (0.5 by default);
+        * seed -- integer value, seed of random numbers (1 by default);
+        * pool_size -- integer value, number of distinct paragraphs, texts
+        are composed of (512 by default).
+        """
+        self._random = random.Random(seed)
+        self._cyrillic_ratio = cyrillic_ratio
+        self._pool = [self._make_paragraph() for _ in xrange(pool_size)]
+
+    def _make_word(self):
+        rnd = self._random
+        if rnd.random() < self._cyrillic_ratio:
+            syllables = CYRILLIC_SYLLABLES
+        else:
+            syllables = ASCII_SYLLABLES
+        word = u''.join(rnd.choice(syllables)
+                        for _ in xrange(rnd.randint(1, 3)))
+        if rnd.random() < 0.1:
+            word = word.capitalize()
+        if rnd.random() < 0.08:
+            word += u','
+        return word
+
+    def _make_paragraph(self):
+        rnd = self._random
+        if rnd.random() < 0.05:
+            # header, which is finished by an empty line
+            words = [self._make_word() for _ in xrange(rnd.randint(1, 4))]
+            return u' '.join(words) + u'\n\n'
+
+        # mostly short paragraphs, but sometimes very long ones
+        num_of_sentences = min(int(rnd.expovariate(0.2)) + 1, 100)
+        words = []
+        for _ in xrange(num_of_sentences):
+            sentence = [self._make_word()
+                        for _ in xrange(rnd.randint(3, 25))]
+            sentence[0] = sentence[0].capitalize()
+            sentence[-1] = (sentence[-1].rstrip(u',')
+                            + rnd.choice(SENTENCE_ENDINGS))
+            words.extend(sentence)
+        words[-1] = words[-1].rstrip(u':') + u'.'
+
+        lines = []
+        line_words = []
+        line_size = 0
+        line_limit = rnd.randint(40, 200)
+        for word in words:
+            line_words.append(word)
+            line_size += len(word) + 1
+            if line_size >= line_limit:
+                lines.append(u' '.join(line_words) + u' \n')
+                line_words = []
+                line_size = 0
+                line_limit = rnd.randint(40, 200)
+        if line_words:
+            lines.append(u' '.join(line_words) + u'\n')
+        return u''.join(lines)
+
+    def write(self, path, size):
+        """
+        Writes a text of about size bytes encoded in utf-8 to the file.
+        """
+        rnd = self._random
+        pool = [paragraph.encode('utf-8') for paragraph in self._pool]
+        written = 0
+        with open(path, 'wb') as dst:
+            while written < size:
+                batch = [rnd.choice(pool) for _ in xrange(256)]
+                data = ''.join(batch)
+                dst.write(data)
+                written += len(data)
+
+
+def get_generated_corpus(directory, size, cyrillic_ratio):
+    """
+    Returns the name of a generated corpus file, generates it if needed.
+    """
+    name = 'generated_%s_cyr%d.txt' % (size, int(cyrillic_ratio * 100))
+    path = os.path.join(directory, name)
+    if not os.path.exists(path):
+        CorpusGenerator(cyrillic_ratio).write(path + '.tmp', parse_size(size))
+        os.rename(path + '.tmp', path)
+    return path
+
+
+def count_lines(path):
+    """Returns the number of lines in a file."""
+    num_of_lines = 0
+    with open(path, 'rb') as src:
+        for chunk in iter(lambda: src.read(1024 * 1024), ''):
+            num_of_lines += chunk.count('\n')
+    return num_of_lines
+
+
+def run_case(case):
+    """
+    Runs one benchmark case in the current process.
+
+    Argument is a dict with keys:
+    * corpus -- corpus file name;
+    * path -- one of SUITE_PATHS: parse_line() and get_lines() calls per
+    line, format_file() or format_mapped() of the formatter or a run of
+    fmt.py script;
+    * engine, linesize, breaking -- options of the formatter.
+
+    Returns a dict with elapsed time, peak memory in KB and an error
+    message if the formatter failed.
+    """
+    error = None
+    start = time.time()
+    try:
+        if case['path'] == 'cli':
+            status = subprocess.call(
+                [sys.executable, FMT_SCRIPT, '-w', str(case['linesize']),
+                 '-e', case['engine'], '-b', case['breaking'],
+                 case['corpus'], os.devnull],
+                stderr=open(os.devnull, 'wb'))
+            if status:
+                error = "fmt.py exited with status %d" % status
+        else:
+            formatter = Formatter(case['linesize'], engine=case['engine'],
+                                  breaking=case['breaking'])
+            with open(case['corpus'], 'rb') as src:
+                with open(os.devnull, 'wb') as dst:
+                    if case['path'] == 'format_file':
+                        formatter.format_file(src, dst)
+                    elif case['path'] == 'format_mapped':
+                        formatter.format_mapped(src, dst)
+                    else:
+                        for line in src:
+                            formatter.parse_line(line)
+                            for out_line in formatter.get_lines():
+                                dst.write(out_line)
+                        for out_line in formatter.get_lines(flush=True):
+                            dst.write(out_line)
+    except ValueError as e:
+        error = e.args[0]
+        if not isinstance(error, unicode):
+            error = error.decode('utf-8', 'replace')
+    elapsed = time.time() - start
+
+    if case['path'] == 'cli':
+        usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    else:
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+    return {'seconds': elapsed, 'peak_rss_kb': usage.ru_maxrss,
+            'error': error}
+
+
+def run_suite(corpora, widths, paths, engines, breakings=('greedy',),
+              repeat=3):
+    """
+    Runs benchmark cases, each one in a separate process to measure
+    its peak memory.
+
+    Arguments are:
+    * corpora -- list of corpora file names;
+    * widths -- list of line sizes;
+    * paths, engines -- lists of formatting paths and parsing engines;
+    * breakings -- list of line breaking modes, the optimal one is measured
+    with the 'split' engine only;
+    * repeat -- integer value, number of runs of each case, the fastest
+    one is reported.
+
+    Returns a list of dicts of case options and results: MB/s, lines/s
+    (of source text) and peak memory.
+    """
+    results = []
+    for corpus in corpora:
+        size = os.path.getsize(corpus)
+        num_of_lines = count_lines(corpus)
+        for path in paths:
+            for engine, breaking in itertools.product(engines, breakings):
+                if breaking == 'optimal' and engine != 'split':
+                    continue
+                for linesize in widths:
+                    case = {'corpus': corpus, 'path': path,
+                            'engine': engine, 'linesize': linesize,
+                            'breaking': breaking}
+                    runs = []
+                    for _ in xrange(repeat):
+                        output = subprocess.check_output(
+                            [sys.executable, os.path.abspath(__file__),
+                             'case', json.dumps(case)])
+                        runs.append(json.loads(output))
+                    best = min(runs, key=lambda run: run['seconds'])
+                    result = dict(case)
+                    result.update(best)
+                    result['corpus'] = os.path.basename(corpus)
+                    result['bytes'] = size
+                    result['lines'] = num_of_lines
+                    result['mb_per_s'] = size / best['seconds'] / 1024 ** 2
+                    result['lines_per_s'] = num_of_lines / best['seconds']
+                    results.append(result)
+                    yield result
+
+
+def get_metadata():
+    """Returns a dict describing the code and the environment measured."""
+    try:
+        commit = subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=open(os.devnull, 'wb')).strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        'commit': commit,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+    }
+
+
+def get_case_key(result):
+    """Returns a tuple, which identifies a benchmark case in results."""
+    # results saved before line breaking modes are greedy ones
+    return (result['corpus'], result['path'], result['engine'],
+            result['linesize'], result.get('breaking', 'greedy'))
+
+
+def compare_results(old, new, threshold=0.1):
+    """
+    Compares two saved suite results.
+
+    Arguments are:
+    * old, new -- dicts loaded from result files;
+    * threshold -- float value, relative slowdown, which is reported as
+    a regression (0.1 by default).
+
+    Returns a list of tuples: case key, old MB/s, new MB/s, relative
+    change and regression flag. Failed cases are skipped.
+    """
+    old_results = dict((get_case_key(result), result)
+                       for result in old['results'] if not result['error'])
+    comparison = []
+    for result in new['results']:
+        old_result = old_results.get(get_case_key(result))
+        if old_result is None or result['error']:
+            continue
+        change = result['mb_per_s'] / old_result['mb_per_s'] - 1
+        comparison.append((get_case_key(result), old_result['mb_per_s'],
+                           result['mb_per_s'], change, change < -threshold))
+    return comparison
+
+
+if __name__ == '__main__':
+
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='command')
+    build_parser = subparsers.add_parser(
+        'build', help="measure the cost of building lines")
+    build_parser.add_argument("-w", "--linesize", type=int, default=80)
+    build_parser.add_argument("-r", "--repeat", type=int, default=15)
+    suite_parser = subparsers.add_parser(
+        'suite', help="measure throughput and memory, save results")
+    suite_parser.add_argument("-o", "--output", help="JSON results file")
+    suite_parser.add_argument(
+        "--sizes", nargs='*', default=list(DEFAULT_SIZES),
+        help="sizes of generated corpora, e.g. 1M 64M 1G")
+    suite_parser.add_argument(
+        "--mixes", nargs='*', type=float, default=list(DEFAULT_MIXES),
+        help="parts of cyrillic words in generated corpora")
+    suite_parser.add_argument(
+        "--widths", nargs='*', type=int, default=list(DEFAULT_WIDTHS))
+    suite_parser.add_argument(
+        "--paths", nargs='*', default=list(SUITE_PATHS), choices=SUITE_PATHS)
+    suite_parser.add_argument(
+        "--engines", nargs='*', default=['split'],
+        choices=sorted(Formatter._engines))
+    suite_parser.add_argument(
+        "--breakings", nargs='*', default=['greedy'],
+        choices=Formatter._breakings)
+    suite_parser.add_argument("-r", "--repeat", type=int, default=3)
+    suite_parser.add_argument(
+        "--corpora-dir", default=os.path.join(tempfile.gettempdir(),
+                                              'fmt_bench_corpora'),
+        help="directory for generated corpora")
+    compare_parser = subparsers.add_parser(
+        'compare', help="compare saved results")
+    compare_parser.add_argument("old")
+    compare_parser.add_argument("new")
+    compare_parser.add_argument("--threshold", type=float, default=0.1)
+    case_parser = subparsers.add_parser('case')
+    case_parser.add_argument("case")
+    args = parser.parse_args()
+
+    if args.command == 'build':
+        paths = [os.path.join(SOURCE_DATA_DIR, name)
+                 for name in SAMPLE_CORPORA]
+        for result in bench_build(paths, args.linesize, repeat=args.repeat):
+            print("%(corpus)-20s %(kind)-10s %(lines)7d lines "
+                  "%(ns_per_line)7.0f ns/line" % result)
+
+    elif args.command == 'suite':
+        if not os.path.isdir(args.corpora_dir):
+            os.makedirs(args.corpora_dir)
+        corpora = [os.path.join(SOURCE_DATA_DIR, name)
+                   for name in SAMPLE_CORPORA]
+        for size in args.sizes:
+            for mix in args.mixes:
+                corpora.append(
+                    get_generated_corpus(args.corpora_dir, size, mix))
+
+        results = []
+        for result in run_suite(corpora, args.widths, args.paths,
+                                args.engines, args.breakings,
+                                args.repeat):
+            results.append(result)
+            if result['error']:
+                message = (u"%(corpus)-26s %(path)-13s %(engine)-5s "
+                           u"%(breaking)-7s %(linesize)3d  failed: %(error)s"
+                           % result)
+                print(message.encode('utf-8'))
+            else:
+                print("%(corpus)-26s %(path)-13s %(engine)-5s "
+                      "%(breaking)-7s %(linesize)3d %(mb_per_s)7.2f MB/s "
+                      "%(lines_per_s)9.0f lines/s %(peak_rss_kb)7d KB"
+                      % result)
+        if args.output:
+            with open(args.output, 'w') as dst:
+                json.dump({'meta': get_metadata(), 'results': results}, dst,
+                          indent=1, sort_keys=True)
+
+    elif args.command == 'compare':
+        with open(args.old) as src:
+            old = json.load(src)
+        with open(args.new) as src:
+            new = json.load(src)
+        regressions = 0
+        for key, old_speed, new_speed, change, regression in \
+                compare_results(old, new, args.threshold):
+            regressions += regression
+            print("%-26s %-13s %-5s %3d %-7s" % key
+                  + " %7.2f -> %7.2f MB/s %+6.1f%%%s"
+                  % (old_speed, new_speed, change * 100,
+                     '  REGRESSION' if regression else ''))
+        sys.exit(1 if regressions else 0)
+
+    elif args.command == 'case':
+        print(json.dumps(run_case(json.loads(args.case))))
@@ -4,6 +4,900 @@ It contains a class with parsing and formatting logic
 and a main script, that performs files IO and uses the class.
 """
 
+import codecs
+import glob
+import hashlib
+import json
+import mmap
+import multiprocessing
+import os
+import re
+import timeit
+import unicodedata
+from array import array
+from bisect import bisect_right
+from collections import OrderedDict
+from collections import deque
+from functools import partial
+from itertools import imap
+from itertools import islice
+from itertools import izip
+
+
+# ascii spaces separate words in bytes and in decoded text alike, other
+# unicode spaces like no-break space (u'\xa0') are parts of words
+_SPACES = ' \t\n\r\x0b\x0c'
+# a word is a run of non-space symbols followed by a space symbol,
+# the same as the scanning parser collects them
+_WORD_RE = re.compile(r'[^ \t\n\r\x0b\x0c]+(?=[ \t\n\r\x0b\x0c])')
+_UNICODE_WORD_RE = re.compile(
+    u'[^ \t\n\r\x0b\x0c]+(?=[ \t\n\r\x0b\x0c])')
+_PARAGRAPH_ENDINGS = ['.', '!', '?', ':']
+_NON_ASCII_RE = re.compile(r'[\x80-\xff]')
+_LINE_RE = re.compile(r'[^\n]*\n')
+# end of a line, which finishes a paragraph: the last word of the line ends
+# with one of _PARAGRAPH_ENDINGS or the line is empty
+_PARAGRAPH_END_RE = re.compile(r'(?:[.!?:]|\n)[ \t\r\x0b\x0c]*\n')
+_EMPTY_LINE_RE = re.compile(r'[ \t\r\x0b\x0c]*\n')
+# end of a block of a mapped file: a line end or a space before a word,
+# so the block ends between words and symbols
+_BLOCK_END_RE = re.compile(r'\n| (?=[^ \t\n\r\x0b\x0c])')
+
+# byte order marks and encodings that skip them while decoding,
+# utf-32 marks go first as they start with utf-16 ones
+_BOMS = (
+    (codecs.BOM_UTF32_LE, 'utf-32'),
+    (codecs.BOM_UTF32_BE, 'utf-32'),
+    (codecs.BOM_UTF8, 'utf-8-sig'),
+    (codecs.BOM_UTF16_LE, 'utf-16'),
+    (codecs.BOM_UTF16_BE, 'utf-16'),
+)
+# single byte encodings in order of preference, the last one decodes anything
+_SINGLE_BYTE_ENCODINGS = ('cp1251', 'koi8-r', 'cp866', 'latin-1')
+_DETECTION_SAMPLE_SIZE = 64 * 1024
+_READ_CHUNK_SIZE = 256 * 1024
+_MAPPED_BLOCK_SIZE = 256 * 1024
+_MAPPED_WINDOW_SIZE = 8 * 1024 * 1024
+_WRITE_BATCH_LINES = 4096
+_PARALLEL_CHUNK_SIZE = 4 * 1024 * 1024
+_BATCH_STATE_FILE = '.fmt_batch_state.json'
+
+# symbols of latin, greek and cyrillic letters without combining marks take
+# one column each, a text of other symbols is measured with width tables
+_WIDTH_CHECK_RE = re.compile(u'[^\x00-\u02ff\u0370-\u0482\u048a-\u058f]')
+# planes, which widths are taken from unicodedata, other symbols out of
+# the basic plane take one column if not in _WIDE_RANGES
+_WIDTH_PLANES = ((0x10000, 0x20000), (0xe0000, 0xe1000))
+# wide symbols unknown to unicodedata: emoji and the rest of cjk planes
+_WIDE_RANGES = (
+    (0x1f300, 0x1f64f),
+    (0x1f680, 0x1f6ff),
+    (0x1f900, 0x1f9ff),
+    (0x1fa70, 0x1faff),
+    (0x20000, 0x3fffd),
+)
+
+
+class _JustificationTable(dict):
+
+    """
+    Inner class. Table of space items for justified lines of one size.
+
+    table[num_of_words][spaces_left] is a tuple of the regular space item,
+    the long space item and the number of words before the first long
+    space item. Rows are computed on first access.
+    """
+
+    def __init__(self, linesize):
+        dict.__init__(self)
+        self._linesize = linesize
+        self._space_items = [' ' * size for size in xrange(linesize + 2)]
+
+    def __missing__(self, num_of_words):
+        space_items = self._space_items
+        num_of_spaces = num_of_words - 1
+        row = []
+        for spaces_left in xrange(self._linesize + 1):
+            size = spaces_left / num_of_spaces
+            extra_spaces_after = num_of_spaces - spaces_left % num_of_spaces
+            row.append((space_items[size], space_items[size + 1],
+                        extra_spaces_after + 1))
+        self[num_of_words] = row
+        return row
+
+
+class _JustificationRow(object):
+
+    """
+    Inner class. Row of space items computed on every access, used instead
+    of _JustificationTable for long lines, as the table takes memory
+    quadratic in the line size.
+    """
+
+    def __init__(self, num_of_words):
+        self._num_of_spaces = num_of_words - 1
+
+    def __getitem__(self, spaces_left):
+        num_of_spaces = self._num_of_spaces
+        size = spaces_left / num_of_spaces
+        extra_spaces_after = num_of_spaces - spaces_left % num_of_spaces
+        return (' ' * size, ' ' * (size + 1), extra_spaces_after + 1)
+
+
+class _DirectJustificationTable(object):
+
+    """Inner class. Table of _JustificationRow items of any number of words."""
+
+    def __getitem__(self, num_of_words):
+        return _JustificationRow(num_of_words)
+
+
+# longest lines justified with a table and the number of the tables kept
+_MAX_JUSTIFICATION_TABLE_LINESIZE = 256
+_JUSTIFICATION_TABLES_COUNT = 16
+
+# line size -> justification table shared by formatters, least recently
+# used ones are dropped; the spacing does not depend on tab size
+_justification_tables = OrderedDict()
+
+
+def _get_justification_table(linesize):
+    """Inner function. Gets a justification table for the line size."""
+    if linesize > _MAX_JUSTIFICATION_TABLE_LINESIZE:
+        return _DirectJustificationTable()
+    table = _justification_tables.pop(linesize, None)
+    if table is None:
+        table = _JustificationTable(linesize)
+        if len(_justification_tables) >= _JUSTIFICATION_TABLES_COUNT:
+            _justification_tables.popitem(last=False)
+    _justification_tables[linesize] = table
+    return table
+
+# display widths of the basic plane symbols, starts of ranges of other
+# symbols and their widths, the tables are built on first use
+_width_tables = {}
+
+
+def _get_symbol_width(symbol):
+    """
+    Inner function. Gets display width of a symbol in columns from
+    unicodedata: combining marks and format symbols take no columns,
+    east asian wide and full width ones take two.
+    """
+    if symbol == u'\xad':
+        # soft hyphen is shown at the end of a line
+        return 1
+    if unicodedata.category(symbol) in ('Mn', 'Me', 'Cf'):
+        return 0
+    if u'\u1160' <= symbol <= u'\u11ff':
+        # hangul medial vowels and final consonants join the syllable
+        return 0
+    if unicodedata.east_asian_width(symbol) in ('W', 'F'):
+        return 2
+    return 1
+
+
+def _build_width_tables():
+    """
+    Inner function. Builds tables of symbols display widths.
+
+    Widths of the basic plane are kept in a bytearray indexed by the symbol
+    code, widths of other planes are kept as ranges for bisect.
+    """
+    basic_widths = bytearray(0x10000)
+    for code in xrange(0x10000):
+        basic_widths[code] = _get_symbol_width(unichr(code))
+
+    widths = {}
+    for start, end in _WIDTH_PLANES:
+        for code in xrange(start, end):
+            widths[code] = _get_symbol_width(unichr(code))
+    for start, end in _WIDE_RANGES:
+        widths.update((code, 2) for code in xrange(start, end + 1))
+    range_starts = [0x10000]
+    range_widths = [1]
+    last_code = 0xffff
+    for code, width in sorted(widths.iteritems()):
+        if code != last_code + 1 and range_widths[-1] != 1:
+            # gap between known symbols
+            range_starts.append(last_code + 1)
+            range_widths.append(1)
+        if width != range_widths[-1]:
+            range_starts.append(code)
+            range_widths.append(width)
+        last_code = code
+    range_starts.append(last_code + 1)
+    range_widths.append(1)
+
+    _width_tables['basic'] = basic_widths
+    _width_tables['starts'] = range_starts
+    _width_tables['widths'] = range_widths
+
+
+def get_text_width(text):
+    """
+    Get display width of a text in columns.
+
+    Argument is:
+    * text -- unicode string.
+
+    Combining marks and zero width symbols take no columns, east asian wide
+    symbols and emoji take two columns, others take one. A text of latin,
+    greek or cyrillic letters is measured by its length.
+    """
+    if not _WIDTH_CHECK_RE.search(text):
+        return len(text)
+    if not _width_tables:
+        _build_width_tables()
+    basic_widths = _width_tables['basic']
+    width = 0
+    for symbol in text:
+        code = ord(symbol)
+        if code < 0x10000:
+            width += basic_widths[code]
+        else:
+            range_starts = _width_tables['starts']
+            width += _width_tables['widths'][
+                bisect_right(range_starts, code) - 1]
+    return width
+
+_STATS_COUNTERS = ('lines', 'chars', 'words', 'justified_lines',
+                   'plain_lines', 'header_lines', 'flushes', 'too_long_words')
+_STATS_SAMPLE_RATE = 16
+
+
+class FormatterStats(object):
+
+    """
+    This class collects counters and sampled timings of a Formatter.
+
+    Counters are:
+    * lines, chars -- number of parsed lines and their symbols (bytes for
+    byte strings);
+    * words -- number of words in built lines;
+    * justified_lines, plain_lines, header_lines -- number of built lines
+    of each kind (plain lines are the last lines of paragraphs);
+    * flushes -- number of finished paragraphs;
+    * too_long_words -- number of 'Word is too long' errors.
+    Timings are collected for stages 'detect' (encoding detection), 'parse'
+    (parsing of a line including building lines from it), 'justify' and
+    'build' (building of a justified or non justified line), and 'flush'
+    (finishing of a paragraph). Only every sample_rate-th call of a stage
+    is timed, the whole time of a stage is estimated from these samples.
+    """
+
+    def __init__(self, sample_rate=_STATS_SAMPLE_RATE):
+        """
+        Instance constructor.
+
+        Argument is:
+        * sample_rate -- integer value, every sample_rate-th call of a stage
+        is timed (the first call is always timed).
+        """
+        self.counters = dict.fromkeys(_STATS_COUNTERS, 0)
+        self._sample_rate = sample_rate
+        # stage -> [calls, sampled calls, sampled seconds]
+        self._stages = {}
+
+    def timed(self, stage, method, *args):
+        """
+        Calls the method with arguments as a part of the stage.
+
+        Returns the result of the method.
+        """
+        stage_stats = self._stages.get(stage)
+        if stage_stats is None:
+            stage_stats = self._stages[stage] = [0, 0, 0.0]
+        stage_stats[0] += 1
+        if (stage_stats[0] - 1) % self._sample_rate:
+            return method(*args)
+        start = timeit.default_timer()
+        try:
+            return method(*args)
+        finally:
+            stage_stats[1] += 1
+            stage_stats[2] += timeit.default_timer() - start
+
+    def as_dict(self):
+        """
+        Returns a dict of counters and stages, each stage is a dict of
+        calls, sampled calls, mean time of a call and estimated whole time
+        of the stage in seconds.
+        """
+        stages = {}
+        for stage, (calls, sampled_calls, seconds) in self._stages.items():
+            mean_seconds = seconds / sampled_calls if sampled_calls else 0.0
+            stages[stage] = {
+                'calls': calls,
+                'sampled_calls': sampled_calls,
+                'mean_seconds': mean_seconds,
+                'estimated_seconds': mean_seconds * calls,
+            }
+        return {'counters': dict(self.counters), 'stages': stages}
+
+    def report(self):
+        """Returns a text report of counters and stages timings."""
+        stats = self.as_dict()
+        lines = ['Counters:']
+        for name in _STATS_COUNTERS:
+            lines.append('  %-16s %12d' % (name, stats['counters'][name]))
+        lines.append('Stages (estimated by samples, parse includes '
+                     'justify and build, flush includes build):')
+        for stage, stage_stats in sorted(stats['stages'].items()):
+            lines.append('  %-8s %10d calls %10.3f s %10.2f us/call' % (
+                stage, stage_stats['calls'],
+                stage_stats['estimated_seconds'],
+                stage_stats['mean_seconds'] * 1e6))
+        return '\n'.join(lines)
+
+
+def detect_encoding(head):
+    """
+    Detects the encoding of a text by its first bytes.
+
+    Argument is:
+    * head -- string of bytes from the beginning of the text.
+
+    Returns the name of the encoding: the one defined by byte order mark,
+    utf-8 if the head is valid utf-8, or a single byte encoding where the
+    most of non-ascii symbols are lowercase letters (as they are in a usual
+    text).
+    """
+    for bom, encoding in _BOMS:
+        if head.startswith(bom):
+            return encoding
+
+    try:
+        # the head may end in the middle of a symbol, so it is not final
+        codecs.getincrementaldecoder('utf-8')().decode(head)
+        return 'utf-8'
+    except UnicodeDecodeError:
+        pass
+
+    non_ascii = ''.join(_NON_ASCII_RE.findall(head))
+    best_encoding = None
+    best_score = -1
+    for encoding in _SINGLE_BYTE_ENCODINGS:
+        score = sum(1 for symbol in non_ascii.decode(encoding, 'replace')
+                    if symbol.islower())
+        if score > best_score:
+            best_encoding = encoding
+            best_score = score
+    return best_encoding
+
+
+def _get_non_ascii_sample(data):
+    """
+    Inner function. Gets a sample of data to detect its encoding from
+    the first non-ascii byte, None if there are no such bytes.
+
+    One ascii byte before it is kept, so the sample never starts with
+    a byte order mark.
+    """
+    match = _NON_ASCII_RE.search(data)
+    if match is None:
+        return None
+    start = max(match.start() - 1, 0)
+    return data[start:start + _DETECTION_SAMPLE_SIZE]
+
+
+def detect_data_encoding(data):
+    """
+    Detects the encoding of a whole text in memory.
+
+    Argument is:
+    * data -- string of bytes or other buffer (e.g. a mapped file).
+
+    Works as detect_encoding() with the beginning of the text, but if
+    the beginning is ascii, which says nothing about the encoding,
+    the sample is taken from the first non-ascii byte.
+    """
+    head = data[:_DETECTION_SAMPLE_SIZE]
+    if _NON_ASCII_RE.search(head) is None:
+        sample = _get_non_ascii_sample(data)
+        if sample is not None:
+            head = sample
+    return detect_encoding(head)
+
+
+def _is_ascii_compatible(encoding):
+    """
+    Inner function. Checks that ascii spaces and paragraph ending signs
+    are encoded as single ascii bytes, so they can be found in encoded text.
+    """
+    sample = u'\n .!?:'
+    return sample.encode(encoding).endswith(sample.encode('ascii'))
+
+
+def _detect_mapped_encoding(fileno, size):
+    """Inner function. Detects the encoding of a file mapped to memory."""
+    mapped = mmap.mmap(fileno, size, access=mmap.ACCESS_READ)
+    try:
+        return detect_data_encoding(mapped)
+    finally:
+        mapped.close()
+
+
+def _iter_mapped_blocks(fileno, size):
+    """
+    Inner function. Yields blocks of a file ending between words.
+
+    Arguments are:
+    * fileno -- file descriptor of the file;
+    * size -- integer value, size of the file.
+
+    Only a window of the file is mapped to memory at once, so mapped pages
+    of the passed blocks are released. The window grows if a block does not
+    fit to it.
+    """
+    window = None
+    window_start = window_end = 0
+    window_size = _MAPPED_WINDOW_SIZE
+    start = 0
+    try:
+        while start < size:
+            match = None
+            if window is not None:
+                match = _BLOCK_END_RE.search(
+                    window, start - window_start + _MAPPED_BLOCK_SIZE)
+            if match is None and window_end < size:
+                new_window_start = start - start % mmap.ALLOCATIONGRANULARITY
+                if window is not None:
+                    window.close()
+                    if new_window_start == window_start:
+                        # the block is longer than the window
+                        window_size *= 2
+                window_start = new_window_start
+                window_end = min(window_start + window_size, size)
+                window = mmap.mmap(fileno, window_end - window_start,
+                                   access=mmap.ACCESS_READ,
+                                   offset=window_start)
+                continue
+            if match is None:
+                end = size
+            else:
+                end = window_start + match.end()
+            yield window[start - window_start:end - window_start]
+            start = end
+    finally:
+        if window is not None:
+            window.close()
+
+
+def _iter_decoded_chunks(src, encoding, head=''):
+    """
+    Inner function. Reads a binary stream by big chunks and decodes them
+    once with an incremental decoder.
+
+    Yields non-empty pieces of text.
+    """
+    decoder = codecs.getincrementaldecoder(encoding)()
+    chunk = head or src.read(_READ_CHUNK_SIZE)
+    while chunk:
+        text = decoder.decode(chunk)
+        if text:
+            yield text
+        chunk = src.read(_READ_CHUNK_SIZE)
+    text = decoder.decode('', final=True)
+    if text:
+        yield text
+
+
+class _DecodedStream(object):
+
+    """
+    Inner class. Binary stream read by big chunks, which are decoded once
+    with an incremental decoder.
+
+    If the encoding is not given, it is detected by the beginning of
+    the stream. An ascii beginning is detected as utf-8, and the encoding
+    is detected again by the first chunk with non-ascii bytes: ascii
+    symbols are the same in all ascii compatible encodings, so the text
+    decoded before stays valid. Attribute encoding is the encoding known
+    so far, encode() encodes results of the decoded text in it.
+    """
+
+    def __init__(self, src, encoding=None, detect=detect_encoding):
+        """
+        Instance constructor.
+
+        Arguments are:
+        * src -- binary file-like object to read from;
+        * encoding -- name of the stream encoding (None by default, which
+        means the encoding is detected);
+        * detect -- function detecting the encoding by the stream head.
+        """
+        self._src = src
+        self._head = ''
+        self._redetect = False
+        if encoding is None:
+            self._head = src.read(_DETECTION_SAMPLE_SIZE)
+            encoding = detect(self._head)
+            self._redetect = _NON_ASCII_RE.search(self._head) is None
+        self.encoding = encoding
+        self._encoder = None
+        self._encoder_encoding = None
+
+    def iter_chunks(self):
+        """Yields non-empty pieces of decoded text."""
+        decoder = codecs.getincrementaldecoder(self.encoding)()
+        chunk = self._head or self._src.read(_READ_CHUNK_SIZE)
+        # the last byte of ascii text read before, see _get_non_ascii_sample()
+        last_byte = ''
+        while chunk:
+            if self._redetect:
+                sample = _get_non_ascii_sample(last_byte + chunk)
+                if sample is None:
+                    last_byte = chunk[-1]
+                else:
+                    self._redetect = False
+                    self.encoding = detect_encoding(sample)
+                    decoder = codecs.getincrementaldecoder(self.encoding)()
+            text = decoder.decode(chunk)
+            if text:
+                yield text
+            chunk = self._src.read(_READ_CHUNK_SIZE)
+        text = decoder.decode('', final=True)
+        if text:
+            yield text
+
+    def encode(self, text, final=False):
+        """Encodes text in the encoding known so far."""
+        if self._encoder_encoding != self.encoding:
+            self._encoder = codecs.getincrementalencoder(self.encoding)()
+            self._encoder_encoding = self.encoding
+        return self._encoder.encode(text, final)
+
+
+def _iter_lines(texts):
+    """
+    Inner function. Joins pieces of text and splits them into lines by
+    '\\n' symbols only, as the lines of a file are.
+    """
+    tail = u''
+    for text in texts:
+        if tail:
+            text = tail + text
+        end = text.rfind(u'\n') + 1
+        for line in _LINE_RE.findall(text, 0, end):
+            yield line
+        tail = text[end:]
+    if tail:
+        yield tail
+
+
+def _split_lines(text):
+    """
+    Inner function. Splits text into lines by '\\n' symbols only.
+
+    Returns a list of lines, the last one may have no line ending.
+    """
+    lines = _LINE_RE.findall(text)
+    end = text.rfind(u'\n') + 1
+    if end < len(text):
+        lines.append(text[end:])
+    return lines
+
+
+def iter_decoded_lines(src, encoding, head=''):
+    """
+    Reads a binary stream and decodes it into lines of text.
+
+    Arguments are:
+    * src -- binary file-like object to read from;
+    * encoding -- name of the stream encoding;
+    * head -- string of bytes already read from the stream ('' by default).
+
+    The stream is read by big chunks, which are decoded once with
+    an incremental decoder. Lines are splitted by '\\n' symbols only,
+    as the lines of a file are.
+    """
+    return _iter_lines(_iter_decoded_chunks(src, encoding, head))
+
+
+def _iter_paragraph_chunks(texts, chunk_size):
+    """
+    Inner function. Joins pieces of text into chunks of about chunk_size
+    symbols, which end at paragraph boundaries.
+
+    Formatter has no state left after a paragraph is finished, so
+    the chunks may be formatted independently.
+    """
+    buf = u''
+    search_start = chunk_size
+    for text in texts:
+        buf += text
+        while len(buf) >= chunk_size:
+            match = _PARAGRAPH_END_RE.search(buf, search_start)
+            if match is None:
+                # search only the new text next time
+                search_start = len(buf) - 1
+                break
+            end = match.end()
+            yield buf[:end]
+            buf = buf[end:]
+            search_start = chunk_size
+    if buf:
+        yield buf
+
+
+# options of the formatters in worker processes
+_worker_options = {}
+
+
+def _init_worker(options):
+    """Inner function. Saves formatter options in a worker process."""
+    _worker_options.update(options)
+
+
+def _format_chunk(text):
+    """Inner function. Formats a chunk of text in a worker process."""
+    formatter = Formatter(**_worker_options)
+    return u''.join(formatter.iter_format(_split_lines(text)))
+
+
+def format_parallel(src, dst, jobs, linesize=80, tabsize=4, engine='split',
+                    encoding=None, chunk_size=_PARALLEL_CHUNK_SIZE,
+                    breaking='greedy'):
+    """
+    Formats the whole text from one binary stream to another
+    in a pool of processes.
+
+    Arguments are:
+    * src -- binary file-like object to read the text from;
+    * dst -- binary file-like object to write formatted text to;
+    * jobs -- integer value, number of worker processes;
+    * linesize, tabsize, engine -- options of the formatters, see Formatter;
+    * encoding -- name of the text encoding (None by default, which means
+    the encoding is detected by the beginning of the text);
+    * chunk_size -- integer value, approximate size of a chunk of text
+    in symbols, given to a worker at once;
+    * breaking -- line breaking mode of the formatters, see Formatter.
+
+    The text is splitted into chunks at paragraph boundaries, each chunk
+    is formatted by its own Formatter, and formatted chunks are written
+    in order, so the result is the same as Formatter.format_file() gives.
+    Only a few chunks per worker are kept in memory at once.
+
+    Returns the name of the encoding.
+    """
+    stream = _DecodedStream(src, encoding)
+    options = {'linesize': linesize, 'tabsize': tabsize, 'engine': engine,
+               'breaking': breaking}
+
+    pool = multiprocessing.Pool(jobs, _init_worker, (options,))
+    try:
+        chunks = _iter_paragraph_chunks(stream.iter_chunks(), chunk_size)
+        pending = deque()
+        for chunk in chunks:
+            pending.append(pool.apply_async(_format_chunk, (chunk,)))
+            if len(pending) > 2 * jobs:
+                dst.write(stream.encode(pending.popleft().get()))
+        while pending:
+            dst.write(stream.encode(pending.popleft().get()))
+        dst.write(stream.encode(u'', final=True))
+    except:
+        pool.terminate()
+        raise
+    else:
+        pool.close()
+    finally:
+        pool.join()
+    return stream.encoding
+
+
+def _iter_batch_sources(sources):
+    """
+    Inner function. Yields pairs of a source file name and an output file
+    name relative to the output directory.
+
+    Sources may be directories (all files are taken recursively, with
+    relative names kept), glob patterns or manifest files, given as
+    '@file', listing one file name per line.
+    """
+    for source in sources:
+        if source.startswith('@'):
+            with open(source[1:]) as manifest:
+                for line in manifest:
+                    src_name = line.strip()
+                    if src_name and not src_name.startswith('#'):
+                        yield src_name, os.path.basename(src_name)
+        elif os.path.isdir(source):
+            for dirpath, dirnames, filenames in os.walk(source):
+                dirnames.sort()
+                for filename in sorted(filenames):
+                    src_name = os.path.join(dirpath, filename)
+                    yield src_name, os.path.relpath(src_name, source)
+        else:
+            # a name of a missing file fails later and is reported
+            for src_name in sorted(glob.glob(source)) or [source]:
+                yield src_name, os.path.basename(src_name)
+
+
+def _get_file_hash(name):
+    """Inner function. Returns sha1 hex digest of the file content."""
+    file_hash = hashlib.sha1()
+    with open(name, 'rb') as src:
+        for chunk in iter(partial(src.read, _READ_CHUNK_SIZE), ''):
+            file_hash.update(chunk)
+    return file_hash.hexdigest()
+
+
+def get_error_message(error):
+    """Returns the message of an exception as text."""
+    if isinstance(error, EnvironmentError) or len(error.args) != 1:
+        message = str(error)
+    else:
+        message = error.args[0]
+    if not isinstance(message, unicode):
+        message = message.decode('utf-8', 'replace')
+    return message
+
+
+def _format_batch_file(task, options=None):
+    """
+    Inner function. Formats one file of a batch in a worker process.
+
+    Arguments are:
+    * task -- tuple of source file name, output file name, encoding and
+    sha1 of the source formatted before (None if it should be formatted
+    anyway);
+    * options -- formatter options (options of the worker by default).
+
+    The output is written to a temporary file, which replaces the output
+    file on success, so no partial output is left on errors.
+    Returns a dict with the source and output names, status ('formatted',
+    'skipped' or 'failed'), source size, sha1, elapsed time and error.
+    """
+    src_name, dst_name, encoding, known_hash = task
+    if options is None:
+        options = _worker_options
+    result = {'src': src_name, 'dst': dst_name, 'status': 'formatted',
+              'bytes': 0, 'hash': None, 'seconds': 0.0, 'error': None}
+    tmp_name = dst_name + '.tmp'
+    started = timeit.default_timer()
+    try:
+        file_hash = _get_file_hash(src_name)
+        result['hash'] = file_hash
+        if file_hash == known_hash:
+            # source was touched, but not changed
+            os.utime(dst_name, None)
+            result['status'] = 'skipped'
+            return result
+
+        dst_dir = os.path.dirname(dst_name)
+        if dst_dir and not os.path.isdir(dst_dir):
+            try:
+                os.makedirs(dst_dir)
+            except OSError:
+                # may be created by another worker
+                if not os.path.isdir(dst_dir):
+                    raise
+        with open(src_name, 'rb') as src:
+            with open(tmp_name, 'wb') as dst:
+                Formatter(**options).format_file(src, dst, encoding)
+        os.rename(tmp_name, dst_name)
+        result['bytes'] = os.path.getsize(src_name)
+    except (ValueError, LookupError, EnvironmentError) as e:
+        result['status'] = 'failed'
+        result['error'] = get_error_message(e)
+        if os.path.exists(tmp_name):
+            os.remove(tmp_name)
+    finally:
+        result['seconds'] = timeit.default_timer() - started
+    return result
+
+
+def format_batch(sources, out_dir, jobs=1, linesize=80, tabsize=4,
+                 engine='split', encoding=None, force=False,
+                 breaking='greedy'):
+    """
+    Formats many files into a directory in a pool of processes.
+
+    Arguments are:
+    * sources -- list of directories, glob patterns or '@manifest' files
+    (a manifest lists one file name per line);
+    * out_dir -- name of the output directory, files from a directory keep
+    their relative names, other files keep their base names;
+    * jobs -- integer value, number of worker processes (1 by default,
+    which means formatting in the current process);
+    * linesize, tabsize, engine -- options of the formatters, see Formatter;
+    * encoding -- name of the files encoding (None by default, which means
+    the encoding of each file is detected);
+    * force -- boolean value, if True - format files even if their output
+    is up to date (False by default);
+    * breaking -- line breaking mode of the formatters, see Formatter.
+
+    Output is up to date if it was formatted by a previous batch with the
+    same options, and it is newer than the source or the source content is
+    not changed. Hashes of sources are recorded in a state file in the output
+    directory. Failed files do not stop the batch.
+
+    Returns a dict of summary: numbers of files, formatted, skipped and
+    failed ones, size of formatted sources, elapsed time, throughput and
+    a list of failures.
+    """
+    started = timeit.default_timer()
+    options = {'linesize': linesize, 'tabsize': tabsize, 'engine': engine,
+               'breaking': breaking}
+    state_options = dict(options, encoding=encoding)
+    state_name = os.path.join(out_dir, _BATCH_STATE_FILE)
+    known_hashes = {}
+    if not force and os.path.exists(state_name):
+        with open(state_name) as src:
+            state = json.load(src)
+        if state['options'] == state_options:
+            known_hashes = state['files']
+
+    summary = {'files': 0, 'formatted': 0, 'skipped': 0, 'failed': 0,
+               'bytes': 0, 'failures': []}
+    hashes = {}
+    tasks = []
+    for src_name, dst_relname in _iter_batch_sources(sources):
+        summary['files'] += 1
+        if dst_relname in hashes:
+            summary['failed'] += 1
+            summary['failures'].append({
+                'src': src_name,
+                'error': u"Output name '%s' is not unique!" % dst_relname})
+            continue
+        hashes[dst_relname] = None
+        dst_name = os.path.join(out_dir, dst_relname)
+        known_hash = known_hashes.get(dst_relname)
+        if known_hash is not None and os.path.exists(dst_name):
+            try:
+                is_newer = (os.path.getmtime(dst_name)
+                            >= os.path.getmtime(src_name))
+            except OSError:
+                is_newer = False
+            if is_newer:
+                summary['skipped'] += 1
+                hashes[dst_relname] = known_hash
+                continue
+        else:
+            known_hash = None
+        tasks.append((src_name, dst_name, encoding, known_hash))
+
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+    pool = None
+    if jobs > 1 and len(tasks) > 1:
+        pool = multiprocessing.Pool(jobs, _init_worker, (options,))
+        results = pool.imap_unordered(_format_batch_file, tasks, 16)
+    else:
+        results = imap(partial(_format_batch_file, options=options), tasks)
+    try:
+        for result in results:
+            dst_relname = os.path.relpath(result['dst'], out_dir)
+            summary[result['status']] += 1
+            summary['bytes'] += result['bytes']
+            if result['error'] is None:
+                hashes[dst_relname] = result['hash']
+            else:
+                summary['failures'].append({'src': result['src'],
+                                            'error': result['error']})
+    except:
+        if pool is not None:
+            pool.terminate()
+        raise
+    else:
+        if pool is not None:
+            pool.close()
+    finally:
+        if pool is not None:
+            pool.join()
+
+    files = dict((name, file_hash) for name, file_hash in hashes.items()
+                 if file_hash is not None)
+    with open(state_name + '.tmp', 'w') as dst:
+        json.dump({'options': state_options, 'files': files}, dst)
+    os.rename(state_name + '.tmp', state_name)
+
+    summary['seconds'] = timeit.default_timer() - started
+    summary['mb_per_s'] = summary['bytes'] / 1024.0 ** 2 / summary['seconds']
+    summary['files_per_s'] = summary['formatted'] / summary['seconds']
+    return summary
+
 
 class Formatter(object):
 
@@ -21,7 +915,17 @@ class Formatter(object):
     Use get_lines(flush=True) to force building of non finished lines.
     """
 
-    def __init__(self, linesize=80, tabsize=4):
+    # parsing engine name -> name of the method that implements it
+    _engines = {
+        'scan': '_parse_line_scan',
+        'split': '_parse_line_split',
+    }
+
+    # line breaking modes
+    _breakings = ('greedy', 'optimal')
+
+    def __init__(self, linesize=80, tabsize=4, engine='scan', stats=False,
+                 breaking='greedy'):
         """
         Instance constructor.
 
@@ -30,8 +934,25 @@ class Formatter(object):
         * linesize -- integer value, defines maximum of formatted text width
         in symbols (80 by default);
         * tabsize -- integer value, defines tabulation size for first line of
-        each paragraph (4 by default).
+        each paragraph (4 by default);
+        * engine -- string value, defines the parsing engine: 'scan' walks
+        the line symbol by symbol, 'split' collects words and their lengths
+        with regular expressions (both give the same result, 'scan' by
+        default);
+        * stats -- boolean value, if True - collect counters and timings,
+        see stats() (False by default, disabled statistics costs nothing);
+        * breaking -- string value, defines how paragraphs are broken into
+        lines: 'greedy' fills each line with as many words as it can,
+        'optimal' minimizes the sum of squared free spaces at the ends of
+        all lines of a paragraph but the last one (needs the 'split' engine,
+        'greedy' by default).
         """
+        if engine not in self._engines:
+            raise ValueError("Unknown parsing engine '%s'!" % engine)
+        if breaking not in self._breakings:
+            raise ValueError("Unknown line breaking mode '%s'!" % breaking)
+        if breaking == 'optimal' and engine != 'split':
+            raise ValueError("Optimal line breaking needs the split engine!")
         if tabsize < 0:
             raise ValueError("Size of tab must be non-zero!")
         if linesize < 0:
@@ -47,9 +968,78 @@ class Formatter(object):
         self._draft_line = []
         self._draft_line_size = self._tabsize
         self._ready_lines = []
-        self._paragraph_endings = ['.', '!', '?', ':']
+        self._paragraph_endings = _PARAGRAPH_ENDINGS
         self.utf8_detected = False
         self.non_utf8_detected = False
+        self._parse_line = getattr(self, self._engines[engine])
+        self._breaking = breaking
+        if breaking == 'optimal':
+            # whole paragraph is cached and broken into lines when it ends
+            self._draft_word_lengths = []
+            self._push_words = self._push_words_optimal
+            self._flush = self._flush_optimal
+        self._justification_table = _get_justification_table(linesize)
+        self._stats = None
+        if stats:
+            self._stats = FormatterStats()
+            self._instrument()
+
+    def _instrument(self):
+        """
+        Inner method. Replaces inner methods of the instance with ones
+        collecting statistics.
+        """
+        stats = self._stats
+        counters = stats.counters
+        parse_line = self._parse_line
+        build_justified_ready_line = self._build_justified_ready_line
+        build_ready_line = self._build_ready_line
+        flush = self._flush
+
+        def instrumented_parse_line(raw_line):
+            counters['lines'] += 1
+            counters['chars'] += len(raw_line)
+            try:
+                stats.timed('parse', parse_line, raw_line)
+            except ValueError:
+                counters['too_long_words'] += 1
+                raise
+
+        def instrumented_build_justified_ready_line():
+            counters['justified_lines'] += 1
+            counters['words'] += len(self._draft_line)
+            stats.timed('justify', build_justified_ready_line)
+
+        def instrumented_build_ready_line():
+            if self._is_new_paragraph:
+                # one line paragraph shorter than a half of line
+                counters['header_lines'] += 1
+            else:
+                counters['plain_lines'] += 1
+            counters['words'] += len(self._draft_line)
+            stats.timed('build', build_ready_line)
+
+        def instrumented_flush():
+            if self._draft_line:
+                counters['flushes'] += 1
+            stats.timed('flush', flush)
+
+        self._parse_line = instrumented_parse_line
+        self._build_justified_ready_line = (
+            instrumented_build_justified_ready_line)
+        self._build_ready_line = instrumented_build_ready_line
+        self._flush = instrumented_flush
+
+    def stats(self):
+        """
+        Get collected statistics.
+
+        Returns None if statistics is disabled, or a dict of counters and
+        stages timings (see FormatterStats.as_dict()).
+        """
+        if self._stats is None:
+            return None
+        return self._stats.as_dict()
 
     def _get_utf8_symbol_length(self, raw_line, cursor):
         """
@@ -115,26 +1105,47 @@ class Formatter(object):
         and stores it at the inner storage.
         It stores the words of non-ended text lines between it's calls.
         """
+        self._parse_line(raw_line)
+
+    def _parse_line_scan(self, raw_line):
+        """Inner method. Parses input raw line symbol by symbol."""
         raw_line_len = len(raw_line)  # in bytes
+        is_text = isinstance(raw_line, unicode)  # has no multibyte symbols
         raw_line_is_empty = True  # have not found non-space symbol yet
         in_word = False  # current parser state
         cursor = 0  # points to the first byte of current symbol
         word_start = 0  # points to the first byte of the word's first symbol
         word_len = 0  # word length in symbols (not bytes)
         num_of_words = len(self._draft_line)  # use it to reduce calls to len()
+        # words of wide or zero width symbols are measured at their ends
+        text = None
+        if is_text:
+            text = raw_line
+        elif not self.non_utf8_detected and _NON_ASCII_RE.search(raw_line):
+            try:
+                text = raw_line.decode('utf-8')
+            except UnicodeDecodeError:
+                pass
+        measure_words = (text is not None
+                         and _WIDTH_CHECK_RE.search(text) is not None)
 
         while cursor < raw_line_len:
             symbol = raw_line[cursor]
-            if self.non_utf8_detected or symbol < 'x\80':
+            if is_text or self.non_utf8_detected or symbol < '\x80':
                 symbol_len = 1
             else:
                 # detect multibyte utf-8 symbol on the fly
                 symbol_len = self._get_utf8_symbol_length(raw_line, cursor)
 
             if in_word:
-                if symbol.isspace():
+                if symbol in _SPACES:
                     in_word = False
                     word_end = cursor
+                    if measure_words:
+                        word = raw_line[word_start:word_end]
+                        if not is_text:
+                            word = word.decode('utf-8')
+                        word_len = get_text_width(word)
                     if num_of_words > 1:
                         if ((self._draft_line_size + word_len + num_of_words)
                                 > self._linesize):
@@ -142,7 +1153,7 @@ class Formatter(object):
                             # build new line with previously cached words
                             self._build_justified_ready_line()
                             self._is_new_paragraph = False
-                            self._draft_line = []
+                            del self._draft_line[:]
                             self._draft_line_size = 0
                             num_of_words = 0
 
@@ -158,7 +1169,7 @@ class Formatter(object):
                 else:
                     word_len += 1
             else:
-                if not symbol.isspace():
+                if symbol not in _SPACES:
                     raw_line_is_empty = False
                     word_start = cursor
                     word_len = 1
@@ -173,6 +1184,224 @@ class Formatter(object):
                 # as a last symbol of the last cached word.
                 self._flush()
 
+    def _parse_line_split(self, raw_line):
+        """
+        Inner method. Parses input raw line with regular expressions.
+
+        Words and their lengths are collected for the whole line at once.
+        Lengths are display widths (see get_text_width()), a line of latin,
+        greek and cyrillic letters is checked once and its words are
+        measured by their lengths.
+        Lines of non-ascii bytes are decoded as utf-8 to count the symbols,
+        a line that is not valid utf-8 is passed to the scanning engine,
+        so both engines detect the encoding the same way.
+        """
+        if isinstance(raw_line, unicode):
+            words = _UNICODE_WORD_RE.findall(raw_line)
+            if _WIDTH_CHECK_RE.search(raw_line):
+                word_lengths = map(get_text_width, words)
+            else:
+                word_lengths = map(len, words)
+        else:
+            words = _WORD_RE.findall(raw_line)
+            if self.non_utf8_detected or not _NON_ASCII_RE.search(raw_line):
+                word_lengths = map(len, words)
+            else:
+                try:
+                    text = raw_line.decode('utf-8')
+                except UnicodeDecodeError:
+                    if self._breaking == 'greedy':
+                        self._parse_line_scan(raw_line)
+                        return
+                    # the scanning engine breaks lines greedily,
+                    # so count bytes as symbols here
+                    self.non_utf8_detected = True
+                    word_lengths = map(len, words)
+                else:
+                    self.utf8_detected = True
+                    # the pattern splits decoded text by the same ascii
+                    # spaces
+                    if _WIDTH_CHECK_RE.search(text):
+                        word_lengths = map(get_text_width,
+                                           _WORD_RE.findall(text))
+                    else:
+                        word_lengths = map(len, _WORD_RE.findall(text))
+
+        self._push_words(words, word_lengths)
+
+        if self._draft_line:
+            if (self._draft_line[-1][-1] in self._paragraph_endings
+                    or not (words or raw_line.strip(_SPACES))):
+                # force building of a new line if got paragraph ending sign
+                # as a last symbol of the last cached word.
+                self._flush()
+
+    def _push_words(self, words, word_lengths):
+        """
+        Inner method. Adds parsed words to the cache.
+
+        Arguments are:
+        * words -- list of words to add;
+        * word_lengths -- list of the words lengths in symbols.
+
+        Builds new justified lines when cached words don't fit to the line.
+        """
+        draft_line = self._draft_line
+        draft_line_size = self._draft_line_size
+        linesize = self._linesize
+        num_of_words = len(draft_line)
+        for word, word_len in izip(words, word_lengths):
+            if num_of_words > 1:
+                if draft_line_size + word_len + num_of_words > linesize:
+                    # new word doesn't fit,
+                    # build new line with previously cached words
+                    self._draft_line_size = draft_line_size
+                    self._build_justified_ready_line()
+                    self._is_new_paragraph = False
+                    del draft_line[:]
+                    draft_line_size = 0
+                    num_of_words = 0
+
+            elif draft_line_size + word_len > linesize:
+                # new word doesn't fit to the empty line
+                self._draft_line_size = draft_line_size
+                raise ValueError("Word '%s' is too long!" % word)
+
+            # add new word to the cache
+            draft_line.append(word)
+            draft_line_size += word_len
+            num_of_words += 1
+        self._draft_line_size = draft_line_size
+
+    def _push_words_optimal(self, words, word_lengths):
+        """
+        Inner method. Adds parsed words to the cache of the paragraph.
+
+        Arguments are:
+        * words -- list of words to add;
+        * word_lengths -- list of the words lengths in symbols.
+
+        Used instead of _push_words() with the optimal line breaking, lines
+        are built when the paragraph ends.
+        """
+        draft_line = self._draft_line
+        draft_word_lengths = self._draft_word_lengths
+        draft_line_size = self._draft_line_size
+        linesize = self._linesize
+        for word, word_len in izip(words, word_lengths):
+            if word_len > linesize or (
+                    not draft_line and draft_line_size + word_len > linesize):
+                # new word doesn't fit to the empty line
+                self._draft_line_size = draft_line_size
+                raise ValueError("Word '%s' is too long!" % word)
+            draft_line.append(word)
+            draft_word_lengths.append(word_len)
+            draft_line_size += word_len
+        self._draft_line_size = draft_line_size
+
+    def _get_optimal_line_ends(self):
+        """
+        Inner method. Finds the optimal breaking of the cached paragraph.
+
+        Returns list of integer values - indexes of the words following
+        the last word of each line.
+
+        A line costs the square of its free space, the last line costs
+        nothing. Prefix sums of the words lengths give the width of any line
+        at once, and only lines that fit are tried, so it takes
+        O(number of words * words per line) steps at most.
+        """
+        linesize = self._linesize
+        draft_word_lengths = self._draft_word_lengths
+        num_of_words = len(draft_word_lengths)
+        # width of the words before the word i with a space after each one
+        # is ends[i], so the line of the words i..j-1 has free space
+        # starts[i] - ends[j] (it is negative if the line doesn't fit)
+        ends = [0] * (num_of_words + 1)
+        size = 0
+        for i, word_len in enumerate(draft_word_lengths, 1):
+            size += word_len + 1
+            ends[i] = size
+        starts = [linesize + 1 + end for end in ends]
+        starts[0] -= self._tabsize
+        # minimal cost of the lines before the word j and the first word
+        # of the last of them
+        costs = [0] * num_of_words
+        line_starts = [0] * num_of_words
+        # the first word of the longest line that fits, it only moves forward
+        first = 0
+        for j in xrange(1, num_of_words):
+            end = ends[j]
+            while starts[first] < end:
+                first += 1
+            free_space = starts[first] - end
+            best_cost = costs[first] + free_space * free_space
+            best_start = first
+            # shorter lines have more free space, stop when its cost alone
+            # is not less than the best one
+            for i in xrange(first + 1, j):
+                free_space = starts[i] - end
+                cost = free_space * free_space
+                if cost >= best_cost:
+                    break
+                cost += costs[i]
+                if cost < best_cost:
+                    best_cost = cost
+                    best_start = i
+            costs[j] = best_cost
+            line_starts[j] = best_start
+
+        # the last line costs nothing
+        end = ends[num_of_words]
+        while starts[first] < end:
+            first += 1
+        best_start = min(xrange(first, num_of_words), key=costs.__getitem__)
+
+        line_ends = [num_of_words]
+        j = best_start
+        while j > 0:
+            line_ends.append(j)
+            j = line_starts[j]
+        line_ends.reverse()
+        return line_ends
+
+    def _flush_optimal(self):
+        """
+        Inner method. Builds lines of the cached paragraph with the optimal
+        line breaking.
+
+        Used instead of _flush(), a paragraph that fits to one line is
+        built the same way.
+        """
+        draft_line = self._draft_line
+        draft_word_lengths = self._draft_word_lengths
+        num_of_words = len(draft_line)
+        if self._draft_line_size + num_of_words - 1 <= self._linesize:
+            del draft_word_lengths[:]
+            Formatter._flush(self)
+            return
+
+        start = 0
+        draft_line_size = self._tabsize
+        for end in self._get_optimal_line_ends():
+            self._draft_line = draft_line[start:end]
+            self._draft_line_size = (
+                draft_line_size + sum(draft_word_lengths[start:end]))
+            if end < num_of_words:
+                self._build_justified_ready_line()
+            else:
+                # last line of a paragraph
+                self._build_ready_line()
+            self._is_new_paragraph = False
+            draft_line_size = 0
+            start = end
+
+        self._draft_line = draft_line
+        self._is_new_paragraph = True
+        del draft_line[:]
+        del draft_word_lengths[:]
+        self._draft_line_size = self._tabsize
+
     def _flush(self):
         """
         Inner method to force the building of a new line from cached words.
@@ -197,46 +1426,34 @@ class Formatter(object):
                     self._build_ready_line()
 
             self._is_new_paragraph = True
-            self._draft_line = []
+            del self._draft_line[:]
             self._draft_line_size = self._tabsize
 
     def _build_justified_ready_line(self):
         """Inner method. Builds new justified line of text."""
-        num_of_words = len(self._draft_line)
+        draft_line = self._draft_line
+        num_of_words = len(draft_line)
+        if self._is_new_paragraph:
+            tab = self._tab
+        else:
+            tab = ''
         if num_of_words > 1:
-            # calculate how many spaces should be inserted per word boundary
-            num_of_spaces = num_of_words - 1
-            spaces_left = self._linesize - self._draft_line_size
-            spaces = ' ' * (spaces_left/num_of_spaces)  # cache space item
-            extra_spaces = spaces + ' '  # cache long space item
-            # get position, from where long space items should be inserted
-            extra_spaces_after = num_of_spaces - spaces_left % num_of_spaces
-            if self._is_new_paragraph:
-                new_line = [self._tab]
+            # get space items and position, from where long space items
+            # should be inserted
+            spaces, extra_spaces, split = self._justification_table[
+                num_of_words][self._linesize - self._draft_line_size]
+            if split < num_of_words:
+                # join words before and after the first long space item
+                # with regular and long space items separately
+                new_line = (tab, spaces.join(draft_line[:split]), extra_spaces,
+                            extra_spaces.join(draft_line[split:]), '\n')
             else:
-                new_line = []
-            space_no = 1
-            for word in self._draft_line:
-                new_line.append(word)
-                if space_no < num_of_words:
-                    # insert space item only between words
-                    if space_no > extra_spaces_after:
-                        # insert long space item
-                        new_line.append(extra_spaces)
-                    else:
-                        # insert regular space item
-                        new_line.append(spaces)
-                space_no += 1
-            new_line.append('\n')
+                new_line = (tab, spaces.join(draft_line), '\n')
             self._ready_lines.append(''.join(new_line))
 
         elif num_of_words == 1:
             # build new line of one word, no spaces
-            if self._is_new_paragraph:
-                new_line = [self._tab, self._draft_line[0], '\n']
-            else:
-                new_line = [self._draft_line[0], '\n']
-            self._ready_lines.append(''.join(new_line))
+            self._ready_lines.append(''.join((tab, draft_line[0], '\n')))
 
     def _build_ready_line(self):
         """Inner method. Builds new line of text (no justification)."""
@@ -247,11 +1464,167 @@ class Formatter(object):
             else:
                 inner = self._draft_line[0]
             if self._is_new_paragraph:
-                new_line = [self._tab, inner, '\n']
+                new_line = (self._tab, inner, '\n')
             else:
-                new_line = [inner, '\n']
+                new_line = (inner, '\n')
             self._ready_lines.append(''.join(new_line))
 
+    def format_file(self, src, dst, encoding=None):
+        """
+        Formats the whole text from one binary stream to another.
+
+        Arguments are:
+        * src -- binary file-like object to read the text from;
+        * dst -- binary file-like object to write formatted text to;
+        * encoding -- name of the text encoding (None by default, which means
+        the encoding is detected by the beginning of the text).
+
+        The text is decoded once, so the formatter parses text lines only.
+        Formatted text is written in the same encoding.
+
+        Returns the name of the encoding.
+        """
+        detect = detect_encoding
+        if self._stats is not None:
+            detect = partial(self._stats.timed, 'detect', detect_encoding)
+        stream = _DecodedStream(src, encoding, detect)
+
+        lines = _iter_lines(stream.iter_chunks())
+        for batch in self._iter_batches(lines):
+            dst.write(stream.encode(batch))
+        dst.write(stream.encode(u'', final=True))
+        return stream.encoding
+
+    def format_mapped(self, src, dst, encoding=None):
+        """
+        Formats the whole text of a file mapped to memory.
+
+        Arguments are:
+        * src -- file object to read the text from, opened in binary mode;
+        * dst -- binary file-like object to write formatted text to;
+        * encoding -- name of the text encoding (None by default, which means
+        the encoding is detected by the beginning of the text).
+
+        The file is scanned by blocks ending between words, each block is
+        decoded once and its words are collected paragraph by paragraph with
+        no line objects. Formatted lines are written once per block.
+        The result is the same as format_file() gives. Files, which can not
+        be mapped (e.g. empty ones or pipes), or encodings, where ascii
+        symbols take more then one byte, are formatted with format_file().
+
+        Returns the name of the encoding.
+        """
+        size = os.fstat(src.fileno()).st_size
+        if not size:
+            return self.format_file(src, dst, encoding)
+        if encoding is None:
+            encoding = _detect_mapped_encoding(src.fileno(), size)
+        if not _is_ascii_compatible(encoding):
+            return self.format_file(src, dst, encoding)
+
+        decoder = codecs.getincrementaldecoder(encoding)()
+        encoder = codecs.getincrementalencoder(encoding)()
+        blocks = _iter_mapped_blocks(src.fileno(), size)
+        try:
+            at_line_start = True
+            for block in blocks:
+                self._push_block(decoder.decode(block), at_line_start)
+                dst.write(encoder.encode(u''.join(self.get_lines())))
+                at_line_start = block[-1] == '\n'
+        finally:
+            blocks.close()
+        self._push_block(decoder.decode('', final=True), at_line_start)
+        dst.write(encoder.encode(u''.join(self.get_lines(flush=True)),
+                                 final=True))
+        return encoding
+
+    def _push_block(self, text, at_line_start):
+        """
+        Inner method. Parses a block of text of many lines.
+
+        Arguments are:
+        * text -- decoded text, it ends with a line end or a space before
+        a word;
+        * at_line_start -- boolean value, True if the text starts with a new
+        line.
+
+        Words of each paragraph are added to the cache at once, and
+        the paragraph is flushed. Words of the last unfinished paragraph stay
+        in the cache.
+        """
+        if self._stats is not None:
+            self._stats.counters['lines'] += text.count(u'\n')
+            self._stats.counters['chars'] += len(text)
+        if at_line_start and _EMPTY_LINE_RE.match(text):
+            # empty line after the previous block finishes a paragraph
+            self._flush()
+        if _WIDTH_CHECK_RE.search(text):
+            get_lengths = partial(map, get_text_width)
+        else:
+            get_lengths = partial(map, len)
+        find_words = _UNICODE_WORD_RE.findall
+        start = 0
+        for match in _PARAGRAPH_END_RE.finditer(text):
+            end = match.end()
+            words = find_words(text, start, end)
+            self._push_words(words, get_lengths(words))
+            self._flush()
+            start = end
+        words = find_words(text, start)
+        self._push_words(words, get_lengths(words))
+
+    def format_stream(self, src, dst):
+        """
+        Formats the whole text from one stream to another.
+
+        Arguments are:
+        * src -- iterable of text lines (e.g. a file opened for reading);
+        * dst -- file-like object to write formatted text to.
+
+        Formatted lines are written by big batches.
+        """
+        for batch in self._iter_batches(src):
+            dst.write(batch)
+
+    def _iter_batches(self, lines):
+        """
+        Inner method. Formats lines and joins formatted ones in big batches.
+
+        Yields strings of up to _WRITE_BATCH_LINES formatted lines.
+        """
+        out_lines = self.iter_format(lines)
+        while True:
+            batch = list(islice(out_lines, _WRITE_BATCH_LINES))
+            if not batch:
+                break
+            yield ''.join(batch)
+
+    def iter_format(self, lines):
+        """
+        Formats lines of text lazily.
+
+        Method has one positional argument:
+        * lines -- iterable of input lines to parse.
+
+        Yields formatted lines as soon as they are built, the last
+        unfinished line is built at the end of the input. Only the words of
+        the current line are kept in memory between input lines.
+        """
+        parse_line = self.parse_line
+        for line in lines:
+            parse_line(line)
+            ready_lines = self._ready_lines
+            if ready_lines:
+                for out_line in ready_lines:
+                    yield out_line
+                del ready_lines[:]
+
+        self._flush()
+        ready_lines = self._ready_lines
+        for out_line in ready_lines:
+            yield out_line
+        del ready_lines[:]
+
     def get_lines(self, flush=False):
         """
         Get ready formatted lines fron inner storage,
@@ -273,28 +1646,299 @@ class Formatter(object):
         return new_lines
 
 
+class ParsedDocument(object):
+
+    """
+    This class keeps a text parsed into paragraphs of words.
+
+    Parsing is done once, at the instance initialization, and the text
+    may be formatted to many line sizes after that, each formatting only
+    splits the paragraphs into lines and justifies them.
+    It has 2 public methods:
+    * render() -- gets formatted lines of text of one line size;
+    * render_many() -- gets formatted lines of text of many line sizes
+    at once.
+    The result is the same as Formatter gives for the same text.
+    """
+
+    def __init__(self, lines):
+        """
+        Instance constructor.
+
+        Method has one positional argument:
+        * lines -- iterable of input lines to parse, lines should be decoded
+        (use from_file() to read a text from a binary stream).
+        """
+        words = []
+        word_lengths = array('l')
+        paragraph_ends = array('l')  # indexes after the paragraphs words
+        num_of_words = 0
+        paragraph_start = 0
+        for line in lines:
+            if isinstance(line, unicode):
+                line_words = _UNICODE_WORD_RE.findall(line)
+            else:
+                line_words = _WORD_RE.findall(line)
+            if line_words:
+                words.extend(line_words)
+                if _WIDTH_CHECK_RE.search(line):
+                    word_lengths.extend(map(get_text_width, line_words))
+                else:
+                    word_lengths.extend(map(len, line_words))
+                num_of_words += len(line_words)
+            if num_of_words > paragraph_start:
+                if (words[-1][-1] in _PARAGRAPH_ENDINGS
+                        or not (line_words or line.strip(_SPACES))):
+                    # paragraph is finished the same way Formatter does it
+                    paragraph_ends.append(num_of_words)
+                    paragraph_start = num_of_words
+        if num_of_words > paragraph_start:
+            paragraph_ends.append(num_of_words)
+
+        self._words = words
+        self._word_lengths = word_lengths
+        self._paragraph_ends = paragraph_ends
+
+    @classmethod
+    def from_file(cls, src, encoding=None):
+        """
+        Parses the whole text from a binary stream.
+
+        Arguments are:
+        * src -- binary file-like object to read the text from;
+        * encoding -- name of the text encoding (None by default, which means
+        the encoding is detected by the beginning of the text).
+
+        Returns new ParsedDocument instance.
+        """
+        stream = _DecodedStream(src, encoding)
+        return cls(_iter_lines(stream.iter_chunks()))
+
+    def render(self, linesize=80, tabsize=4):
+        """
+        Formats the text.
+
+        Arguments are the same as of Formatter:
+        * linesize -- integer value, maximum of formatted text width
+        in symbols (80 by default);
+        * tabsize -- integer value, tabulation size for first line of
+        each paragraph (4 by default).
+
+        Returns a list of formatted lines.
+        """
+        return self.render_many([linesize], tabsize)[linesize]
+
+    def render_many(self, linesizes, tabsize=4):
+        """
+        Formats the text to many line sizes in one pass over paragraphs.
+
+        Arguments are:
+        * linesizes -- iterable of integer values, line sizes to format to;
+        * tabsize -- integer value, tabulation size for first line of
+        each paragraph (4 by default).
+
+        Returns a dict of line size -> list of formatted lines.
+        """
+        formatters = [Formatter(linesize, tabsize) for linesize in linesizes]
+        words = self._words
+        word_lengths = self._word_lengths
+        paragraph_start = 0
+        for paragraph_end in self._paragraph_ends:
+            paragraph_words = words[paragraph_start:paragraph_end]
+            paragraph_word_lengths = (
+                word_lengths[paragraph_start:paragraph_end])
+            for formatter in formatters:
+                formatter._push_words(paragraph_words, paragraph_word_lengths)
+                formatter._flush()
+            paragraph_start = paragraph_end
+        return dict((formatter._linesize, formatter.get_lines())
+                    for formatter in formatters)
+
+
+class IncrementalFormatter(object):
+
+    """
+    This class formats versions of a text, reformatting changed paragraphs
+    only.
+
+    It keeps an index of paragraphs of the last formatted version: a hash of
+    each paragraph content and its formatted text for every line size and
+    tab size it was formatted to. Paragraphs of a new version, which are
+    found in the index, are not parsed and formatted again.
+    It has 1 public method:
+    * format() -- gets the whole text and returns the whole formatted text.
+    After each call attributes formatted_paragraphs and reused_paragraphs
+    contain the numbers of paragraphs formatted and taken from the index.
+    """
+
+    def __init__(self):
+        """Instance constructor."""
+        self._index = {}
+        self._formatters = {}
+        self.formatted_paragraphs = 0
+        self.reused_paragraphs = 0
+
+    def _get_paragraph_key(self, paragraph):
+        """Inner method. Returns a hash of the paragraph content."""
+        if isinstance(paragraph, unicode):
+            paragraph = paragraph.encode('utf-8')
+        return hashlib.sha1(paragraph).digest()
+
+    def _iter_paragraphs(self, text):
+        """
+        Inner method. Splits text into paragraphs at lines finishing them,
+        so each paragraph may be formatted independently.
+        """
+        start = 0
+        for match in _PARAGRAPH_END_RE.finditer(text):
+            end = match.end()
+            yield text[start:end]
+            start = end
+        if start < len(text):
+            yield text[start:]
+
+    def format(self, text, linesize=80, tabsize=4):
+        """
+        Formats the text.
+
+        Arguments are:
+        * text -- the whole text of the current version, decoded;
+        * linesize -- integer value, maximum of formatted text width
+        in symbols (80 by default);
+        * tabsize -- integer value, tabulation size for first line of
+        each paragraph (4 by default).
+
+        Returns the whole formatted text. Paragraphs, which are absent in
+        the text, are removed from the index.
+        """
+        options = (linesize, tabsize)
+        formatter = self._formatters.get(options)
+        if formatter is None:
+            formatter = Formatter(linesize, tabsize, engine='split')
+            self._formatters[options] = formatter
+
+        old_index = self._index
+        index = {}
+        formatted_paragraphs = 0
+        out = []
+        for paragraph in self._iter_paragraphs(text):
+            key = self._get_paragraph_key(paragraph)
+            outputs = index.get(key)
+            if outputs is None:
+                outputs = old_index.get(key)
+                if outputs is None:
+                    outputs = {}
+                index[key] = outputs
+            out_paragraph = outputs.get(options)
+            if out_paragraph is None:
+                lines = formatter.iter_format(_split_lines(paragraph))
+                try:
+                    out_paragraph = ''.join(lines)
+                except Exception:
+                    # the formatter keeps words of the failed paragraph,
+                    # a new one is made for the next call
+                    del self._formatters[options]
+                    raise
+                outputs[options] = out_paragraph
+                formatted_paragraphs += 1
+            out.append(out_paragraph)
+
+        self._index = index
+        self.formatted_paragraphs = formatted_paragraphs
+        self.reused_paragraphs = len(out) - formatted_paragraphs
+        return ''.join(out)
+
+
 if __name__ == '__main__':
 
     import argparse
+    import sys
 
     parser = argparse.ArgumentParser()
-    parser.add_argument("src", help="source file name")
-    parser.add_argument("dst", help="output file name")
+    parser.add_argument("src", nargs='?', help="source file name")
+    parser.add_argument("dst", nargs='?', help="output file name")
+    parser.add_argument("-w", "--linesize", type=int, default=80,
+                        help="maximum line width in symbols (80 by default)")
+    parser.add_argument("-t", "--tabsize", type=int, default=4,
+                        help="first line indent in symbols (4 by default)")
+    parser.add_argument("-e", "--engine", default='split',
+                        choices=sorted(Formatter._engines),
+                        help="parsing engine ('split' by default)")
+    parser.add_argument("-b", "--breaking", default='greedy',
+                        choices=Formatter._breakings,
+                        help="line breaking mode ('greedy' by default, "
+                        "'optimal' needs the 'split' engine)")
+    parser.add_argument("--encoding",
+                        help="source file encoding (detected by default)")
+    parser.add_argument("-j", "--jobs", type=int,
+                        help="number of worker processes (1 by default, "
+                        "number of CPUs in batch mode)")
+    parser.add_argument("--stats", action='store_true',
+                        help="print formatting statistics at the end")
+    parser.add_argument("--mmap", action='store_true',
+                        help="read the source file mapped to memory")
+    parser.add_argument("--batch", nargs='+', metavar='SOURCE',
+                        help="format directories, glob patterns or "
+                        "@manifest files into --out-dir instead of src")
+    parser.add_argument("--out-dir", help="output directory of batch mode")
+    parser.add_argument("--force", action='store_true',
+                        help="format up to date files in batch mode")
+    parser.add_argument("--summary",
+                        help="file to write JSON summary of batch mode to")
     args = parser.parse_args()
+    if args.breaking == 'optimal' and args.engine != 'split':
+        parser.error("optimal line breaking needs the split engine")
 
-    with open(args.src, 'r') as src:
+    if args.batch:
+        if args.src or args.dst or not args.out_dir:
+            parser.error("batch mode needs --out-dir and no src and dst")
+        if args.stats:
+            parser.error("--stats is not supported in batch mode")
+        summary = format_batch(
+            args.batch, args.out_dir,
+            jobs=args.jobs or multiprocessing.cpu_count(),
+            linesize=args.linesize, tabsize=args.tabsize,
+            engine=args.engine, encoding=args.encoding, force=args.force,
+            breaking=args.breaking)
+        for failure in summary['failures']:
+            sys.stderr.write((u"%(src)s: %(error)s\n" % failure)
+                             .encode('utf-8'))
+        print("Files: %(files)d, formatted: %(formatted)d, "
+              "skipped: %(skipped)d, failed: %(failed)d; "
+              "%(seconds).2f s, %(mb_per_s).2f MB/s, "
+              "%(files_per_s).1f files/s" % summary)
+        if args.summary:
+            with open(args.summary, 'w') as dst:
+                json.dump(summary, dst, indent=1, sort_keys=True)
+        sys.exit(1 if summary['failed'] else 0)
 
-        with open(args.dst, 'w') as dst:
+    if not (args.src and args.dst):
+        parser.error("src and dst are required")
+    args.jobs = args.jobs or 1
+    if args.stats and args.jobs > 1:
+        parser.error("--stats is not supported with --jobs")
+    if args.mmap and args.jobs > 1:
+        parser.error("--mmap is not supported with --jobs")
 
-            formatter = Formatter(80, 4)
+    with open(args.src, 'rb') as src:
 
-            for line in src:
-                formatter.parse_line(line)
-                out_lines = formatter.get_lines()
-                if out_lines:
-                    for out_line in out_lines:
-                        dst.write(out_line)
+        with open(args.dst, 'wb') as dst:
 
-            out_lines = formatter.get_lines(flush=True)
-            for out_line in out_lines:
-                dst.write(out_line)
+            if args.jobs > 1:
+                format_parallel(src, dst, args.jobs, args.linesize,
+                                args.tabsize, engine=args.engine,
+                                encoding=args.encoding,
+                                breaking=args.breaking)
+            else:
+                formatter = Formatter(args.linesize, args.tabsize,
+                                      engine=args.engine, stats=args.stats,
+                                      breaking=args.breaking)
+                started = timeit.default_timer()
+                if args.mmap:
+                    formatter.format_mapped(src, dst, encoding=args.encoding)
+                else:
+                    formatter.format_file(src, dst, encoding=args.encoding)
+                if args.stats:
+                    sys.stderr.write("Formatted in %.3f s\n%s\n" % (
+                        timeit.default_timer() - started,
+                        formatter._stats.report()))
@@ -0,0 +1,288 @@
+"""
+This module is an HTTP service formatting texts with Formatter.
+
+POST /format?linesize=80&tabsize=4 with a text in the request body streams
+back the formatted text in the same encoding, GET /stats gets the service
+statistics as JSON.
+"""
+
+import cgi
+import codecs
+import hashlib
+import json
+from collections import OrderedDict
+from io import BytesIO
+from itertools import islice
+
+from twisted.internet import reactor
+from twisted.internet.endpoints import TCP4ServerEndpoint
+from twisted.internet.task import Cooperator
+from twisted.internet.task import TaskFinished
+from twisted.internet.task import TaskStopped
+from twisted.python import log
+from twisted.web.resource import Resource
+from twisted.web.server import NOT_DONE_YET
+from twisted.web.server import Site
+
+from fmt import Formatter
+from fmt import detect_data_encoding
+from fmt import get_error_message
+from fmt import iter_decoded_lines
+
+
+# formatted lines written at once, then control goes back to the reactor
+CHUNK_LINES = 256
+DEFAULT_CACHE_SIZE = 64 * 1024 * 1024
+# limits of formatting parameters given by clients
+MAX_LINESIZE = 1000
+
+
+# -----------------------------------------------------------------------------
+
+class ResultCache(object):
+
+    """
+    LRU cache of formatted texts bounded by their total size.
+
+    Keys are tuples of the source text hash and formatting parameters,
+    values are formatted texts (strings of bytes). The least recently used
+    texts are evicted when the total size exceeds the bound, a text larger
+    than the bound is not cached at all.
+    """
+
+    def __init__(self, max_size=DEFAULT_CACHE_SIZE):
+        """
+        Instance constructor.
+
+        Argument is:
+        * max_size -- integer value, maximum total size of cached texts
+        in bytes.
+        """
+        self._items = OrderedDict()
+        self._max_size = max_size
+        self._size = 0
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        self._evicted_size = 0
+
+    def __len__(self):
+        return len(self._items)
+
+    def get(self, key):
+        """Get cached text by the key or None, marks it as recently used."""
+        value = self._items.pop(key, None)
+        if value is None:
+            self._misses += 1
+        else:
+            self._items[key] = value
+            self._hits += 1
+        return value
+
+    def put(self, key, value):
+        """
+        Put a text to the cache, evicts the least recently used ones.
+
+        Returns True if the text is cached.
+        """
+        if len(value) > self._max_size:
+            return False
+        old_value = self._items.pop(key, None)
+        if old_value is not None:
+            self._size -= len(old_value)
+        self._items[key] = value
+        self._size += len(value)
+        while self._size > self._max_size:
+            _, evicted_value = self._items.popitem(last=False)
+            self._size -= len(evicted_value)
+            self._evictions += 1
+            self._evicted_size += len(evicted_value)
+        return True
+
+    def get_stats(self):
+        """Get a dict of cache counters."""
+        requests = self._hits + self._misses
+        return {
+            'items': len(self._items),
+            'size': self._size,
+            'max_size': self._max_size,
+            'hits': self._hits,
+            'misses': self._misses,
+            'hit_ratio': float(self._hits) / requests if requests else 0.0,
+            'evictions': self._evictions,
+            'evicted_size': self._evicted_size,
+        }
+
+
+# -----------------------------------------------------------------------------
+
+def get_request_encoding(request, body):
+    """
+    Get encoding of a request body: 'encoding' argument, charset of
+    the content type or the detected one.
+    """
+    if 'encoding' in request.args:
+        encoding = request.args['encoding'][0]
+    else:
+        content_type = request.getHeader('content-type') or ''
+        encoding = cgi.parse_header(content_type)[1].get('charset')
+    if not encoding:
+        encoding = detect_data_encoding(body)
+    # raises LookupError for unknown encodings
+    return codecs.lookup(encoding).name
+
+
+class Format(Resource):
+
+    isLeaf = True
+
+    def render_POST(self, request):
+        try:
+            linesize = int(request.args.get('linesize', [80])[0])
+            tabsize = int(request.args.get('tabsize', [4])[0])
+            if not 0 < linesize <= MAX_LINESIZE:
+                raise ValueError("Size of line must be from 1 to %d!" %
+                                 MAX_LINESIZE)
+            if tabsize < 0:
+                raise ValueError("Size of tab must not be negative!")
+            formatter = Formatter(linesize, tabsize, engine='split')
+        except ValueError as e:
+            request.setResponseCode(400)
+            return "%s\n" % e
+        body = request.content.read()
+        try:
+            encoding = get_request_encoding(request, body)
+        except LookupError as e:
+            request.setResponseCode(400)
+            return "%s\n" % e
+
+        request.setHeader('content-type', 'text/plain; charset=%s' % encoding)
+        key = (hashlib.sha1(body).hexdigest(), linesize, tabsize, encoding)
+        formatted = request.site.cache.get(key)
+        if formatted is not None:
+            request.setHeader('x-cache', 'hit')
+            return formatted
+
+        request.setHeader('x-cache', 'miss')
+        lines = iter_decoded_lines(BytesIO(body), encoding)
+        task = request.site.cooperate(
+            self._iter_write(request, formatter.iter_format(lines), encoding,
+                             key))
+        request.notifyFinish().addErrback(self._stop, task)
+        task.whenDone().addErrback(self._stopped)
+        return NOT_DONE_YET
+
+    def _iter_write(self, request, formatted_lines, encoding, key):
+        """
+        Inner method. Writes formatted text to the request by chunks.
+
+        It is iterated by a cooperator, each step formats and writes a chunk
+        of lines. The whole text is cached when it is written.
+        """
+        encoder = codecs.getincrementalencoder(encoding)()
+        chunks = []
+        while True:
+            try:
+                chunk = u''.join(islice(formatted_lines, CHUNK_LINES))
+                chunk = encoder.encode(chunk, final=not chunk)
+            except ValueError as e:
+                # too long word or a text not in the encoding
+                message = get_error_message(e).encode('utf-8')
+                if chunks:
+                    # response is already started, it can be only broken
+                    log.msg("Formatting failed: %s" % message)
+                    request.loseConnection()
+                else:
+                    request.setResponseCode(400)
+                    request.setHeader('content-type',
+                                      'text/plain; charset=utf-8')
+                    request.write(message + '\n')
+                    request.finish()
+                return
+            if not chunk:
+                break
+            chunks.append(chunk)
+            request.write(chunk)
+            yield
+        request.site.cache.put(key, ''.join(chunks))
+        request.finish()
+
+    def _stop(self, reason, task):
+        """Inner method. Stops formatting for a disconnected client."""
+        try:
+            task.stop()
+        except TaskFinished:
+            # formatting is already finished or broken
+            pass
+
+    def _stopped(self, reason):
+        """Inner method. Ignores stopping of a formatting task."""
+        reason.trap(TaskStopped)
+
+
+class Stats(Resource):
+
+    isLeaf = True
+
+    def render_GET(self, request):
+        request.setHeader('content-type', 'application/json')
+        stats = {
+            'cache': request.site.cache.get_stats(),
+            'active_tasks': request.site.active_tasks,
+        }
+        return json.dumps(stats, indent=1, sort_keys=True) + '\n'
+
+
+# -----------------------------------------------------------------------------
+
+class FormatSite(Site):
+
+    def __init__(self, resource, cache, cooperator=None, *args, **kwargs):
+        Site.__init__(self, resource, *args, **kwargs)
+        self._cache = cache
+        self._cooperator = cooperator or Cooperator()
+        self._active_tasks = 0
+
+    @property
+    def cache(self):
+        return self._cache
+
+    @property
+    def active_tasks(self):
+        return self._active_tasks
+
+    def cooperate(self, iterator):
+        """Start an iterator as a task sharing the reactor with others."""
+        task = self._cooperator.cooperate(iterator)
+        self._active_tasks += 1
+        task.whenDone().addBoth(self._task_done)
+        return task
+
+    def _task_done(self, result):
+        # only counts tasks, their results are handled by resources
+        self._active_tasks -= 1
+
+
+# -----------------------------------------------------------------------------
+
+if __name__ == "__main__":
+
+    import argparse
+    import sys
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-p", "--port", type=int, default=8081,
+                        help="port to listen (8081 by default)")
+    parser.add_argument("--cache-size", type=int, default=64,
+                        help="maximum size of cached texts in MB "
+                        "(64 by default)")
+    args = parser.parse_args()
+
+    log.startLogging(sys.stdout)
+    root = Resource()
+    root.putChild('format', Format())
+    root.putChild('stats', Stats())
+    site = FormatSite(root, ResultCache(args.cache_size * 1024 * 1024))
+    endpoint = TCP4ServerEndpoint(reactor, args.port)
+    endpoint.listen(site)
+    reactor.run()
@@ -1,17 +1,63 @@
 # -*- encoding: utf-8 -*-
 
+import codecs
+import mmap
+import os
+import shutil
+import tempfile
 import unittest
+from io import BytesIO
+from StringIO import StringIO
+
+import fmt
+
 from fmt import Formatter
+from fmt import IncrementalFormatter
+from fmt import ParsedDocument
+from fmt import detect_encoding
+from fmt import format_batch
+from fmt import format_parallel
+from fmt import get_text_width
+
+
+SOURCE_DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                               'source_data')
+# ascii text longer than the encoding detection sample
+ASCII_HEAD = "Lorem ipsum dolor sit amet.\n" * 3000
+
+
+def read_with_ascii_head(name):
+    """Reads a source data file after ASCII_HEAD."""
+    with open(os.path.join(SOURCE_DATA_DIR, name), 'rb') as src:
+        return ASCII_HEAD + src.read()
+
+
+def format_file(path, **kwargs):
+    """Formats the file line by line, returns output lines or an error."""
+    formatter = Formatter(**kwargs)
+    out = []
+    try:
+        with open(path, 'r') as src:
+            for line in src:
+                formatter.parse_line(line)
+                out.extend(formatter.get_lines())
+        out.extend(formatter.get_lines(flush=True))
+    except ValueError as e:
+        out.append(e)
+    return out
 
 
 class BasicTests(unittest.TestCase):
     
+    engine = 'scan'
+
     def setUp(self):
         self.linesize = 80
         self.tabsize = 4
         
         self.formatter = Formatter(linesize=self.linesize,
-                                   tabsize=self.tabsize)
+                                   tabsize=self.tabsize,
+                                   engine=self.engine)
     
     def test_empty_formatter(self):
         out = self.formatter.get_lines()
@@ -112,3 +158,642 @@ class BasicTests(unittest.TestCase):
         self.formatter.parse_line(line)
         out = self.formatter.get_lines(flush=True)
         self.assertEqual([expected_line], out)
+
+
+class SplitEngineTests(BasicTests):
+
+    engine = 'split'
+
+    def test_unicode_line(self):
+        line = u"Селдон больше не пытался задерживать сопровождающих.\n"
+        expected_line = (u"    Селдон     больше      не      пытался"
+                         u"      задерживать      сопровождающих.\n")
+        self.formatter.parse_line(line)
+        out = self.formatter.get_lines()
+        self.assertEqual([expected_line], out)
+
+    def test_word_without_trailing_space_is_not_collected(self):
+        self.formatter.parse_line("Lorem ipsum")
+        out = self.formatter.get_lines(flush=True)
+        self.assertEqual([" "*self.tabsize + "Lorem\n"], out)
+
+
+class EnginesEquivalenceTests(unittest.TestCase):
+
+    def test_source_data(self):
+        for name in sorted(os.listdir(SOURCE_DATA_DIR)):
+            path = os.path.join(SOURCE_DATA_DIR, name)
+            for linesize in (40, 80, 120):
+                scan_out = format_file(path, linesize=linesize, engine='scan')
+                split_out = format_file(path, linesize=linesize,
+                                        engine='split')
+                self.assertEqual(len(scan_out), len(split_out))
+                for scan_line, split_line in zip(scan_out, split_out):
+                    if isinstance(scan_line, ValueError):
+                        scan_line = scan_line.args
+                        split_line = split_line.args
+                    self.assertEqual(scan_line, split_line)
+
+    def test_unknown_engine(self):
+        self.assertRaises(ValueError, Formatter, engine='unknown')
+
+
+class JustificationTableTests(unittest.TestCase):
+
+    def setUp(self):
+        self.max_linesize = fmt._MAX_JUSTIFICATION_TABLE_LINESIZE
+
+    def tearDown(self):
+        fmt._MAX_JUSTIFICATION_TABLE_LINESIZE = self.max_linesize
+
+    def test_long_lines_are_justified_without_table(self):
+        path = os.path.join(SOURCE_DATA_DIR, sorted(os.listdir(
+            SOURCE_DATA_DIR))[0])
+        for linesize in (40, 80):
+            table_out = format_file(path, linesize=linesize)
+            fmt._MAX_JUSTIFICATION_TABLE_LINESIZE = 0
+            direct_out = format_file(path, linesize=linesize)
+            fmt._MAX_JUSTIFICATION_TABLE_LINESIZE = self.max_linesize
+            self.assertEqual([str(line) for line in table_out],
+                             [str(line) for line in direct_out])
+
+    def test_tables_are_bounded(self):
+        for linesize in xrange(20, 20 + 2 * fmt._JUSTIFICATION_TABLES_COUNT):
+            Formatter(linesize=linesize)
+        self.assertEqual(len(fmt._justification_tables),
+                         fmt._JUSTIFICATION_TABLES_COUNT)
+        Formatter(linesize=100000)
+        self.assertNotIn(100000, fmt._justification_tables)
+
+
+class OptimalBreakingTests(unittest.TestCase):
+
+    paragraph = (
+        "Lorem ipsum dolor sit amet, consectetur adipisicing elit, sed do "
+        "eiusmod tempor incididunt ut labore et dolore magna aliqua. Ut enim "
+        "ad minim veniam, quis nostrud exercitation ullamco laboris nisi ut "
+        "aliquip ex ea commodo consequat.\n")
+
+    def format(self, text, linesize, tabsize=4, breaking='optimal'):
+        formatter = Formatter(linesize, tabsize, engine='split',
+                              breaking=breaking)
+        return list(formatter.iter_format([text]))
+
+    def get_raggedness(self, lines, linesize, tabsize=4):
+        """Returns sum of squared free spaces of all lines but the last."""
+        raggedness = 0
+        for i, line in enumerate(lines[:-1]):
+            words = line.split()
+            width = sum(map(len, words)) + len(words) - 1
+            if i == 0:
+                width += tabsize
+            raggedness += (linesize - width) ** 2
+        return raggedness
+
+    def test_lines_fit_and_keep_words(self):
+        for linesize in xrange(30, 81, 5):
+            out = self.format(self.paragraph, linesize)
+            self.assertTrue(max(len(line) - 1 for line in out) <= linesize)
+            self.assertEqual(''.join(out).split(), self.paragraph.split())
+            self.assertTrue(out[0].startswith(" "*4 + "Lorem"))
+            # the last line is not justified
+            self.assertEqual(out[-1], ' '.join(out[-1].split()) + '\n')
+
+    def test_not_more_ragged_than_greedy(self):
+        for linesize in xrange(30, 81, 5):
+            optimal = self.format(self.paragraph, linesize)
+            greedy = self.format(self.paragraph, linesize, breaking='greedy')
+            self.assertTrue(self.get_raggedness(optimal, linesize)
+                            <= self.get_raggedness(greedy, linesize))
+
+    def test_less_ragged_than_greedy(self):
+        optimal = self.format(self.paragraph, 30)
+        greedy = self.format(self.paragraph, 30, breaking='greedy')
+        self.assertEqual(self.get_raggedness(optimal, 30), 92)
+        self.assertEqual(self.get_raggedness(greedy, 30), 140)
+
+    def test_one_line_paragraphs(self):
+        for text in ("Header!\n", "Lorem ipsum dolor sit amet, consectetur "
+                     "adipisicing elit, sed do eiusmod.\n"):
+            self.assertEqual(self.format(text, 80),
+                             self.format(text, 80, breaking='greedy'))
+
+    def test_source_data(self):
+        for name in ('text01_utf.txt', 'text01_cp1251.txt'):
+            with open(os.path.join(SOURCE_DATA_DIR, name), 'rb') as src:
+                dst = BytesIO()
+                encoding = Formatter(engine='split', breaking='optimal'
+                                     ).format_file(src, dst)
+            src_words = codecs.open(os.path.join(SOURCE_DATA_DIR, name),
+                                    encoding=encoding).read().split()
+            out_lines = dst.getvalue().decode(encoding).splitlines()
+            self.assertTrue(max(map(len, out_lines)) <= 80)
+            self.assertEqual(u' '.join(out_lines).split(), src_words)
+
+    def test_too_long_word(self):
+        self.assertRaises(ValueError, self.format, "Lorem ipsum.\n", 8)
+        self.assertRaises(ValueError, self.format, "Lorem ipsum.\n", 10, 6)
+
+    def test_wrong_options(self):
+        self.assertRaises(ValueError, Formatter, breaking='unknown')
+        self.assertRaises(ValueError, Formatter, engine='scan',
+                          breaking='optimal')
+
+
+class DisplayWidthTests(unittest.TestCase):
+
+    paragraph = (u"Café naı̈ve 日本語のテキスト 整形 "
+                 u"\U0001F600 smile, \U0001F468‍\U0001F469 family, "
+                 u"ｆｕｌｌ width, 한국어 text, Селдон́ and "
+                 u"\U00020000 ext. Lorem ipsum dolor sit amet.\n")
+
+    def test_get_text_width(self):
+        self.assertEqual(get_text_width(u"Lorem"), 5)
+        self.assertEqual(get_text_width(u"Селдон"), 6)
+        self.assertEqual(get_text_width(u"Café"), 4)
+        self.assertEqual(get_text_width(u"日本語"), 6)
+        self.assertEqual(get_text_width(u"ｆｕｌｌ"), 8)
+        self.assertEqual(get_text_width(u"a​b"), 2)
+        self.assertEqual(get_text_width(u"\U0001F600"), 2)
+        self.assertEqual(get_text_width(u"\U0001F468‍\U0001F469"), 4)
+        self.assertEqual(get_text_width(u"\U00020000x"), 3)
+        self.assertEqual(get_text_width(u"\U00010000x"), 2)
+        self.assertEqual(get_text_width(u"\U000E0001x"), 1)
+
+    def test_justified_line(self):
+        formatter = Formatter(23, 0, engine='split')
+        formatter.parse_line(u"日本語 テキスト 整形.\n")
+        self.assertEqual(formatter.get_lines(),
+                         [u"日本語  テキスト  整形.\n"])
+
+    def test_lines_fit(self):
+        for engine in ('scan', 'split'):
+            for linesize in (30, 40, 50):
+                out = list(Formatter(linesize, engine=engine).iter_format(
+                    [self.paragraph]))
+                self.assertEqual(u''.join(out).split(),
+                                 self.paragraph.split())
+                for line in out[:-1]:
+                    self.assertEqual(get_text_width(line[:-1]), linesize)
+                self.assertTrue(get_text_width(out[-1][:-1]) <= linesize)
+
+    def test_engines_equivalence(self):
+        data = self.paragraph.encode('utf-8')
+        for linesize in (30, 40, 50):
+            scan_out = list(Formatter(linesize, engine='scan').iter_format(
+                [data]))
+            split_out = list(Formatter(linesize, engine='split').iter_format(
+                [data]))
+            self.assertEqual(scan_out, split_out)
+            self.assertEqual(
+                [line.decode('utf-8') for line in split_out],
+                list(Formatter(linesize, engine='split').iter_format(
+                    [self.paragraph])))
+
+    def test_parsed_document(self):
+        document = ParsedDocument([self.paragraph])
+        self.assertEqual(
+            document.render(40),
+            list(Formatter(40, engine='split').iter_format([self.paragraph])))
+
+
+class IterFormatTests(unittest.TestCase):
+
+    lines = [
+        "Lorem ipsum\n",
+        " \n",
+        "Lorem ipsum dolor sit amet, consectetur adipisicing elit, sed do\n",
+        "eiusmod tempor incididunt ut labore et dolore magna aliqua. "
+        "Ut enim\n",
+        "ad minim veniam, quis nostrud exercitation ullamco laboris nisi ut\n",
+        "aliquip ex ea commodo consequat\n",
+    ]
+
+    def test_same_as_get_lines(self):
+        expected = []
+        formatter = Formatter()
+        for line in self.lines:
+            formatter.parse_line(line)
+            expected.extend(formatter.get_lines())
+        expected.extend(formatter.get_lines(flush=True))
+        out = list(Formatter().iter_format(self.lines))
+        self.assertEqual(expected, out)
+
+    def test_lazy(self):
+        consumed = []
+
+        def lines():
+            for line in self.lines:
+                consumed.append(line)
+                yield line
+
+        out = Formatter().iter_format(lines())
+        self.assertEqual("    Lorem ipsum\n", next(out))
+        self.assertEqual(self.lines[:2], consumed)
+
+    def test_format_stream(self):
+        dst = StringIO()
+        Formatter().format_stream(iter(self.lines), dst)
+        expected = ''.join(Formatter().iter_format(self.lines))
+        self.assertEqual(expected, dst.getvalue())
+
+    def test_format_stream_of_file(self):
+        path = os.path.join(SOURCE_DATA_DIR, 'text01_utf.txt')
+        dst = StringIO()
+        with open(path) as src:
+            Formatter(engine='split').format_stream(src, dst)
+        self.assertEqual(''.join(format_file(path)), dst.getvalue())
+
+
+class FormatFileTests(unittest.TestCase):
+
+    text = (u"Селдон больше не пытался "
+            u"задерживать сопровождающих.\n"
+            u"Lorem ipsum\n")
+    expected_text = (u"    Селдон     больше      не"
+                     u"      пытался      задерживать"
+                     u"      сопровождающих.\n"
+                     u"    Lorem ipsum\n")
+
+    def format_bytes(self, data, encoding=None):
+        dst = BytesIO()
+        used_encoding = Formatter().format_file(BytesIO(data), dst, encoding)
+        return used_encoding, dst.getvalue()
+
+    def test_detect_encoding(self):
+        for encoding in ('utf-8', 'cp1251', 'koi8-r', 'cp866'):
+            self.assertEqual(encoding,
+                             detect_encoding(self.text.encode(encoding)))
+
+    def test_detect_encoding_by_bom(self):
+        self.assertEqual('utf-8-sig',
+                         detect_encoding(codecs.BOM_UTF8 + 'text'))
+        self.assertEqual('utf-16',
+                         detect_encoding(self.text.encode('utf-16')))
+
+    def test_detect_encoding_of_cut_symbol(self):
+        data = self.text.encode('utf-8')[:3]
+        self.assertEqual('utf-8', detect_encoding(data))
+
+    def test_format_in_source_encoding(self):
+        for encoding in ('utf-8', 'cp1251', 'koi8-r', 'utf-8-sig', 'utf-16'):
+            used_encoding, out = self.format_bytes(self.text.encode(encoding))
+            self.assertEqual(encoding, used_encoding)
+            self.assertEqual(self.expected_text, out.decode(encoding))
+
+    def test_no_break_space(self):
+        # no-break space is a part of a word, not a separator
+        text = u"100\xa0руб. и т.\xa0д.\n"
+        expected_text = u"    100\xa0руб. и т.\xa0д.\n"
+        for encoding in ('utf-8', 'cp1251'):
+            used_encoding, out = self.format_bytes(text.encode(encoding))
+            self.assertEqual(encoding, used_encoding)
+            self.assertEqual(expected_text, out.decode(encoding))
+        for engine in ('scan', 'split'):
+            formatter = Formatter(engine=engine)
+            formatter.parse_line(text)
+            self.assertEqual(expected_text,
+                             u''.join(formatter.get_lines(flush=True)))
+
+    def test_long_ascii_head(self):
+        # the encoding is detected by the text after the ascii head
+        data = read_with_ascii_head('text01_cp1251.txt')
+        dst = BytesIO()
+        Formatter().format_file(BytesIO(data), dst, 'cp1251')
+        expected = dst.getvalue()
+        self.assertEqual(('cp1251', expected), self.format_bytes(data))
+        dst = BytesIO()
+        self.assertEqual('cp1251', format_parallel(BytesIO(data), dst, 2,
+                                                   chunk_size=4096))
+        self.assertEqual(expected, dst.getvalue())
+        document = ParsedDocument.from_file(BytesIO(data))
+        self.assertEqual(expected.decode('cp1251'),
+                         u''.join(document.render()))
+        for name in ('text01_cp1251.txt', 'text01_utf.txt'):
+            data = read_with_ascii_head(name)
+            self.assertEqual(fmt.detect_data_encoding(data),
+                             detect_encoding(data[len(ASCII_HEAD):]))
+
+    def test_format_with_given_encoding(self):
+        data = self.text.encode('cp866')
+        used_encoding, out = self.format_bytes(data, encoding='cp866')
+        self.assertEqual('cp866', used_encoding)
+        self.assertEqual(self.expected_text, out.decode('cp866'))
+
+    def test_source_data_encodings(self):
+        outputs = []
+        for name in ('text01_utf.txt', 'text01_cp1251.txt'):
+            with open(os.path.join(SOURCE_DATA_DIR, name), 'rb') as src:
+                dst = BytesIO()
+                encoding = Formatter(engine='split').format_file(src, dst)
+                outputs.append(dst.getvalue().decode(encoding))
+        self.assertEqual(outputs[0], outputs[1])
+        self.assertEqual(outputs[0].encode('utf-8'),
+                         ''.join(format_file(os.path.join(SOURCE_DATA_DIR,
+                                                          'text01_utf.txt'))))
+
+
+class FormatMappedTests(unittest.TestCase):
+
+    text = (u"Lorem ipsum dolor sit amet,\n"
+            u"\n"
+            u"   \n"
+            u"consectetur adipisicing elit, sed do\xa0\n"
+            u"eiusmod tempor incididunt. \n"
+            u"   Ut enim ad minim veniam:\n"
+            u"\n"
+            u"quis nostrud " + u"exercitation ullamco " * 40 + u"\n"
+            u"laboris nisi ut aliquip ex ea commodo consequat")
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.block_size = fmt._MAPPED_BLOCK_SIZE
+        self.window_size = fmt._MAPPED_WINDOW_SIZE
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+        fmt._MAPPED_BLOCK_SIZE = self.block_size
+        fmt._MAPPED_WINDOW_SIZE = self.window_size
+
+    def format(self, path, method, **kwargs):
+        dst = BytesIO()
+        with open(path, 'rb') as src:
+            encoding = getattr(Formatter(**kwargs), method)(src, dst)
+        return encoding, dst.getvalue()
+
+    def write(self, data):
+        path = os.path.join(self.tmp_dir, 'src.txt')
+        with open(path, 'wb') as dst:
+            dst.write(data)
+        return path
+
+    def test_same_as_format_file(self):
+        paths = [os.path.join(SOURCE_DATA_DIR, name)
+                 for name in sorted(os.listdir(SOURCE_DATA_DIR))]
+        for path in paths:
+            for kwargs in ({}, {'linesize': 120, 'engine': 'split',
+                                'breaking': 'optimal'}):
+                self.assertEqual(self.format(path, 'format_mapped', **kwargs),
+                                 self.format(path, 'format_file', **kwargs))
+
+    def test_small_blocks_and_windows(self):
+        fmt._MAPPED_WINDOW_SIZE = mmap.ALLOCATIONGRANULARITY
+        for encoding in ('utf-8', 'utf-8-sig', 'cp1251'):
+            path = self.write(self.text.encode(encoding))
+            expected = self.format(path, 'format_file', linesize=40)
+            for block_size in (1, 7, 100, 10000):
+                fmt._MAPPED_BLOCK_SIZE = block_size
+                self.assertEqual(
+                    self.format(path, 'format_mapped', linesize=40), expected)
+
+    def test_long_ascii_head(self):
+        path = self.write(read_with_ascii_head('text01_cp1251.txt'))
+        encoding, out = self.format(path, 'format_mapped')
+        self.assertEqual('cp1251', encoding)
+        self.assertEqual(self.format(path, 'format_file'), (encoding, out))
+
+    def test_not_mapped(self):
+        path = self.write(self.text.encode('utf-16'))
+        self.assertEqual(self.format(path, 'format_mapped'),
+                         self.format(path, 'format_file'))
+        path = self.write('')
+        self.assertEqual(self.format(path, 'format_mapped'), ('utf-8', ''))
+
+    def test_too_long_word(self):
+        path = self.write(self.text.encode('utf-8'))
+        self.assertRaises(ValueError, self.format, path, 'format_mapped',
+                          linesize=10)
+
+
+class FormatParallelTests(unittest.TestCase):
+
+    def format_serial(self, data):
+        dst = BytesIO()
+        Formatter(engine='split').format_file(BytesIO(data), dst)
+        return dst.getvalue()
+
+    def format_parallel(self, data, **kwargs):
+        dst = BytesIO()
+        format_parallel(BytesIO(data), dst, 2, **kwargs)
+        return dst.getvalue()
+
+    def test_source_data(self):
+        for name in sorted(os.listdir(SOURCE_DATA_DIR)):
+            with open(os.path.join(SOURCE_DATA_DIR, name), 'rb') as src:
+                data = src.read()
+            self.assertEqual(self.format_serial(data),
+                             self.format_parallel(data, chunk_size=4096))
+
+    def test_cut_text(self):
+        with open(os.path.join(SOURCE_DATA_DIR, 'text01_cp1251.txt'),
+                  'rb') as src:
+            data = src.read(100003)
+        self.assertEqual(self.format_serial(data),
+                         self.format_parallel(data, chunk_size=1000))
+
+    def test_long_word(self):
+        data = "Lorem ipsum.\n" * 1000 + "x" * 100 + "\n"
+        self.assertRaises(ValueError, self.format_parallel, data,
+                          chunk_size=100)
+
+
+class ParsedDocumentTests(unittest.TestCase):
+
+    def read_document(self, name):
+        with open(os.path.join(SOURCE_DATA_DIR, name), 'rb') as src:
+            return ParsedDocument.from_file(src)
+
+    def format_text(self, name, linesize):
+        with open(os.path.join(SOURCE_DATA_DIR, name), 'rb') as src:
+            dst = BytesIO()
+            encoding = Formatter(linesize).format_file(src, dst)
+        return dst.getvalue().decode(encoding)
+
+    def test_render(self):
+        for name in ('src01.txt', 'src02.txt', 'text01_utf.txt'):
+            document = self.read_document(name)
+            for linesize in (80, 100, 120):
+                self.assertEqual(self.format_text(name, linesize),
+                                 u''.join(document.render(linesize)))
+
+    def test_render_many(self):
+        document = self.read_document('src02.txt')
+        linesizes = range(30, 121, 10)
+        out = document.render_many(linesizes)
+        self.assertEqual(sorted(linesizes), sorted(out))
+        for linesize in linesizes:
+            self.assertEqual(document.render(linesize), out[linesize])
+
+    def test_render_byte_lines(self):
+        lines = IterFormatTests.lines
+        document = ParsedDocument(lines)
+        self.assertEqual(list(Formatter(60, 2).iter_format(lines)),
+                         document.render(60, 2))
+
+    def test_render_long_word(self):
+        document = ParsedDocument(["Lorem ipsum dolor\n"])
+        self.assertRaises(ValueError, document.render, 8)
+
+
+class IncrementalFormatterTests(unittest.TestCase):
+
+    def setUp(self):
+        with open(os.path.join(SOURCE_DATA_DIR, 'text01_utf.txt'),
+                  'rb') as src:
+            self.text = src.read().decode('utf-8')
+        self.formatter = IncrementalFormatter()
+
+    def format_text(self, text, linesize=80, tabsize=4):
+        return u''.join(Formatter(linesize, tabsize).iter_format(
+            text.splitlines(True)))
+
+    def test_format(self):
+        out = self.formatter.format(self.text)
+        self.assertEqual(self.format_text(self.text), out)
+        # only repeated paragraphs are reused
+        self.assertEqual(len(self.formatter._index),
+                         self.formatter.formatted_paragraphs)
+
+    def test_reformat_edited_paragraph(self):
+        self.formatter.format(self.text)
+        num_of_paragraphs = (self.formatter.formatted_paragraphs
+                             + self.formatter.reused_paragraphs)
+        text = self.text.replace(u"Селдон", u"Гэри Селдон", 1)
+        out = self.formatter.format(text)
+        self.assertEqual(self.format_text(text), out)
+        self.assertEqual(1, self.formatter.formatted_paragraphs)
+        self.assertEqual(num_of_paragraphs - 1,
+                         self.formatter.reused_paragraphs)
+
+    def test_reformat_removed_paragraph(self):
+        self.formatter.format(u"Lorem ipsum.\nDolor sit amet.\n")
+        out = self.formatter.format(u"Dolor sit amet.\n")
+        self.assertEqual(u"    Dolor sit amet.\n", out)
+        self.assertEqual(0, self.formatter.formatted_paragraphs)
+        self.assertEqual(1, len(self.formatter._index))
+
+    def test_format_after_error(self):
+        self.assertRaises(ValueError, self.formatter.format,
+                          u"Some %s word.\n" % (u"long" * 20), 40)
+        text = u"Another paragraph.\n"
+        self.assertEqual(self.format_text(text, 40),
+                         self.formatter.format(text, 40))
+
+    def test_many_line_sizes(self):
+        self.formatter.format(self.text, 100)
+        out = self.formatter.format(self.text, 120, 2)
+        self.assertEqual(self.format_text(self.text, 120, 2), out)
+        self.formatter.format(self.text, 100)
+        self.assertEqual(0, self.formatter.formatted_paragraphs)
+
+
+class StatsTests(unittest.TestCase):
+
+    def test_disabled(self):
+        formatter = Formatter()
+        self.assertEqual(None, formatter.stats())
+        self.assertFalse('_flush' in vars(formatter))
+
+    def test_counters(self):
+        formatter = Formatter(engine='split', stats=True)
+        out = list(formatter.iter_format(IterFormatTests.lines))
+        counters = formatter.stats()['counters']
+        self.assertEqual(len(IterFormatTests.lines), counters['lines'])
+        self.assertEqual(sum(map(len, IterFormatTests.lines)),
+                         counters['chars'])
+        self.assertEqual(sum(len(line.split()) for line in out),
+                         counters['words'])
+        self.assertEqual(1, counters['header_lines'])
+        self.assertEqual(3, counters['justified_lines'])
+        self.assertEqual(1, counters['plain_lines'])
+        self.assertEqual(2, counters['flushes'])
+        self.assertEqual(0, counters['too_long_words'])
+
+    def test_same_output(self):
+        lines = IterFormatTests.lines
+        self.assertEqual(list(Formatter().iter_format(lines)),
+                         list(Formatter(stats=True).iter_format(lines)))
+
+    def test_too_long_word(self):
+        formatter = Formatter(20, stats=True)
+        self.assertRaises(ValueError, formatter.parse_line, "x" * 30 + "\n")
+        self.assertEqual(1, formatter.stats()['counters']['too_long_words'])
+
+    def test_stages(self):
+        formatter = Formatter(stats=True)
+        with open(os.path.join(SOURCE_DATA_DIR, 'src02.txt'), 'rb') as src:
+            formatter.format_file(src, BytesIO())
+        stages = formatter.stats()['stages']
+        self.assertEqual(['build', 'detect', 'flush', 'justify', 'parse'],
+                         sorted(stages))
+        self.assertEqual(1, stages['detect']['sampled_calls'])
+        self.assertEqual(9, stages['parse']['calls'])
+
+
+class FormatBatchTests(unittest.TestCase):
+
+    def setUp(self):
+        self.src_dir = tempfile.mkdtemp()
+        self.out_dir = os.path.join(tempfile.mkdtemp(), 'out')
+        os.mkdir(os.path.join(self.src_dir, 'sub'))
+        for name in ('src01.txt', 'src02.txt', os.path.join('sub', 'a.txt')):
+            shutil.copy(os.path.join(SOURCE_DATA_DIR, 'src02.txt'),
+                        os.path.join(self.src_dir, name))
+
+    def tearDown(self):
+        shutil.rmtree(self.src_dir)
+        shutil.rmtree(os.path.dirname(self.out_dir))
+
+    def write_source(self, name, text):
+        with open(os.path.join(self.src_dir, name), 'wb') as dst:
+            dst.write(text)
+
+    def test_format_directory(self):
+        summary = format_batch([self.src_dir], self.out_dir, jobs=2)
+        self.assertEqual(3, summary['formatted'])
+        expected = ''.join(format_file(os.path.join(SOURCE_DATA_DIR,
+                                                    'src02.txt')))
+        with open(os.path.join(self.out_dir, 'sub', 'a.txt'), 'rb') as src:
+            self.assertEqual(expected, src.read())
+
+    def test_skip_up_to_date(self):
+        format_batch([self.src_dir], self.out_dir)
+        summary = format_batch([self.src_dir], self.out_dir)
+        self.assertEqual(0, summary['formatted'])
+        self.assertEqual(3, summary['skipped'])
+
+    def test_format_changed(self):
+        format_batch([self.src_dir], self.out_dir)
+        self.write_source('src01.txt', "Lorem ipsum.\n")
+        os.utime(os.path.join(self.src_dir, 'src01.txt'), (0, 2 ** 31))
+        summary = format_batch([self.src_dir], self.out_dir)
+        self.assertEqual(1, summary['formatted'])
+        self.assertEqual(2, summary['skipped'])
+        with open(os.path.join(self.out_dir, 'src01.txt'), 'rb') as src:
+            self.assertEqual("    Lorem ipsum.\n", src.read())
+
+    def test_format_with_other_options(self):
+        format_batch([self.src_dir], self.out_dir)
+        summary = format_batch([self.src_dir], self.out_dir, linesize=100)
+        self.assertEqual(3, summary['formatted'])
+
+    def test_failures(self):
+        self.write_source('src01.txt', "x" * 100 + "\n")
+        pattern = os.path.join(self.src_dir, '*.txt')
+        missing = os.path.join(self.src_dir, 'missing.txt')
+        summary = format_batch([pattern, missing], self.out_dir, jobs=2)
+        self.assertEqual(1, summary['formatted'])
+        self.assertEqual(2, summary['failed'])
+        self.assertEqual(['missing.txt', 'src01.txt'],
+                         sorted(os.path.basename(failure['src'])
+                                for failure in summary['failures']))
+        self.assertEqual(['.fmt_batch_state.json', 'src02.txt'],
+                         sorted(os.listdir(self.out_dir)))
+
+    def test_manifest(self):
+        manifest = os.path.join(self.src_dir, 'manifest')
+        with open(manifest, 'w') as dst:
+            dst.write(os.path.join(self.src_dir, 'sub', 'a.txt') + '\n')
+        summary = format_batch(['@' + manifest], self.out_dir)
+        self.assertEqual(1, summary['formatted'])
+        self.assertTrue(os.path.exists(os.path.join(self.out_dir, 'a.txt')))
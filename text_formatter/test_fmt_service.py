@@ -0,0 +1,201 @@
+# -*- encoding: utf-8 -*-
+
+import json
+import os
+import unittest
+from io import BytesIO
+
+from twisted.internet.error import ConnectionDone
+from twisted.internet.task import Clock
+from twisted.internet.task import Cooperator
+from twisted.python.failure import Failure
+from twisted.web.resource import Resource
+from twisted.web.test.requesthelper import DummyRequest
+
+import fmt_service
+from fmt import Formatter
+from fmt_service import MAX_LINESIZE
+from fmt_service import Format
+from fmt_service import FormatSite
+from fmt_service import ResultCache
+from fmt_service import Stats
+
+
+SOURCE_DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                               'source_data')
+
+
+class ResultCacheTests(unittest.TestCase):
+
+    def test_get_and_put(self):
+        cache = ResultCache(100)
+        self.assertEqual(cache.get('a'), None)
+        self.assertTrue(cache.put('a', 'x' * 10))
+        self.assertEqual(cache.get('a'), 'x' * 10)
+        stats = cache.get_stats()
+        self.assertEqual((stats['hits'], stats['misses']), (1, 1))
+        self.assertEqual((stats['items'], stats['size']), (1, 10))
+
+    def test_least_recently_used_are_evicted(self):
+        cache = ResultCache(100)
+        cache.put('a', 'x' * 40)
+        cache.put('b', 'x' * 40)
+        cache.get('a')
+        cache.put('c', 'x' * 40)
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual(cache.get('a'), 'x' * 40)
+        self.assertEqual(cache.get('c'), 'x' * 40)
+        stats = cache.get_stats()
+        self.assertEqual((stats['evictions'], stats['evicted_size']), (1, 40))
+        self.assertEqual((stats['items'], stats['size']), (2, 80))
+
+    def test_replace(self):
+        cache = ResultCache(100)
+        cache.put('a', 'x' * 40)
+        cache.put('a', 'x' * 50)
+        self.assertEqual(cache.get_stats()['size'], 50)
+        self.assertEqual(len(cache), 1)
+
+    def test_too_large_text(self):
+        cache = ResultCache(100)
+        cache.put('a', 'x' * 40)
+        self.assertFalse(cache.put('b', 'x' * 101))
+        self.assertEqual(cache.get('a'), 'x' * 40)
+        self.assertEqual(cache.get_stats()['evictions'], 0)
+
+
+class FormatTests(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        # one step of each task per reactor turn, a turn is a clock tick
+        cooperator = Cooperator(
+            terminationPredicateFactory=lambda: lambda: True,
+            scheduler=lambda step: self.clock.callLater(1, step))
+        root = Resource()
+        root.putChild('format', Format())
+        root.putChild('stats', Stats())
+        self.site = FormatSite(root, ResultCache(), cooperator)
+        self.chunk_lines = fmt_service.CHUNK_LINES
+        fmt_service.CHUNK_LINES = 100
+
+    def tearDown(self):
+        fmt_service.CHUNK_LINES = self.chunk_lines
+
+    def post(self, body, **args):
+        request = DummyRequest(['format'])
+        request.method = 'POST'
+        request.site = self.site
+        request.content = BytesIO(body)
+        for name, value in args.items():
+            request.addArg(name, str(value))
+        request.render(self.site.resource.getChildWithDefault('format',
+                                                               request))
+        return request
+
+    def run_tasks(self):
+        while self.clock.getDelayedCalls():
+            self.clock.advance(1)
+
+    def get_stats(self):
+        request = DummyRequest(['stats'])
+        request.site = self.site
+        request.render(self.site.resource.getChildWithDefault('stats',
+                                                              request))
+        return json.loads(''.join(request.written))
+
+    def read_source(self, name):
+        with open(os.path.join(SOURCE_DATA_DIR, name), 'rb') as src:
+            return src.read()
+
+    def format_source(self, name, linesize=80, tabsize=4):
+        dst = BytesIO()
+        with open(os.path.join(SOURCE_DATA_DIR, name), 'rb') as src:
+            Formatter(linesize, tabsize).format_file(src, dst)
+        return dst.getvalue()
+
+    def test_format(self):
+        for name in ('text01_utf.txt', 'text01_cp1251.txt'):
+            request = self.post(self.read_source(name), linesize=100)
+            self.assertFalse(request.finished)
+            self.run_tasks()
+            self.assertEqual(request.finished, 1)
+            self.assertEqual(request.responseCode, None)
+            self.assertEqual(''.join(request.written),
+                             self.format_source(name, 100))
+            self.assertTrue(len(request.written) > 1)
+
+    def test_long_ascii_head(self):
+        body = ("Lorem ipsum dolor sit amet.\n" * 3000 +
+                self.read_source('text01_cp1251.txt'))
+        request = self.post(body)
+        self.run_tasks()
+        self.assertEqual(request.responseCode, None)
+        self.assertEqual(request.responseHeaders.getRawHeaders(
+            'content-type'), ['text/plain; charset=cp1251'])
+        dst = BytesIO()
+        Formatter().format_file(BytesIO(body), dst, 'cp1251')
+        self.assertEqual(''.join(request.written), dst.getvalue())
+
+    def test_cached_result(self):
+        body = self.read_source('text01_utf.txt')
+        first = self.post(body)
+        self.run_tasks()
+        second = self.post(body)
+        self.assertEqual(second.finished, 1)
+        self.assertEqual(second.responseHeaders.getRawHeaders('x-cache'),
+                         ['hit'])
+        self.assertEqual(''.join(second.written), ''.join(first.written))
+        third = self.post(body, tabsize=2)
+        self.assertEqual(third.responseHeaders.getRawHeaders('x-cache'),
+                         ['miss'])
+        self.run_tasks()
+        stats = self.get_stats()
+        self.assertEqual((stats['cache']['hits'], stats['cache']['misses']),
+                         (1, 2))
+        self.assertEqual(stats['cache']['items'], 2)
+
+    def test_tasks_share_reactor(self):
+        big = self.post(self.read_source('text01_utf.txt'))
+        small = self.post("Lorem ipsum dolor sit amet.\n")
+        self.assertEqual(self.get_stats()['active_tasks'], 2)
+        for _ in xrange(4):
+            self.clock.advance(1)
+        self.assertEqual(small.finished, 1)
+        self.assertFalse(big.finished)
+        self.run_tasks()
+        self.assertEqual(big.finished, 1)
+        self.assertEqual(self.get_stats()['active_tasks'], 0)
+
+    def test_disconnect(self):
+        request = self.post(self.read_source('text01_utf.txt'))
+        self.clock.advance(1)
+        request.processingFailed(Failure(ConnectionDone()))
+        self.run_tasks()
+        self.assertFalse(request.finished)
+        self.assertEqual(self.get_stats()['active_tasks'], 0)
+        self.assertEqual(self.get_stats()['cache']['items'], 0)
+
+    def test_bad_requests(self):
+        request = self.post("Lorem ipsum.\n", linesize='x')
+        self.assertEqual(request.responseCode, 400)
+        request = self.post("Lorem ipsum.\n", linesize=4, tabsize=4)
+        self.assertEqual(request.responseCode, 400)
+        request = self.post("Lorem ipsum.\n", linesize=MAX_LINESIZE + 1)
+        self.assertEqual(request.responseCode, 400)
+        request = self.post("Lorem ipsum.\n", linesize=0, tabsize=-4)
+        self.assertEqual(request.responseCode, 400)
+        request = self.post("Lorem ipsum.\n", tabsize=-1)
+        self.assertEqual(request.responseCode, 400)
+        request = self.post("Lorem ipsum.\n", encoding='unknown')
+        self.assertEqual(request.responseCode, 400)
+        request = self.post(self.read_source('text01_utf.txt'), linesize=20)
+        self.run_tasks()
+        self.assertEqual(request.responseCode, 400)
+        self.assertEqual(request.finished, 1)
+        self.assertTrue(''.join(request.written).startswith("Word '"))
+        self.assertEqual(self.get_stats()['cache']['items'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()